@@ -0,0 +1,268 @@
+"""
+Time and memory-profile every converter on synthetic sdoc documents.
+
+    python benchmarks/bench_converters.py run -o before.json
+    python benchmarks/bench_converters.py run --corpus tables --converter sdoc2docx
+    python benchmarks/bench_converters.py run --blocks 5000 --table-size 100x100 --tables 2
+    python benchmarks/bench_converters.py compare before.json after.json
+
+``run`` generates the corpora of ``corpus.CORPORA`` (or the ones picked
+with ``--corpus``, or a custom one when any shape option is given) and
+runs sdoc2html, sdoc2md, sdoc2docx, md2sdoc and docx2sdoc on each.
+md2sdoc and docx2sdoc are fed what sdoc2md and sdoc2docx produced.  The
+best and median time of ``--repeat`` runs and the tracemalloc peak of
+one more run are written as JSON, by default to
+``benchmarks/results/<commit>.json``.
+
+Image downloads and uploads go to a local Seahub stand-in, which waits
+``--latency`` seconds per request.
+
+``compare`` prints the change between two result files and, with
+``--fail-on-regression``, exits non-zero when anything got slower or
+bigger by more than ``--threshold``.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.abspath(os.path.join(BENCHMARKS_DIR, '..'))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from corpus import CORPORA, generate_sdoc
+from tests.seahub_stub import SeahubStub
+
+DOC_UUID = 'bench-doc-uuid'
+USERNAME = 'bench@auth.local'
+CONVERTERS = ('sdoc2html', 'sdoc2md', 'sdoc2docx', 'md2sdoc', 'docx2sdoc')
+# converters that take the output of another one
+CONVERTER_INPUTS = {
+    'md2sdoc': ('md', 'sdoc2md'),
+    'docx2sdoc': ('docx', 'sdoc2docx'),
+}
+SHAPE_OPTIONS = ('blocks', 'tables', 'table_size', 'lists', 'list_depth',
+                 'formula_density', 'code_density', 'images')
+
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', 'seadoc_converter'], cwd=REPO_DIR).returncode
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_converters():
+    # config reads these when it is first imported
+    os.environ.setdefault('SDOC_SERVER_DIR', REPO_DIR)
+    os.environ.setdefault('JWT_PRIVATE_KEY', 'bench-private-key-of-at-least-32-bytes')
+
+    from seadoc_converter.converter.html_converter import sdoc2html
+    from seadoc_converter.converter.markdown_converter import sdoc2md
+    from seadoc_converter.converter.docx_converter import sdoc2docx
+    from seadoc_converter.converter.sdoc_converter.md2sdoc import md2sdoc
+    from seadoc_converter.converter.sdoc_converter.docx2sdoc import docx2sdoc
+
+    return {
+        'sdoc2html': lambda inputs: sdoc2html(inputs['sdoc'], doc_uuid=DOC_UUID, use_cache=False),
+        'sdoc2md': lambda inputs: sdoc2md(inputs['sdoc'], doc_uuid=DOC_UUID),
+        'sdoc2docx': lambda inputs: sdoc2docx(inputs['sdoc'], DOC_UUID, USERNAME),
+        'md2sdoc': lambda inputs: md2sdoc(inputs['md'], username=USERNAME, image_name_url_map={}),
+        'docx2sdoc': lambda inputs: docx2sdoc(inputs['docx'], USERNAME, DOC_UUID)[0],
+    }
+
+
+def output_size(output):
+    if isinstance(output, (str, bytes)):
+        return len(output)
+    return len(json.dumps(output))
+
+
+def measure(convert, inputs, repeat):
+    output = convert(inputs)
+
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        convert(inputs)
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        convert(inputs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = {
+        'best': min(timings),
+        'median': statistics.median(timings),
+        'runs': timings,
+        'peak_memory': peak,
+        'output_size': output_size(output),
+    }
+    return result, output
+
+
+def custom_shape(args):
+    shape = {}
+    for option in SHAPE_OPTIONS:
+        value = getattr(args, option)
+        if value is None:
+            continue
+        if option == 'table_size':
+            rows, cols = value.lower().split('x')
+            shape['table_rows'], shape['table_cols'] = int(rows), int(cols)
+        else:
+            shape[option] = value
+    return shape
+
+
+def run(args):
+    logging.basicConfig(level=logging.CRITICAL)
+
+    corpora = {name: CORPORA[name] for name in (args.corpus or CORPORA)}
+    shape = custom_shape(args)
+    if shape:
+        corpora = {name: corpora[name] for name in (args.corpus or [])}
+        corpora['custom'] = shape
+    converters = [converter for converter in CONVERTERS if converter in (args.converter or CONVERTERS)]
+
+    stub = SeahubStub(latency=args.latency).start()
+    os.environ['SEAHUB_SERVICE_URL'] = stub.url
+    try:
+        convert = load_converters()
+        results = {}
+        for name, shape in corpora.items():
+            sdoc = generate_sdoc(seed=args.seed, **shape)
+            inputs = {'sdoc': sdoc}
+            corpus_results = results[name] = {
+                'shape': shape,
+                'elements': len(sdoc['elements']),
+                'converters': {},
+            }
+            for converter in converters:
+                if converter in CONVERTER_INPUTS:
+                    key, source = CONVERTER_INPUTS[converter]
+                    if key not in inputs:
+                        inputs[key] = convert[source](inputs)
+
+                result, _ = measure(convert[converter], inputs, args.repeat)
+                corpus_results['converters'][converter] = result
+                print(f'{name:<14}{converter:<11}{result["best"]:>10.4f}s{result["median"]:>10.4f}s'
+                      f'{result["peak_memory"] / 1024 / 1024:>10.1f}M{result["output_size"]:>12}')
+    finally:
+        stub.stop()
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'latency': args.latency,
+        'seed': args.seed,
+        'corpora': results,
+    }
+
+    output = args.output or os.path.join(BENCHMARKS_DIR, 'results', f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    print(f'results written to {output}')
+
+
+def change(base, head):
+    if not base:
+        return 0.0
+    return (head - base) / base
+
+
+def compare(args):
+    with open(args.base) as fp:
+        base = json.load(fp)
+    with open(args.head) as fp:
+        head = json.load(fp)
+
+    print(f'{base["commit"]} -> {head["commit"]}')
+    print(f'{"corpus":<14}{"converter":<11}{"base":>10}{"head":>10}{"time":>9}{"base mem":>11}{"head mem":>11}{"mem":>9}')
+
+    regressions = 0
+    for name, head_corpus in head['corpora'].items():
+        base_corpus = base['corpora'].get(name)
+        if not base_corpus:
+            continue
+        if base_corpus['shape'] != head_corpus['shape']:
+            print(f'{name:<14}shapes differ, skipped')
+            continue
+        for converter, head_result in head_corpus['converters'].items():
+            base_result = base_corpus['converters'].get(converter)
+            if not base_result:
+                continue
+
+            time_change = change(base_result['best'], head_result['best'])
+            memory_change = change(base_result['peak_memory'], head_result['peak_memory'])
+            flags = []
+            if time_change > args.threshold:
+                flags.append('slower')
+            if memory_change > args.threshold:
+                flags.append('bigger')
+            regressions += bool(flags)
+
+            print(f'{name:<14}{converter:<11}{base_result["best"]:>9.4f}s{head_result["best"]:>9.4f}s'
+                  f'{time_change:>+9.1%}{base_result["peak_memory"] / 1024 / 1024:>10.1f}M'
+                  f'{head_result["peak_memory"] / 1024 / 1024:>10.1f}M{memory_change:>+9.1%}  {" ".join(flags)}')
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmark the converters of this tree')
+    run_parser.add_argument('--corpus', action='append', choices=sorted(CORPORA))
+    run_parser.add_argument('--converter', action='append', choices=CONVERTERS)
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--latency', type=float, default=0.0, help='seconds per Seahub request')
+    run_parser.add_argument('-o', '--output', help='result file')
+    shape = run_parser.add_argument_group('custom corpus')
+    shape.add_argument('--blocks', type=int)
+    shape.add_argument('--tables', type=int)
+    shape.add_argument('--table-size', help='rows x columns, e.g. 100x20')
+    shape.add_argument('--lists', type=int)
+    shape.add_argument('--list-depth', type=int)
+    shape.add_argument('--formula-density', type=float)
+    shape.add_argument('--code-density', type=float)
+    shape.add_argument('--images', type=int)
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser('compare', help='diff two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('head')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    compare_parser.add_argument('--fail-on-regression', action='store_true')
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
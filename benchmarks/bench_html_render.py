@@ -0,0 +1,212 @@
+"""
+Compare sdoc2html against the html_converter of another git revision
+on deep and wide synthetic documents.
+
+    python benchmarks/bench_html_render.py --ref HEAD~1
+
+The reference module is loaded straight from ``git show`` so that the
+current renderer can be checked for identical output and timed against
+it.  Documents that make the reference hit the recursion limit are
+reported as such.  The fragment cache is bypassed for the comparison
+and measured on its own afterwards, re-exporting a large page after a
+one paragraph edit.  With ``--processes`` a formula and code heavy
+document is also rendered on a process pool and checked against the
+serial output.
+"""
+import os
+import sys
+import time
+import types
+import argparse
+import functools
+import subprocess
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault('SDOC_SERVER_DIR', REPO_DIR)
+
+from seadoc_converter.converter import html_converter
+
+CONVERTER_PATH = 'seadoc_converter/converter/html_converter.py'
+
+
+def load_reference(ref):
+    source = subprocess.check_output(['git', 'show', f'{ref}:{CONVERTER_PATH}'], cwd=REPO_DIR)
+    module = types.ModuleType('reference_html_converter')
+    exec(compile(source, f'{ref}:{CONVERTER_PATH}', 'exec'), module.__dict__)
+    return module
+
+
+def text(node_id, value='item text'):
+    return {'id': node_id, 'text': value}
+
+
+def paragraph(node_id, value='paragraph text'):
+    return {'id': node_id, 'type': 'paragraph', 'children': [text(f'{node_id}-t', value)]}
+
+
+def nested_list(depth):
+    node = paragraph('leaf')
+    for level in range(depth):
+        node = {
+            'id': f'ul-{level}',
+            'type': 'unordered_list',
+            'children': [{
+                'id': f'li-{level}',
+                'type': 'list_item',
+                'children': [paragraph(f'p-{level}'), node],
+            }],
+        }
+    return {'elements': [node]}
+
+
+def nested_blocks(depth):
+    # node types without a dedicated renderer only concatenate their
+    # children, which isolates the cost of the traversal itself
+    node = paragraph('leaf')
+    for level in range(depth):
+        node = {'id': f'block-{level}', 'type': 'image_block', 'children': [node]}
+    return {'elements': [node]}
+
+
+def wide_paragraphs(count):
+    return {'elements': [paragraph(f'p-{index}') for index in range(count)]}
+
+
+def images(count):
+    return {'elements': [{
+        'id': f'block-{index}',
+        'type': 'image_block',
+        'children': [{
+            'id': f'image-{index}',
+            'type': 'image',
+            'data': {'src': f'/image-{index}.png'},
+            'children': [text(f'image-{index}-t', '')],
+        }],
+    } for index in range(count)]}
+
+
+def wide_table(rows, cols):
+    return {'elements': [{
+        'id': 'table',
+        'type': 'table',
+        'columns': [{'width': 100}] * cols,
+        'children': [{
+            'id': f'row-{row}',
+            'type': 'table_row',
+            'style': {'min_height': 42},
+            'children': [{
+                'id': f'cell-{row}-{col}',
+                'type': 'table_cell',
+                'children': [text(f'cell-{row}-{col}-t', f'{row}:{col}')],
+            } for col in range(cols)],
+        } for row in range(rows)],
+    }]}
+
+
+DOCUMENTS = [
+    ('nested list x50', lambda: nested_list(50)),
+    ('nested list x100', lambda: nested_list(100)),
+    ('nested list x300', lambda: nested_list(300)),
+    ('nested blocks x5000', lambda: nested_blocks(5000)),
+    ('paragraphs x20000', lambda: wide_paragraphs(20000)),
+    ('images x20000', lambda: images(20000)),
+    ('table 200x20', lambda: wide_table(200, 20)),
+    ('table 100x100', lambda: wide_table(100, 100)),
+]
+
+
+def formulas_and_code(count):
+    elements = []
+    for index in range(count):
+        elements.append({
+            'id': f'formula-{index}',
+            'type': 'formula',
+            'data': {'formula': f'\\sum_{{k=0}}^{{{index}}} \\frac{{x^k}}{{k!}}'},
+            'children': [text(f'formula-{index}-t', '')],
+        })
+        elements.append({
+            'id': f'code-{index}',
+            'type': 'code_block',
+            'language': 'python',
+            'children': [{
+                'id': f'code-{index}-{line}',
+                'type': 'code_line',
+                'children': [text(f'code-{index}-{line}-t', f'value_{line} = compute({index}, {line})  # step')],
+            } for line in range(20)],
+        })
+    return {'elements': elements}
+
+
+def edited(doc, index):
+    elements = list(doc['elements'])
+    elements[index] = paragraph(elements[index]['id'], 'edited paragraph text')
+    return {'elements': elements}
+
+
+def best_of(func, doc, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        html = func(doc)
+        timings.append(time.perf_counter() - start)
+    return min(timings), html
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ref', help='git revision of the reference html_converter')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--processes', type=int, default=0, help='also time rendering on a process pool')
+    args = parser.parse_args()
+
+    reference = load_reference(args.ref) if args.ref else None
+    render = functools.partial(html_converter.sdoc2html, use_cache=False)
+    render_reference = None
+    if reference:
+        render_reference = reference.sdoc2html
+        if hasattr(reference, 'HTML_FRAGMENT_CACHE'):
+            render_reference = functools.partial(reference.sdoc2html, use_cache=False)
+
+    print(f'{"document":<22}{"current":>12}{"reference":>16}  output')
+    for name, build in DOCUMENTS:
+        doc = build()
+        current_time, current_html = best_of(render, doc, args.repeat)
+
+        reference_column = '-'
+        output_column = f'{len(current_html)} chars'
+        if reference:
+            try:
+                reference_time, reference_html = best_of(render_reference, doc, args.repeat)
+            except RecursionError:
+                reference_column = 'RecursionError'
+            else:
+                reference_column = f'{reference_time:.4f}s'
+                output_column += ', identical' if reference_html == current_html else ', DIFFERENT'
+
+        print(f'{name:<22}{current_time:>11.4f}s{reference_column:>16}  {output_column}')
+
+    doc = wide_paragraphs(10000)
+    html_converter.HTML_FRAGMENT_CACHE.clear()
+    print(f'\n{"paragraphs x10000":<22}{"time":>12}  output')
+    for name, version in (('cold cache', doc), ('unchanged', doc), ('one edit', edited(doc, 5000))):
+        start = time.perf_counter()
+        html = html_converter.sdoc2html(version)
+        elapsed = time.perf_counter() - start
+        same = html == render(version)
+        print(f'{name:<22}{elapsed:>11.4f}s  {"identical" if same else "DIFFERENT"} to uncached')
+
+
+    if args.processes > 1:
+        doc = formulas_and_code(200)
+        serial_time, serial_html = best_of(render, doc, 1)
+        parallel = functools.partial(render, processes=args.processes)
+        parallel(doc)
+        parallel_time, parallel_html = best_of(parallel, doc, 1)
+        same = parallel_html == serial_html
+        print(f'\n{"formulas and code x200":<22}{serial_time:>11.4f}s serial'
+              f'{parallel_time:>11.4f}s on {args.processes} processes  {"identical" if same else "DIFFERENT"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Time every node type of the test fixture when it is rendered under
+``--depth`` ancestors, against the html_converter of another revision.
+
+    python benchmarks/bench_html_templates.py --ref HEAD~1 --depth 8
+
+The reference renders a node at level 0 and is then indented once per
+ancestor, which is what its parents used to do.  The current renderer
+is asked for the node at ``--depth`` directly.  Both the best time and
+the tracemalloc peak of one render are reported, and the outputs are
+compared.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('SDOC_SERVER_DIR', REPO_DIR)
+
+from seadoc_converter.converter import html_converter
+from bench_html_render import load_reference
+
+FIXTURE_PATH = os.path.join(REPO_DIR, 'tests', 'test.sdoc')
+DOC_UUID = 'bench-doc-uuid'
+FORMULA_SVG = '<svg>\n  <path d="M 0 0"/>\n</svg>\n'
+
+
+def nodes_by_type(nodes, found=None):
+    found = {} if found is None else found
+    for node in nodes:
+        if not isinstance(node, dict):
+            continue
+        node_type = node.get('type', 'text')
+        if node_type not in found:
+            found[node_type] = node
+        nodes_by_type(node.get('children', []), found)
+    return found
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        html = func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(timings), peak, html
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ref', required=True, help='git revision of the reference html_converter')
+    parser.add_argument('--depth', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    reference = load_reference(args.ref)
+    # matplotlib timestamps its svg output, keep formulas comparable
+    html_converter.formula_to_svg = reference.formula_to_svg = lambda formula: FORMULA_SVG
+
+    with open(FIXTURE_PATH, 'r', encoding='utf-8') as fp:
+        fixture = json.load(fp)
+
+    def render_reference(node):
+        html = reference.render_node(node, doc_uuid=DOC_UUID)
+        for _ in range(args.depth):
+            html = reference.indent_html(html)
+        return html
+
+    def render_current(node):
+        return html_converter.render_node(node, doc_uuid=DOC_UUID, level=args.depth)
+
+    print(f'{"node type":<20}{"current":>12}{"reference":>12}{"peak":>10}{"ref peak":>10}  output')
+    for node_type, node in sorted(nodes_by_type(fixture['elements']).items()):
+        current_time, current_peak, current_html = timed(lambda: render_current(node), args.repeat)
+        reference_time, reference_peak, reference_html = timed(lambda: render_reference(node), args.repeat)
+        same = current_html == reference_html
+        print(f'{node_type:<20}{current_time * 1e6:>10.1f}us{reference_time * 1e6:>10.1f}us'
+              f'{current_peak:>10}{reference_peak:>10}  {"identical" if same else "DIFFERENT"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+Synthetic sdoc documents of a controllable shape, for the benchmarks.
+
+    from corpus import generate_sdoc
+    doc = generate_sdoc(blocks=1000, tables=5, table_rows=40, table_cols=8,
+                        lists=10, list_depth=6, formula_density=0.05,
+                        code_density=0.1, images=20)
+
+``blocks`` is the number of top level elements.  ``tables``, ``lists``
+and ``images`` of them are tables, nested lists and image blocks, and
+the given fractions of the rest are formulas and code blocks.  The
+remaining blocks are headers, paragraphs with formatted text and links,
+check list items, blockquotes and callouts.  The same arguments always
+give the same document.
+"""
+import random
+
+WORDS = (
+    'seafile sdoc wiki page export table list formula image code '
+    'library share upload sync version history comment review draft'
+).split()
+
+FORMULAS = (
+    r'\sum_{k=0}^{n} \frac{x^k}{k!}',
+    r'\int_0^1 f(x)\,dx = F(1) - F(0)',
+    r'a^2 + b^2 = c^2',
+    r'\sqrt{\frac{1}{n}\sum_{i=1}^{n}(x_i - \mu)^2}',
+    r'e^{i\pi} + 1 = 0',
+)
+
+CODE_LANGUAGES = ('python', 'javascript', 'java', 'sql', 'bash', 'plaintext')
+
+# the named shapes the benchmark suite runs by default
+CORPORA = {
+    'paragraphs': dict(blocks=1000),
+    'tables': dict(blocks=100, tables=10, table_rows=50, table_cols=10),
+    'nested-lists': dict(blocks=200, lists=40, list_depth=8),
+    'formulas': dict(blocks=300, formula_density=0.2),
+    'code': dict(blocks=300, code_density=0.3),
+    'images': dict(blocks=200, images=50),
+    'mixed': dict(blocks=1000, tables=5, table_rows=20, table_cols=6, lists=20, list_depth=4,
+                  formula_density=0.02, code_density=0.05, images=10),
+}
+
+
+class SdocBuilder(object):
+
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def new_id(self):
+        self.count += 1
+        return f'node-{self.count:07d}'
+
+    def words(self, count):
+        return ' '.join(self.random.choice(WORDS) for _ in range(count))
+
+    def text(self, value=None, **marks):
+        node = {'id': self.new_id(), 'text': self.words(6) if value is None else value}
+        node.update(marks)
+        return node
+
+    def inline_children(self):
+        children = [self.text()]
+        choice = self.random.random()
+        if choice < 0.3:
+            children.append(self.text(bold=True))
+        elif choice < 0.5:
+            children.append(self.text(italic=True, color='#e03e2d'))
+        elif choice < 0.6:
+            children.append({
+                'id': self.new_id(),
+                'type': 'link',
+                'href': 'https://www.seafile.com/',
+                'title': 'seafile',
+                'children': [self.text('seafile')],
+            })
+            children.append(self.text())
+        return children
+
+    def paragraph(self):
+        return {'id': self.new_id(), 'type': 'paragraph', 'children': self.inline_children()}
+
+    def header(self):
+        return {'id': self.new_id(), 'type': f'header{self.random.randint(1, 3)}', 'children': [self.text()]}
+
+    def check_list_item(self):
+        return {
+            'id': self.new_id(),
+            'type': 'check_list_item',
+            'checked': self.random.random() < 0.5,
+            'children': [self.text()],
+        }
+
+    def blockquote(self):
+        return {'id': self.new_id(), 'type': 'blockquote', 'children': [self.paragraph()]}
+
+    def callout(self):
+        return {
+            'id': self.new_id(),
+            'type': 'callout',
+            'style': {'background_color': '#fef7e0'},
+            'children': [self.paragraph(), self.paragraph()],
+        }
+
+    def table(self, rows, cols):
+        return {
+            'id': self.new_id(),
+            'type': 'table',
+            'columns': [{'width': 120} for _ in range(cols)],
+            'children': [{
+                'id': self.new_id(),
+                'type': 'table_row',
+                'style': {'min_height': 42},
+                'children': [{
+                    'id': self.new_id(),
+                    'type': 'table_cell',
+                    'style': {},
+                    'children': [self.text(self.words(2))],
+                } for _ in range(cols)],
+            } for _ in range(rows)],
+        }
+
+    def nested_list(self, depth, ordered=False):
+        items = []
+        for _ in range(2):
+            children = [self.paragraph()]
+            if depth > 1 and not items:
+                children.append(self.nested_list(depth - 1, ordered))
+            items.append({'id': self.new_id(), 'type': 'list_item', 'children': children})
+        return {'id': self.new_id(), 'type': 'ordered_list' if ordered else 'unordered_list', 'children': items}
+
+    def formula(self):
+        return {
+            'id': self.new_id(),
+            'type': 'formula',
+            'data': {'formula': self.random.choice(FORMULAS)},
+            'children': [self.text('')],
+        }
+
+    def code_block(self, lines=12):
+        language = self.random.choice(CODE_LANGUAGES)
+        return {
+            'id': self.new_id(),
+            'type': 'code_block',
+            'language': language,
+            'style': {'white_space': 'nowrap'},
+            'children': [{
+                'id': self.new_id(),
+                'type': 'code_line',
+                'children': [self.text(f'{"    " * (line % 3)}value_{line} = compute("{self.words(2)}", {line})')],
+            } for line in range(lines)],
+        }
+
+    def image_paragraph(self, index):
+        # inline in a paragraph, the only place sdoc2docx looks for images
+        return {
+            'id': self.new_id(),
+            'type': 'paragraph',
+            'children': [
+                self.text(''),
+                {
+                    'id': self.new_id(),
+                    'type': 'image',
+                    'data': {'src': f'/image-{index:05d}.png'},
+                    'children': [self.text('')],
+                },
+                self.text(''),
+            ],
+        }
+
+
+def generate_sdoc(blocks=100, tables=0, table_rows=10, table_cols=5, lists=0, list_depth=3,
+                  formula_density=0.0, code_density=0.0, images=0, seed=0):
+    builder = SdocBuilder(seed)
+
+    kinds = ['table'] * tables + ['list'] * lists + ['image'] * images
+    rest = max(blocks - len(kinds), 0)
+    formulas = int(rest * formula_density)
+    code_blocks = int(rest * code_density)
+    kinds += ['formula'] * formulas + ['code'] * code_blocks
+    kinds += ['text'] * (blocks - len(kinds))
+    builder.random.shuffle(kinds)
+
+    text_blocks = (
+        (builder.paragraph, 0.6),
+        (builder.header, 0.75),
+        (builder.check_list_item, 0.85),
+        (builder.blockquote, 0.95),
+        (builder.callout, 1.0),
+    )
+
+    elements = []
+    image_count = 0
+    for kind in kinds:
+        if kind == 'table':
+            elements.append(builder.table(table_rows, table_cols))
+        elif kind == 'list':
+            elements.append(builder.nested_list(list_depth, ordered=builder.random.random() < 0.5))
+        elif kind == 'image':
+            elements.append(builder.image_paragraph(image_count))
+            image_count += 1
+        elif kind == 'formula':
+            elements.append(builder.formula())
+        elif kind == 'code':
+            elements.append(builder.code_block())
+        else:
+            choice = builder.random.random()
+            build = next(build for build, limit in text_blocks if choice < limit)
+            elements.append(build())
+
+    return {
+        'version': 1,
+        'format_version': 4,
+        'cursors': {},
+        'last_modify_user': 'bench@auth.local',
+        'elements': elements,
+    }
@@ -29,6 +29,47 @@ sys.path.insert(0, SDOC_SERVER_DIR)
 SDOC_OPERATION_CLEAN_LOG_FILE = os.path.join(LOG_DIR, 'sdoc_operation_log_clean.log')
 SDOC_OPERATION_CLEAN_LOG_LEVEL = 'info'
 
+# total length of the rendered html elements kept between sdoc2html calls,
+# 0 disables the cache
+HTML_FRAGMENT_CACHE_SIZE = 64 * 1024 * 1024
+# worker processes rendering the elements of large documents to html,
+# 0 or 1 renders in the request
+HTML_RENDER_PROCESSES = 0
+# images downloaded at the same time for an export, and the seconds to
+# wait for each of them
+IMAGE_DOWNLOAD_WORKERS = 8
+IMAGE_DOWNLOAD_TIMEOUT = 30
+# seconds an image download link from Seahub is reused for, 0 to ask for
+# a new one every time, and the most links kept
+IMAGE_LINK_CACHE_TTL = 60
+IMAGE_LINK_CACHE_SIZE = 10000
+# fetch the images of a document that link other sites directly when it
+# is exported with its images, instead of leaving them linked or, in
+# docx exports, looking them up in Seahub by name.  Hosts with private,
+# loopback or other non public addresses are refused all the same
+IMAGE_DOWNLOAD_EXTERNAL = False
+# .docx whose styles, page setup and content docx exports start from,
+# empty for the python-docx default template
+DOCX_TEMPLATE_PATH = ''
+# bytes of an exported .docx kept in memory, before it is moved to a
+# temporary file on disk
+DOCX_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+# limits of highlighting one code block in html: lines past the first
+# CODE_HIGHLIGHT_MAX_LINES lines or CODE_HIGHLIGHT_MAX_BYTES bytes, and
+# lines left after CODE_HIGHLIGHT_TIME_BUDGET seconds, are rendered plain
+CODE_HIGHLIGHT_MAX_LINES = 10000
+CODE_HIGHLIGHT_MAX_BYTES = 1024 * 1024
+CODE_HIGHLIGHT_TIME_BUDGET = 1.0
+# seconds an html export may take, after which the elements left are
+# rendered as their source text, 0 for no limit
+HTML_EXPORT_TIMEOUT = 60
+# seconds one formula or code block may take to render in html, 0 for no
+# limit.  With a limit, formulas are rendered in worker processes that
+# are stopped when it runs out, and shown as their source from then on.
+HTML_NODE_TIME_BUDGET = 0
+# log the time spent on each node type by every html export
+HTML_RENDER_PROFILE = False
+
 
 # config in file
 try:
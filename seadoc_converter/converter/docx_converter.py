@@ -1,40 +1,35 @@
-import os
 import io
+import os
+import re
+import copy
 import docx
 import logging
-import requests
-import time
+import functools
+
+from xml.sax.saxutils import escape, quoteattr
 
 from docx import Document
-from docx.shared import Pt, Inches, RGBColor
-from docx.oxml.ns import qn
+from docx.shared import Pt, Emu, Inches, RGBColor
+from docx.enum.style import WD_STYLE_TYPE
+from docx.table import Table
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn, nsdecls
+from docx.oxml.shape import CT_Inline
 from docx.oxml.shared import OxmlElement
 
-from seadoc_converter.config import SEAHUB_SERVICE_URL
-from seadoc_converter.converter.utils import gen_jwt_auth_header
+from seadoc_converter.config import SEAHUB_SERVICE_URL, DOCX_TEMPLATE_PATH
+from seadoc_converter.converter.utils import download_images
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_CALLOUT_COLOR = 'fef7e0'
-
-
-def get_image_content_url(file_uuid, image_name):
-
-    payload = {
-        'file_uuid': file_uuid,
-        'exp': int(time.time()) + 300
-    }
-
-    url = f'{SEAHUB_SERVICE_URL}/api/v2.1/seadoc/image-download-link/{file_uuid}/'
-    params = {'image_name': image_name}
-    headers = gen_jwt_auth_header(payload)
-
-    resp = requests.get(url, params, headers=headers)
-    if resp.status_code == 200:
-        return resp.json().get('download_link')
-    else:
-        logger.error(resp.__dict__)
-        return ""
+LINK_TYPES = ('link', 'sdoc_link', 'file_link')
+LIST_TYPES = ('ordered_list', 'unordered_list')
+# the deepest list level with its own paragraph style, e.g. 'List Bullet 3'
+MAX_LIST_LEVEL = 3
+RUN_BREAK_RE = re.compile(r'([\t\r\n])')
+# (bold, italic, color, font, font size, font also for east asian text) of code
+CODE_RUN_FORMAT = (False, False, None, 'Courier New', 10, False)
 
 
 def hex_to_rgb(hex_color):
@@ -42,7 +37,332 @@ def hex_to_rgb(hex_color):
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
 
-def sdoc2docx(file_content_json, file_uuid, username):
+@functools.lru_cache(maxsize=16)
+def load_docx_template(template_path, mtime):
+    # mtime is part of the key, so that an edited template is read again
+    return Document(template_path)
+
+
+def new_document(template_path=None):
+    """
+    A new document from the .docx at ``template_path``, or from the
+    python-docx default template.  Each template is parsed once per
+    process and every document is a copy of the parsed one.
+    """
+    template_path = template_path or DOCX_TEMPLATE_PATH or None
+    mtime = os.path.getmtime(template_path) if template_path else None
+    return copy.deepcopy(load_docx_template(template_path, mtime))
+
+
+def get_image_src(sdoc_type, content):
+    """
+    The src of the image a paragraph or image block is exported as, or
+    '' when it is exported as text or a link.
+    """
+    if sdoc_type not in ('paragraph', 'image_block') or \
+            not any(item.get('type') == 'image' for item in content):
+        return ''
+    if sdoc_type == 'paragraph' and any(item.get('type') in LINK_TYPES for item in content):
+        return ''
+
+    image_src = ''
+    for item in content:
+        if 'data' in item:
+            image_src = item['data']['src']
+    return image_src
+
+
+def iter_docx_blocks(sdoc_node_list):
+    """
+    The blocks of an sdoc as (type, content, style), in document order.
+
+    A block is each innermost node whose children are text, with the type
+    and style of the top level element it is in, or a table with its
+    rows.  Items of nested lists get the type of their
+    own list and their nesting level, e.g. 'unordered_list_2'.  The tree
+    is walked without recursion, so any depth of nesting is fine.
+    """
+    for sdoc_node in sdoc_node_list:
+        top_type = sdoc_node.get('type', '')
+        top_style = sdoc_node.get('style', '')
+        children_list = sdoc_node.get('children', [])
+        if not children_list:
+            continue
+
+        if 'text' in children_list[0]:
+            yield top_type, children_list, top_style
+            continue
+        if top_type == 'table':
+            yield top_type, children_list, top_style
+            continue
+
+        # (siblings left to visit, innermost list type, list level)
+        list_level = 1 if top_type in LIST_TYPES else 0
+        stack = [(iter(children_list), top_type, list_level)]
+        while stack:
+            siblings, list_type, list_level = stack[-1]
+            node = next(siblings, None)
+            if node is None:
+                stack.pop()
+                continue
+
+            sub_children_list = node.get('children', [])
+            if not sub_children_list:
+                continue
+
+            node_type = node.get('type')
+            if list_level and node_type in LIST_TYPES:
+                list_type, list_level = node_type, list_level + 1
+
+            if 'text' not in sub_children_list[0]:
+                stack.append((iter(sub_children_list), list_type, list_level))
+            elif list_level > 1:
+                yield f'{list_type}_{min(list_level, MAX_LIST_LEVEL)}', sub_children_list, top_style
+            elif list_level:
+                yield list_type, sub_children_list, top_style
+            else:
+                yield top_type, sub_children_list, top_style
+
+
+class RunStyles(object):
+    """
+    The character styles of a document, one for each distinct run
+    formatting, so that runs refer to a style instead of each carrying
+    its own copy of the formatting.
+
+    Bold and italic are toggles in Word: set in both a paragraph style
+    and a character style they cancel out.  So in paragraphs whose style
+    turns them on, like headings, they stay on the runs as before.
+    """
+
+    def __init__(self, document):
+        self.styles = document.styles
+        # run format -> character style, None for no formatting
+        self.run_styles = {(False, False, None, None, None, True): None}
+        # paragraph style id -> (bold, italic) it turns on
+        self.paragraph_toggles = {}
+
+    def get(self, run_format):
+        if run_format in self.run_styles:
+            return self.run_styles[run_format]
+
+        bold, italic, color, font, font_size, east_asia = run_format
+        words = ['Bold' if bold else '', 'Italic' if italic else '', color and color.lstrip('#').upper(),
+                 font, font_size and f'{font_size}pt']
+        name = ' '.join(['Sdoc'] + [word for word in words if word])
+        unique_name, index = name, 1
+        while unique_name in self.styles:
+            index += 1
+            unique_name = f'{name} {index}'
+
+        style = self.styles.add_style(unique_name, WD_STYLE_TYPE.CHARACTER)
+        if bold:
+            style.font.bold = True
+        if italic:
+            style.font.italic = True
+        if color:
+            style.font.color.rgb = RGBColor(*hex_to_rgb(color))
+        if font:
+            style.font.name = font
+            if east_asia:
+                style.element.rPr.rFonts.set(qn('w:eastAsia'), font)
+        if font_size:
+            style.font.size = Pt(font_size)
+
+        self.run_styles[run_format] = style
+        return style
+
+    def get_paragraph_toggles(self, style_id):
+        toggles = self.paragraph_toggles.get(style_id)
+        if toggles is None:
+            style = self.styles.get_by_id(style_id, WD_STYLE_TYPE.PARAGRAPH)
+            bold = italic = None
+            while style is not None and (bold is None or italic is None):
+                bold = style.font.bold if bold is None else bold
+                italic = style.font.italic if italic is None else italic
+                style = style.base_style
+            toggles = self.paragraph_toggles[style_id] = (bool(bold), bool(italic))
+        return toggles
+
+    def get_run_formatting(self, text_dict, paragraph_style_id):
+        """
+        The character style of a run formatted like the sdoc text node
+        ``text_dict`` in a paragraph of the given style, and the bold and
+        italic set on the run itself, None where it sets none.
+        """
+        bold = bool(text_dict.get('bold', False))
+        italic = bool(text_dict.get('italic', False))
+        paragraph_bold, paragraph_italic = self.get_paragraph_toggles(paragraph_style_id)
+        run_format = (
+            bold and not paragraph_bold,
+            italic and not paragraph_italic,
+            text_dict.get('color') or None,
+            text_dict.get('font') or None,
+            text_dict.get('font_size') or None,
+            True,
+        )
+        return self.get(run_format), bold if paragraph_bold else None, italic if paragraph_italic else None
+
+    def add_run(self, paragraph, text, text_dict):
+        """
+        Add a run of ``text`` to ``paragraph``, formatted like the sdoc
+        text node ``text_dict``.
+        """
+        style, bold, italic = self.get_run_formatting(text_dict, paragraph._p.style)
+        run = paragraph.add_run(text)
+        if style is not None:
+            # run.style would look up the default style for every run
+            run._r.style = style.style_id
+        if bold is not None:
+            run.bold = bold
+        if italic is not None:
+            run.italic = italic
+        return run
+
+    def add_styled_run(self, paragraph, text, run_format):
+        run = paragraph.add_run(text)
+        style = self.get(run_format)
+        if style is not None:
+            run._r.style = style.style_id
+        return run
+
+    def run_xml(self, text, text_dict, paragraph_style_id=None):
+        """
+        The xml of the run ``add_run`` would add to a paragraph of the
+        given style, for building larger pieces of xml at once.
+        """
+        style, bold, italic = self.get_run_formatting(text_dict, paragraph_style_id)
+        rpr = []
+        if style is not None:
+            rpr.append(f'<w:rStyle w:val={quoteattr(style.style_id)}/>')
+        if bold is not None:
+            rpr.append('<w:b/>' if bold else '<w:b w:val="0"/>')
+        if italic is not None:
+            rpr.append('<w:i/>' if italic else '<w:i w:val="0"/>')
+
+        xml = ['<w:r>']
+        if rpr:
+            xml += ['<w:rPr>', *rpr, '</w:rPr>']
+        # tabs and line breaks become w:tab and w:br, like run.text does
+        for part in RUN_BREAK_RE.split(text or ''):
+            if part == '\t':
+                xml.append('<w:tab/>')
+            elif part in ('\r', '\n'):
+                xml.append('<w:br/>')
+            elif part:
+                space = ' xml:space="preserve"' if len(part.strip()) < len(part) else ''
+                xml.append(f'<w:t{space}>{escape(part)}</w:t>')
+        xml.append('</w:r>')
+        return ''.join(xml)
+
+
+class Pictures(object):
+    """
+    The pictures of a document.  The image of each src is read, measured
+    and stored once, and every picture of it refers to the same image
+    part.  Images of different srcs with the same content share their
+    part as well, as python-docx looks image parts up by their sha1.
+    """
+
+    def __init__(self, document):
+        self.document = document
+        self.part = document.part
+        # src -> (rId, image), or the error the image could not be added with
+        self.images = {}
+        self.shape_id = None
+
+    def add(self, image_src, image_content, width=None, height=None):
+        """
+        Add a paragraph with a picture of ``image_content``, like
+        ``document.add_picture``.
+        """
+        run = self.document.add_paragraph().add_run()
+
+        image = self.images.get(image_src)
+        if image is None:
+            try:
+                image = self.part.get_or_add_image(io.BytesIO(image_content))
+            except Exception as e:
+                image = e
+            self.images[image_src] = image
+        if isinstance(image, Exception):
+            raise image
+        r_id, image = image
+
+        # part.next_id scans the whole document, the ids after it are
+        # only taken by the pictures added here
+        self.shape_id = self.part.next_id if self.shape_id is None else self.shape_id + 1
+        cx, cy = image.scaled_dimensions(width, height)
+        run._r.add_drawing(CT_Inline.new_pic_inline(self.shape_id, r_id, image.filename, cx, cy))
+        return run
+
+
+def add_table(document, rows, run_styles):
+    """
+    Add a table of the sdoc ``rows`` to ``document``, with the cells
+    merged as their rowspan and colspan say.
+
+    The w:tbl, cell text included, is built as one piece of xml in one
+    pass over the rows, the way python-docx builds an empty table.
+    Filling a table through ``row.cells`` and ``paragraph.add_run``
+    instead works the cell grid out again for every row, and builds
+    each run element by element.
+    """
+    col_count = max(len(row.get('children', [])) for row in rows)
+    col_width = Emu(document._block_width // col_count) if col_count else Emu(0)
+
+    def tc_xml(span, v_merge, runs):
+        grid_span = f'<w:gridSpan w:val="{span}"/>' if span > 1 else ''
+        return (f'<w:tc><w:tcPr><w:tcW w:type="dxa" w:w="{col_width.twips * span}"/>'
+                f'{grid_span}{v_merge}</w:tcPr><w:p>{runs}</w:p></w:tc>')
+
+    xml = [
+        f'<w:tbl {nsdecls("w")}><w:tblPr><w:tblW w:type="auto" w:w="0"/>'
+        '<w:tblLook w:firstColumn="1" w:firstRow="1" w:lastColumn="0" w:lastRow="0" w:noHBand="0" '
+        'w:noVBand="1" w:val="04A0"/></w:tblPr><w:tblGrid>',
+        f'<w:gridCol w:w="{col_width.twips}"/>' * col_count,
+        '</w:tblGrid>',
+    ]
+    # column -> (rows left, colspan) of the merged cell reaching down into it
+    v_merges = {}
+    for row_index, row in enumerate(rows):
+        xml.append('<w:tr>')
+        row_cells = row.get('children', [])
+        col_index = 0
+        while col_index < col_count:
+            if col_index in v_merges:
+                rows_left, colspan = v_merges.pop(col_index)
+                if rows_left > 1:
+                    v_merges[col_index] = (rows_left - 1, colspan)
+                xml.append(tc_xml(colspan, '<w:vMerge/>', ''))
+                col_index += colspan
+                continue
+
+            cell = row_cells[col_index] if col_index < len(row_cells) else {}
+            colspan = max(int(cell.get('colspan') or 1), 1)
+            rowspan = min(max(int(cell.get('rowspan') or 1), 1), len(rows) - row_index)
+            # a cell can not reach into the columns a cell above covers
+            colspan = next((span for span in range(1, colspan)
+                            if col_index + span >= col_count or col_index + span in v_merges), colspan)
+            if rowspan > 1:
+                v_merges[col_index] = (rowspan - 1, colspan)
+            runs = ''.join(run_styles.run_xml(cell_run.get('text', ''), cell_run)
+                           for cell_run in cell.get('children', []))
+            xml.append(tc_xml(colspan, '<w:vMerge w:val="restart"/>' if rowspan > 1 else '', runs))
+            col_index += colspan
+        xml.append('</w:tr>')
+    xml.append('</w:tbl>')
+
+    tbl = parse_xml(''.join(xml))
+    document.element.body._insert_tbl(tbl)
+    return Table(tbl, document._body)
+
+
+def sdoc2docx(file_content_json, file_uuid, username, template_path=None, output=None):
+    """
+    Export an sdoc as .docx.  The .docx is written to ``output``, a
+    seekable binary file object, or returned as bytes when it is None.
+    """
 
     def add_hyperlink(paragraph, url, text, color):
         """
@@ -83,55 +403,17 @@ def sdoc2docx(file_content_json, file_uuid, username):
 
         return hyperlink
 
-    def search_sdoc_node_recursively(children_list, type_sq=[], top_type='', top_style=''):
-
-        if 'text' in children_list[0]:
-            if top_type == "ordered_list" and type_sq.count('ordered_list') == 1:
-                type_content_list.append(['ordered_list_2', children_list, top_style])
-            elif top_type == "ordered_list" and type_sq.count('ordered_list') >= 2:
-                type_content_list.append(['ordered_list_3', children_list, top_style])
-            elif top_type == "unordered_list" and type_sq.count('unordered_list') == 1:
-                type_content_list.append(['ordered_list_2', children_list, top_style])
-            elif top_type == "unordered_list" and type_sq.count('unordered_list') >= 2:
-                type_content_list.append(['ordered_list_3', children_list, top_style])
-            else:
-                type_content_list.append([top_type, children_list, top_style])
-        else:
-            if top_type == 'table':
-                table_runs = []
-                for row in children_list:
-                    row_data = []
-                    for cell in row["children"]:
-                        cell_data = cell["children"]
-                        row_data.append(cell_data)
-                    table_runs.append(row_data)
-
-                type_content_list.append([top_type, table_runs, top_style])
-            else:
-                for children in children_list:
-                    current_type = children.get('type', 'no type')
-                    sub_children_list = children.get('children', [])
-                    if sub_children_list:
-                        search_sdoc_node_recursively(sub_children_list,
-                                                 type_sq + [current_type],
-                                                 top_type=top_type, top_style=top_style)
-
     sdoc_node_list = file_content_json.get('elements', [])
-    type_content_list = []
-    for sdoc_node in sdoc_node_list:
-        top_sdoc_type = sdoc_node.get('type', '')
-        children_list = sdoc_node.get('children', [])
-        style = sdoc_node.get('style', '')
-        if children_list:
-            search_sdoc_node_recursively(children_list, top_type=top_sdoc_type, top_style=style)
 
-    document = Document()
+    # download every image up front, concurrently and each src once
+    image_srcs = (get_image_src(sdoc_type, content) for sdoc_type, content, _ in iter_docx_blocks(sdoc_node_list))
+    images = download_images(filter(None, image_srcs), file_uuid, batch_links=True)
 
-    for type_content in type_content_list:
+    document = new_document(template_path)
+    run_styles = RunStyles(document)
+    pictures = Pictures(document)
 
-        sdoc_type = type_content[0]
-        content = type_content[1]
-        style = type_content[2]
+    for sdoc_type, content, style in iter_docx_blocks(sdoc_node_list):
 
         if sdoc_type == 'title':
             docx_paragraph = document.add_heading(level=0)
@@ -173,9 +455,7 @@ def sdoc2docx(file_content_json, file_uuid, username):
 
             for text_dict in content:
                 text = text_dict.get('text', '')
-                run = docx_paragraph.add_run(text)
-                run.font.size = Pt(10)
-                run.font.name = 'Courier New'
+                run_styles.add_styled_run(docx_paragraph, text, CODE_RUN_FORMAT)
 
         elif sdoc_type == 'paragraph' and \
                 any(item.get('type') == 'link' for item in content):
@@ -243,48 +523,20 @@ def sdoc2docx(file_content_json, file_uuid, username):
             #    'type': 'image'},
             #   {'id': 'SQjLfnvBSimn695OZtyGnw', 'text': ''}]],
 
-            image_file_path = ''
-            for item in content:
-                if 'data' in item:
-                    image_file_path = item['data']['src']
-
-            image_name = os.path.basename(image_file_path)
-            image_content_url = get_image_content_url(file_uuid, image_name)
-            if image_content_url:
-                resp = requests.get(image_content_url)
-                image_content = resp.content
+            image_file_path = get_image_src(sdoc_type, content)
+            image = images.get(image_file_path)
+            if image:
+                image_content, _ = image
                 try:
-                    document.add_picture(io.BytesIO(image_content), width=Inches(5))
+                    pictures.add(image_file_path, image_content, width=Inches(5))
                 except Exception as e:
-                    logger.debug('add image to docx failed: file_uuid: %s, image_path: %s, error: %s', file_uuid, image_content_url, e)
+                    logger.debug('add image to docx failed: file_uuid: %s, image_path: %s, error: %s', file_uuid, image_file_path, e)
             else:
-                logger.exception(f'can not get image content: {file_uuid} {image_file_path}')
+                logger.error(f'can not get image content: {file_uuid} {image_file_path}')
 
         elif sdoc_type == 'table':
             # add table to docx
-
-            table = document.add_table(rows=len(content), cols=len(content[0]))
-            for i, row in enumerate(table.rows):
-                for j, cell in enumerate(row.cells):
-                    cell_info = content[i][j]
-                    paragraph = (
-                        cell.paragraphs[0] if cell.paragraphs else cell.add_paragraph()
-                    )
-
-                    for cell_run in cell_info:
-                        run = paragraph.add_run(cell_run.get('text', ''))
-                        bold = cell_run.get('bold', False)
-                        run.bold = True if bold else False
-                        italic = cell_run.get('italic', False)
-                        run.italic = True if italic else False
-                        if hex_color := cell_run.get('color', None):
-                            rgb_color = hex_to_rgb(hex_color)
-                            run.font.color.rgb = RGBColor(*rgb_color)
-                        if font_name := cell_run.get('font', None):
-                            run.font.name = font_name
-                            run._element.rPr.rFonts.set(qn('w:eastAsia'), font_name)
-                        if font_size := cell_run.get('font_size', None):
-                            run.font.size = Pt(font_size)
+            add_table(document, content, run_styles)
 
         elif sdoc_type == 'callout':
 
@@ -306,41 +558,16 @@ def sdoc2docx(file_content_json, file_uuid, username):
             docx_paragraph.paragraph_format.element.pPr.append(shd)
 
             for text_dict in content:
-                text = text_dict.get('text', '')
-                run = docx_paragraph.add_run(text)
-
-                bold = text_dict.get('bold', False)
-                run.bold = True if bold else False
-                italic = text_dict.get('italic', False)
-                run.italic = True if italic else False
-                if hex_color := text_dict.get('color', None):
-                    rgb_color = hex_to_rgb(hex_color)
-                    run.font.color.rgb = RGBColor(*rgb_color)
-                if font_name := text_dict.get('font', None):
-                    run.font.name = font_name
-                    run._element.rPr.rFonts.set(qn('w:eastAsia'), font_name)
-                if font_size := text_dict.get('font_size', None):
-                    run.font.size = Pt(font_size)
+                run_styles.add_run(docx_paragraph, text_dict.get('text', ''), text_dict)
         else:
 
             for text_dict in content:
-
                 text = text_dict.get('text', '') or text_dict.get('href', '')
-                run = docx_paragraph.add_run(text)
-
-                bold = text_dict.get('bold', False)
-                run.bold = True if bold else False
-
-                italic = text_dict.get('italic', False)
-                run.italic = True if italic else False
-                if hex_color := text_dict.get('color', None):
-                    rgb_color = hex_to_rgb(hex_color)
-                    run.font.color.rgb = RGBColor(*rgb_color)
-                if font_name := text_dict.get('font', None):
-                    run.font.name = font_name
-                    run._element.rPr.rFonts.set(qn('w:eastAsia'), font_name)
-                if font_size := text_dict.get('font_size', None):
-                    run.font.size = Pt(font_size)
+                run_styles.add_run(docx_paragraph, text, text_dict)
+
+    if output is not None:
+        document.save(output)
+        return
 
     memory_stream = io.BytesIO()
     document.save(memory_stream)
@@ -1,19 +1,37 @@
 # -*- coding: utf-8 -*-
 import json
+import time
+import logging
+import hashlib
+import functools
+import itertools
+import threading
+import multiprocessing
 import html as html_module
 import re
-from io import BytesIO
+import string
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO, StringIO
+from urllib.parse import quote
 
 import matplotlib
 import matplotlib.pyplot as plt
-from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers import get_lexer_by_name
 from pygments.util import ClassNotFound
-from seadoc_converter.converter.utils import trans_img_path_to_url, \
-        trans_video_path_to_url, trans_wiki_page_id_to_url
+from seadoc_converter.config import HTML_FRAGMENT_CACHE_SIZE, HTML_RENDER_PROCESSES, \
+        CODE_HIGHLIGHT_MAX_LINES, CODE_HIGHLIGHT_MAX_BYTES, CODE_HIGHLIGHT_TIME_BUDGET, \
+        HTML_EXPORT_TIMEOUT, HTML_NODE_TIME_BUDGET, HTML_RENDER_PROFILE
+from seadoc_converter.converter.utils import is_url_link, get_img_url_prefix, \
+        get_video_url_prefix, get_wiki_page_url_prefix, download_images, image_data_uri, \
+        bundle_images, bundled_image_srcs, iter_nodes, collect_image_srcs, iter_sdoc_elements, iter_preview
+
+logger = logging.getLogger(__name__)
 
 matplotlib.use('Agg')
+# keep svg ids stable, so that every process renders the same formula alike
+matplotlib.rcParams['svg.hashsalt'] = 'seadoc-converter'
 
 
 HEADER_CLASS_DICT = {
@@ -55,18 +73,195 @@ PYGMENTS_LANGUAGE_MAP = {
 }
 
 
+INDENT = ' ' * 4
+
+# every character str.splitlines() breaks on
+LINE_BREAKS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+LINE_BREAK_RE = re.compile('[%s]' % LINE_BREAKS)
+
+# deeper levels are compiled on the fly instead of being kept around
+TEMPLATE_CACHED_LEVELS = 32
+
+
 # util function
 def escape_html(value):
     return html_module.escape(str(value), quote=True)
 
 
-def indent_html(value, indent=' ' * 4):
+def indent_html(value, indent=INDENT):
     return ''.join(
         f'{indent}{line}' if line.strip() else line
         for line in value.splitlines(True)
     )
 
 
+def join_html(parts, level=0):
+    """
+    Join html parts that were each rendered at ``level``.
+
+    The result is ``indent_html(''.join(plain_parts), INDENT * level)``,
+    i.e. what indenting the joined level 0 parts would have given.  The
+    two only differ when a part continues the last line of the previous
+    one, which is fixed up here.
+    """
+    if not level:
+        return ''.join(parts)
+
+    indent = INDENT * level
+    joined = []
+    ends_line = True
+    for part in parts:
+        if not part:
+            continue
+
+        if not ends_line and part[0] not in LINE_BREAKS:
+            first_line = LINE_BREAK_RE.split(part, 1)[0]
+            if first_line.strip():
+                # the first line of the part was indented as if it
+                # started a line, but it continues the previous one
+                part = part[len(indent):]
+                # the line being continued starts after the last break
+                index = len(joined) - 1
+                while index >= 0:
+                    line_start = max(joined[index].rfind(char) for char in LINE_BREAKS) + 1
+                    if line_start:
+                        break
+                    index -= 1
+                index = max(index, 0)
+                if not ''.join(joined[index:])[line_start:].strip():
+                    previous = joined[index]
+                    joined[index] = previous[:line_start] + indent + previous[line_start:]
+
+        joined.append(part)
+        ends_line = part[-1] in LINE_BREAKS
+
+    return ''.join(joined)
+
+
+class HtmlTemplate(object):
+    """
+    Html snippet with ``{field}`` slots that is split into static and
+    dynamic parts once, when the module is loaded.
+
+    ``render(level, **fields)`` gives the same text as
+    ``indent_html(text.format(**fields), INDENT * level)``.  Static lines
+    are indented once per level and cached, so rendered nodes are never
+    split into lines and indented again by their ancestors.
+
+    A field alone on its line whose name ends in ``_html`` takes markup
+    that is already rendered at ``level``, such as children rendered at
+    ``level + 1`` and joined with ``join_html``.  Any other field takes
+    plain text, which is indented here when it spans several lines.
+    """
+
+    STATIC, INLINE, TEXT_LINE, MARKUP_LINE = range(4)
+
+    def __init__(self, text):
+        self.lines = []
+        self.exact_only = False
+        self.programs = {}
+
+        formatter = string.Formatter()
+        for line in text.splitlines(True):
+            parts = list(formatter.parse(line))
+            fields = [name for _, name, _, _ in parts if name is not None]
+            literals = [literal for literal, _, _, _ in parts]
+
+            if not fields:
+                self.lines.append((self.STATIC, (line, not line.strip())))
+            elif len(fields) == 1 and not literals[0].strip(' ') and ''.join(literals[1:]) in ('\n', ''):
+                kind = self.MARKUP_LINE if fields[0].endswith('_html') else self.TEXT_LINE
+                self.lines.append((kind, (literals[0], fields[0], ''.join(literals[1:]))))
+            else:
+                if any(name.endswith('_html') for name in fields):
+                    raise ValueError('markup field must be alone on its line: %r' % line)
+                if not ''.join(literals).strip():
+                    # whether such a line is indented depends on its values
+                    self.exact_only = True
+                self.lines.append((self.INLINE, parts))
+
+    def compile(self, level):
+        """
+        Return the static pieces of the template indented for ``level``,
+        with ``None`` where fields go, and the ``(index, kind, name)`` of
+        every field.
+        """
+        indent = INDENT * level
+        pieces = []
+        slots = []
+        static = []
+
+        def add_slot(kind, name):
+            pieces.append(''.join(static))
+            static[:] = []
+            slots.append((len(pieces), kind, name))
+            pieces.append(None)
+
+        for kind, payload in self.lines:
+            if kind == self.STATIC:
+                line, blank = payload
+                static.append(line if blank else indent + line)
+            elif kind == self.INLINE:
+                static.append(indent)
+                for literal, name, _, _ in payload:
+                    static.append(literal)
+                    if name is not None:
+                        add_slot(self.INLINE, name)
+            else:
+                leading, name, trailing = payload
+                static.append(leading)
+                add_slot(kind, name)
+                static.append(trailing)
+
+        pieces.append(''.join(static))
+        program = (pieces, slots)
+        if level <= TEMPLATE_CACHED_LEVELS:
+            self.programs[level] = program
+        return program
+
+    def render(self, level=0, **fields):
+        if level and self.exact_only:
+            return self.render_lines(level, fields)
+
+        pieces, slots = self.programs.get(level) or self.compile(level)
+        parts = pieces[:]
+        for index, kind, name in slots:
+            value = fields[name]
+            if value.__class__ is not str:
+                value = format(value)
+            if level and kind != self.MARKUP_LINE:
+                if LINE_BREAK_RE.search(value):
+                    return self.render_lines(level, fields)
+                if kind == self.TEXT_LINE and value.strip():
+                    value = INDENT * level + value
+            parts[index] = value
+
+        return ''.join(parts)
+
+    def render_lines(self, level, fields):
+        # line by line, for values that span several lines
+        indent = INDENT * level
+        rendered = []
+        for kind, payload in self.lines:
+            if kind == self.STATIC:
+                line, blank = payload
+                rendered.append(line if blank else indent + line)
+            elif kind == self.INLINE:
+                line = ''.join(
+                    literal if name is None else literal + format(fields[name])
+                    for literal, name, _, _ in payload
+                )
+                rendered.append(indent_html(line, indent))
+            elif kind == self.TEXT_LINE:
+                leading, name, trailing = payload
+                rendered.append(leading + indent_html(format(fields[name]), indent) + trailing)
+            else:
+                leading, name, trailing = payload
+                rendered.append(leading + fields[name] + trailing)
+
+        return ''.join(rendered)
+
+
 def normalize_formula(formula):
     return ' '.join(str(formula).replace('\u200b', ' ').split())
 
@@ -88,11 +283,38 @@ def preserve_code_line_indentation(code_line, highlighted_line):
     return prefix.replace(' ', '&nbsp;').replace('\t', '&nbsp;' * 4) + highlighted_line.lstrip()
 
 
-def highlight_code_block_lines(sdoc_json):
+# tokens highlighted between checks of the time budget
+CODE_HIGHLIGHT_CHECK_TOKENS = 1000
+
+
+def count_highlighted_lines(code_lines):
+    """
+    How many of ``code_lines`` fit in the highlighting limits.
+    """
+    size = 0
+    for index, code_line in enumerate(code_lines[:CODE_HIGHLIGHT_MAX_LINES]):
+        size += len(code_line.encode('utf-8')) + 1
+        if size > CODE_HIGHLIGHT_MAX_BYTES:
+            return index
+    return min(len(code_lines), CODE_HIGHLIGHT_MAX_LINES)
+
+
+def highlight_code_block_lines(sdoc_json, time_budget=None):
+    """
+    Return the highlighted html of the code lines of a code block, None
+    when its language is not highlighted, and whether highlighting was
+    done within ``time_budget``.
+
+    The lines within the highlighting limits are highlighted as one
+    piece, so that strings and comments spanning lines are lexed right,
+    until ``time_budget`` seconds, by default CODE_HIGHLIGHT_TIME_BUDGET,
+    run out.  The list returned is shorter than the code lines when the
+    rest is to be rendered plain.
+    """
     language = sdoc_json.get('language', '')
     lexer_name = PYGMENTS_LANGUAGE_MAP.get(language)
     if not lexer_name:
-        return None
+        return None, True
 
     code_lines = [
         get_code_line_text(child)
@@ -101,7 +323,7 @@ def highlight_code_block_lines(sdoc_json):
     ]
 
     if not code_lines:
-        return []
+        return [], True
 
     leading_blank_lines = 0
     for code_line in code_lines:
@@ -117,24 +339,50 @@ def highlight_code_block_lines(sdoc_json):
 
     trimmed_code_lines = code_lines[leading_blank_lines:len(code_lines) - trailing_blank_lines or None]
     if not trimmed_code_lines:
-        return code_lines
+        return code_lines, True
 
     try:
-        lexer = get_lexer_by_name(lexer_name)
-        formatter = HtmlFormatter(nowrap=True, classprefix='pg-')
-        highlighted_html = highlight('\n'.join(trimmed_code_lines), lexer, formatter)
+        # the lines within the limits may end with blank lines, which
+        # must stay lines
+        lexer = get_lexer_by_name(lexer_name, stripnl=False)
     except ClassNotFound:
-        return None
-
-    highlighted_lines = highlighted_html.split('\n')
-    highlighted_lines = ([''] * leading_blank_lines) + highlighted_lines + ([''] * trailing_blank_lines)
-    if len(highlighted_lines) < len(code_lines):
-        highlighted_lines.extend([''] * (len(code_lines) - len(highlighted_lines)))
+        return None, True
+    formatter = HtmlFormatter(nowrap=True, classprefix='pg-')
+
+    highlighted_count = count_highlighted_lines(trimmed_code_lines)
+    if time_budget is None:
+        time_budget = CODE_HIGHLIGHT_TIME_BUDGET
+    deadline = time.monotonic() + time_budget
+    tokens = []
+    line_count = highlighted_count
+    complete = True
+    for index, token in enumerate(lexer.get_tokens('\n'.join(trimmed_code_lines[:highlighted_count]))):
+        if not index % CODE_HIGHLIGHT_CHECK_TOKENS and time.monotonic() > deadline:
+            # only the lines whose tokens are all in are highlighted
+            line_count = sum(value.count('\n') for _, value in tokens)
+            complete = False
+            break
+        tokens.append(token)
+
+    buffer = StringIO()
+    formatter.format(tokens, buffer)
+    highlighted_lines = [''] * leading_blank_lines
+    if line_count:
+        lines = buffer.getvalue().split('\n')[:line_count]
+        lines.extend([''] * (line_count - len(lines)))
+        highlighted_lines.extend(lines)
+
+    if len(highlighted_lines) < leading_blank_lines + len(trimmed_code_lines):
+        logger.info('code block %s highlighted %d of its %d lines, the rest is plain',
+                    sdoc_json.get('id', ''), len(highlighted_lines), len(code_lines))
+    else:
+        highlighted_lines.extend([''] * trailing_blank_lines)
 
-    return [
-        preserve_code_line_indentation(code_line, highlighted_lines[index])
-        for index, code_line in enumerate(code_lines)
+    highlighted_lines = [
+        preserve_code_line_indentation(code_line, highlighted_line)
+        for code_line, highlighted_line in zip(code_lines, highlighted_lines)
     ]
+    return highlighted_lines, complete
 
 
 def formula_to_svg(formula):
@@ -164,6 +412,7 @@ def formula_to_svg(formula):
             bbox_inches='tight',
             pad_inches=0.1,
             transparent=True,
+            metadata={'Date': None},
         )
     finally:
         plt.close(fig)
@@ -173,8 +422,439 @@ def formula_to_svg(formula):
     return svg[svg.find('<svg'):].strip()
 
 
+# render engine
+class RenderOptions(object):
+    """
+    Settings shared by every node of a document, with the urls that
+    depend on them worked out once per document.
+
+    ``image_urls`` maps image srcs to the url they are rendered with
+    instead of their Seahub download url, and ``formula_urls`` maps
+    normalized formulas to the url of their svg, which is then referred
+    to instead of being inlined.
+
+    ``deadline`` is the ``time.monotonic()`` after which the elements
+    not rendered yet are shown as their source text, and
+    ``node_time_budget`` the seconds one formula or code block may take.
+    The ids of the nodes cut short by it, such as code blocks only
+    partly highlighted, are collected in ``incomplete_ids``.
+    """
+    __slots__ = ('doc_uuid', 'publish_url', 'image_urls', 'formula_urls', 'deadline', 'node_time_budget',
+                 'incomplete_ids', 'image_url_prefix', 'video_url_prefix', 'wiki_page_url_prefix')
+
+    def __init__(self, doc_uuid='', publish_url='', image_urls=None, formula_urls=None, deadline=None,
+                 node_time_budget=0):
+        self.doc_uuid = doc_uuid
+        self.publish_url = publish_url
+        self.image_urls = image_urls or {}
+        self.formula_urls = formula_urls or {}
+        self.deadline = deadline
+        self.node_time_budget = node_time_budget
+        self.incomplete_ids = set()
+        self.image_url_prefix = get_img_url_prefix(doc_uuid)
+        self.video_url_prefix = get_video_url_prefix(doc_uuid)
+        self.wiki_page_url_prefix = get_wiki_page_url_prefix(publish_url)
+
+    def image_url(self, image_path):
+        if image_path in self.image_urls:
+            return self.image_urls[image_path]
+        if is_url_link(image_path):
+            return image_path
+        return self.image_url_prefix + image_path.strip('/')
+
+    def video_url(self, video_path):
+        if is_url_link(video_path):
+            return video_path
+        return self.video_url_prefix + video_path.strip('/')
+
+    def wiki_page_url(self, wiki_page_id):
+        return self.wiki_page_url_prefix + wiki_page_id
+
+    def time_budget(self, default=None):
+        """
+        Seconds the next formula or code block may take, at most
+        ``default``, or None for no limit.
+        """
+        budgets = [budget for budget in (default, self.node_time_budget) if budget]
+        if self.deadline is not None:
+            budgets.append(max(self.deadline - time.monotonic(), 0))
+        return min(budgets) if budgets else None
+
+    def formula_time_budget(self):
+        """
+        Seconds the next formula may take in a worker process, or None
+        to render it in this process when there is no node time budget.
+        """
+        if not self.node_time_budget:
+            return None
+        return self.time_budget()
+
+
+class RenderContext(object):
+    """
+    Where a node is rendered: the document options, the id of the node
+    its parent reports, its indentation level and, for table cells, its
+    row and column.  All the children of a node share one context.
+    """
+    __slots__ = ('options', 'parent_id', 'level', 'row_index', 'col_index')
+
+    def __init__(self, options, parent_id='', level=0, row_index=1, col_index=1):
+        self.options = options
+        self.parent_id = parent_id
+        self.level = level
+        self.row_index = row_index
+        self.col_index = col_index
+
+    def nested(self, parent_id, depth=1, row_index=1, col_index=1):
+        return RenderContext(self.options, parent_id, self.level + depth, row_index, col_index)
+
+
+class RenderFrame(object):
+    # node_type, start and child_time are only set when profiling
+    __slots__ = ('visitor', 'tasks', 'rendered', 'node_type', 'start', 'child_time')
+
+    def __init__(self, visitor):
+        self.visitor = visitor
+        self.tasks = None
+        self.rendered = None
+
+
+class RenderProfile(object):
+    """
+    Calls, cumulative time, self time and output bytes of the rendered
+    nodes, by node type.  The output of a node includes that of its
+    children, its self time does not include their time.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, node_type, cumulative, self_time, size):
+        stats = self.stats.get(node_type)
+        if stats is None:
+            stats = self.stats[node_type] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += cumulative
+        stats[2] += self_time
+        stats[3] += size
+
+    def as_dict(self):
+        return {
+            node_type: {'calls': calls, 'cumulative': cumulative, 'self': self_time, 'bytes': size}
+            for node_type, (calls, cumulative, self_time, size) in self.stats.items()
+        }
+
+    def log(self, doc_uuid=''):
+        logger.info('html render profile of document %s:', doc_uuid)
+        for node_type, (calls, cumulative, self_time, size) in sorted(
+                self.stats.items(), key=lambda item: item[1][2], reverse=True):
+            logger.info('%-20s calls %8d  cumulative %9.4fs  self %9.4fs  bytes %10d',
+                        node_type, calls, cumulative, self_time, size)
+
+
+def render_iteratively(visitor, profile=None):
+    """
+    Run a visitor generator to completion using an explicit stack, so
+    that document depth is not limited by the Python recursion limit.
+
+    A visitor yields a list of ``(node, context)`` tasks and is sent back
+    the html of those nodes, rendered at the level of their context, in
+    the same order.  Its return value is the html of the
+    node it renders.  The nodes rendered are recorded in ``profile``
+    when one is given.
+    """
+    if profile is not None:
+        return render_iteratively_profiled(visitor, profile)
+
+    stack = [RenderFrame(visitor)]
+    while True:
+        frame = stack[-1]
+        if frame.tasks is None:
+            try:
+                tasks = frame.visitor.send(frame.rendered)
+            except StopIteration as e:
+                stack.pop()
+                if not stack:
+                    return e.value
+                stack[-1].rendered.append(e.value)
+                continue
+            frame.tasks = iter(tasks)
+            frame.rendered = []
+
+        rendered = frame.rendered
+        for node, context in frame.tasks:
+            html = visit_node(node, context)
+            if isinstance(html, str):
+                rendered.append(html)
+            else:
+                stack.append(RenderFrame(html))
+                break
+        else:
+            frame.tasks = None
+
+
+def render_iteratively_profiled(visitor, profile):
+    # render_iteratively, timing every node
+    clock = time.perf_counter
+    root = RenderFrame(visitor)
+    root.node_type = None
+    root.start = clock()
+    root.child_time = 0.0
+    stack = [root]
+    while True:
+        frame = stack[-1]
+        if frame.tasks is None:
+            try:
+                tasks = frame.visitor.send(frame.rendered)
+            except StopIteration as e:
+                stack.pop()
+                html = e.value
+                elapsed = clock() - frame.start
+                if frame.node_type is not None:
+                    profile.add(frame.node_type, elapsed, elapsed - frame.child_time, len(html.encode('utf-8')))
+                if not stack:
+                    return html
+                stack[-1].rendered.append(html)
+                stack[-1].child_time += elapsed
+                continue
+            frame.tasks = iter(tasks)
+            frame.rendered = []
+
+        rendered = frame.rendered
+        for node, context in frame.tasks:
+            start = clock()
+            html = visit_node(node, context)
+            node_type = 'text' if 'text' in node else node.get('type', '')
+            if isinstance(html, str):
+                elapsed = clock() - start
+                profile.add(node_type, elapsed, elapsed, len(html.encode('utf-8')))
+                frame.child_time += elapsed
+                rendered.append(html)
+            else:
+                child = RenderFrame(html)
+                child.node_type = node_type
+                child.start = start
+                child.child_time = 0.0
+                stack.append(child)
+                break
+        else:
+            frame.tasks = None
+
+
+def child_tasks(sdoc_json, context):
+    return [(child, context) for child in sdoc_json.get('children', [])]
+
+
+def render_visited(html, profile=None):
+    return html if isinstance(html, str) else render_iteratively(html, profile)
+
+
+def node_renderer(visit):
+    """
+    Wrap ``visit(sdoc_json, context)`` as a regular ``render_*`` function
+    that takes the render options as keyword arguments.
+
+    ``visit`` returns the html of the node, or a visitor generator when
+    the html depends on its children.  It is kept as ``.visit`` so that
+    ``visit_node`` can schedule it on the explicit stack instead of
+    recursing into it.
+    """
+    @functools.wraps(visit)
+    def render(sdoc_json, doc_uuid='', parent_id='', publish_url='', level=0):
+        context = RenderContext(RenderOptions(doc_uuid, publish_url), parent_id, level)
+        return render_visited(visit(sdoc_json, context))
+
+    render.visit = visit
+    return render
+
+
 # render function
-def render_blockquote(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+# nodes rendered as their source text once the export deadline has passed,
+# the top level elements aside
+DEADLINE_NODE_TYPES = frozenset(('formula', 'code_block'))
+INLINE_NODE_TYPES = frozenset(('link', 'file_link', 'wiki_link', 'image'))
+RENDER_FALLBACK_CLASS = 'sdoc-render-fallback'
+
+# count of nodes rendered as their source text, by node type and reason
+RENDER_FALLBACKS = Counter()
+RENDER_FALLBACKS_LOCK = threading.Lock()
+
+# formulas that went over the time budget, not to be tried again
+SLOW_FORMULAS = OrderedDict()
+SLOW_FORMULAS_SIZE = 1024
+SLOW_FORMULAS_LOCK = threading.Lock()
+
+
+def remember_slow_formula(formula):
+    with SLOW_FORMULAS_LOCK:
+        SLOW_FORMULAS[formula] = None
+        SLOW_FORMULAS.move_to_end(formula)
+        while len(SLOW_FORMULAS) > SLOW_FORMULAS_SIZE:
+            SLOW_FORMULAS.popitem(last=False)
+
+
+# idle formula workers kept for the next formulas
+FORMULA_WORKERS = []
+FORMULA_WORKERS_SIZE = 2
+FORMULA_WORKERS_LOCK = threading.Lock()
+
+
+def run_formula_worker(connection):
+    connection.send(None)
+    while True:
+        try:
+            formula = connection.recv()
+        except EOFError:
+            return
+        try:
+            connection.send((formula_to_svg(formula), None))
+        except ValueError as e:
+            connection.send((None, ValueError(str(e))))
+        except Exception as e:
+            connection.send((None, RuntimeError(f'{type(e).__name__}: {e}')))
+
+
+class FormulaWorker(object):
+    """
+    A process that renders formulas, so that one taking too long can be
+    stopped by killing the process.
+    """
+
+    def __init__(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, worker_connection = context.Pipe()
+        self.process = context.Process(target=run_formula_worker, args=(worker_connection,), daemon=True)
+        self.process.start()
+        worker_connection.close()
+        # starting the worker is not charged to the first formula
+        try:
+            self.receive(None)
+        except (EOFError, OSError):
+            self.close()
+            raise
+
+    def receive(self, timeout):
+        if not self.connection.poll(timeout):
+            raise TimeoutError
+        return self.connection.recv()
+
+    def render(self, formula, timeout):
+        self.connection.send(formula)
+        svg, error = self.receive(timeout)
+        if error is not None:
+            raise error
+        return svg
+
+    def close(self):
+        self.connection.close()
+        self.process.kill()
+        self.process.join()
+
+
+def formula_to_svg_in_worker(formula, timeout):
+    """
+    The svg of a normalized formula rendered in a worker process, which
+    is killed when it takes longer than ``timeout`` seconds, raising
+    TimeoutError.
+    """
+    with FORMULA_WORKERS_LOCK:
+        worker = FORMULA_WORKERS.pop() if FORMULA_WORKERS else None
+
+    try:
+        if worker is None:
+            worker = FormulaWorker()
+        return worker.render(formula, timeout)
+    except (TimeoutError, EOFError, OSError):
+        # the worker is stuck or gone
+        if worker is not None:
+            worker.close()
+            worker = None
+        raise
+    finally:
+        if worker is not None:
+            with FORMULA_WORKERS_LOCK:
+                if len(FORMULA_WORKERS) < FORMULA_WORKERS_SIZE:
+                    FORMULA_WORKERS.append(worker)
+                    worker = None
+            if worker is not None:
+                worker.close()
+
+
+def formula_to_svg_within(formula, time_budget):
+    """
+    The svg of a normalized formula, or None when rendering it takes
+    longer than ``time_budget`` seconds, now or before.  Formulas with a
+    time budget are rendered in a worker process, which is stopped when
+    the budget runs out.  Raise ValueError when the formula can not be
+    rendered, there or in the worker.
+    """
+    if formula in SLOW_FORMULAS:
+        return None
+    if time_budget is None:
+        return formula_to_svg(formula)
+    if time_budget <= 0:
+        return None
+
+    try:
+        return formula_to_svg_in_worker(formula, time_budget)
+    except TimeoutError:
+        remember_slow_formula(formula)
+        return None
+    except (EOFError, OSError, RuntimeError) as e:
+        logger.error('can not render formula in a worker process: %s', e)
+        raise ValueError(str(e))
+
+
+def get_source_lines(sdoc_json):
+    """
+    The text of a node, a line per formula, code line or other block.
+    """
+    lines = []
+    for node in iter_nodes([sdoc_json]):
+        node_type = node.get('type')
+        if node_type == 'formula':
+            lines.append(normalize_formula(node.get('data', {}).get('formula', '')))
+        elif 'text' not in node and node_type not in INLINE_NODE_TYPES and \
+                any('text' in child for child in node.get('children', []) if isinstance(child, dict)):
+            lines.append(''.join(str(leaf['text']) for leaf in iter_nodes(node['children']) if 'text' in leaf))
+    return lines
+
+
+FALLBACK_TEMPLATE = HtmlTemplate("""
+    <div data-id="{ele_id}" class="{fallback_class}">{text}</div>
+    """)
+
+
+def render_fallback(sdoc_json, context, reason):
+    """
+    Render a node as its escaped source text, for when rendering it
+    properly would take too long.
+    """
+    node_type = sdoc_json.get('type', '')
+    logger.warning('rendered %s %s of document %s as text: %s',
+                   node_type, sdoc_json.get('id', ''), context.options.doc_uuid, reason)
+    with RENDER_FALLBACKS_LOCK:
+        RENDER_FALLBACKS[(node_type, reason)] += 1
+
+    ele_id = escape_html(sdoc_json.get('id', ''))
+    text = '<br>'.join(escape_html(line) for line in get_source_lines(sdoc_json))
+    return FALLBACK_TEMPLATE.render(context.level, ele_id=ele_id, fallback_class=RENDER_FALLBACK_CLASS, text=text)
+
+
+BLOCKQUOTE_TEMPLATE = HtmlTemplate("""
+    <blockquote
+        data-id="{ele_id}"
+        data-slate-node="element"
+        class="sdoc-drag-cover"
+        data-root="true"
+    >
+        {children_html}
+    </blockquote>
+    """)
+
+
+@node_renderer
+def render_blockquote(sdoc_json, context):
     """
     sdoc:
     {
@@ -195,26 +875,45 @@ def render_blockquote(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <blockquote
-        data-id="{ele_id}"
-        data-slate-node="element"
-        class="sdoc-drag-cover"
-        data-root="true"
-    >
-        {children_html}
-    </blockquote>
-    """
+    html = BLOCKQUOTE_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
 
     return html
 
 
-def render_table_cell(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+COMBINED_CELL_TEMPLATE = HtmlTemplate("""
+        <span data-slate-node="text">
+            <span
+                data-id="{text_id}"
+                data-slate-leaf="true"
+                class="id"
+                style="padding-left: 0.1px;"
+            >
+                <span data-slate-zero-width="n" data-slate-length="0">
+                    <br>
+                </span>
+            </span>
+        </span>
+        """)
+
+TABLE_CELL_TEMPLATE = HtmlTemplate("""
+    <div
+        data-slate-node="element"
+        class="table-cell"
+        data-id="{ele_id}"
+        style="{inline_style}"
+    >
+        <div class="sdoc-cell-container">
+            {children_html}
+        </div>
+    </div>
+    """)
+
+
+@node_renderer
+def render_table_cell(sdoc_json, context):
     """
     sdoc:
     {
@@ -249,8 +948,8 @@ def render_table_cell(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     """
 
     ele_id = escape_html(sdoc_json['id'])
-    row_index = escape_html(sdoc_json.get('_row_index', 1))
-    col_index = escape_html(sdoc_json.get('_col_index', 1))
+    row_index = context.row_index
+    col_index = context.col_index
     rowspan = escape_html(sdoc_json.get('rowspan', 1))
     colspan = escape_html(sdoc_json.get('colspan', 1))
     style = sdoc_json.get('style', {})
@@ -271,63 +970,44 @@ def render_table_cell(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     if sdoc_json.get('is_combined'):
         style_parts.append('display: none;')
 
-    if row_index == '1' and col_index == '1':
+    if row_index == 1 and col_index == 1:
         style_parts.append('border-top-width: 1px;')
         style_parts.append('border-top-style: solid;')
         style_parts.append('border-left-width: 1px;')
         style_parts.append('border-left-style: solid;')
-    elif row_index == '1':
+    elif row_index == 1:
         style_parts.append('border-top-width: 1px;')
         style_parts.append('border-top-style: solid;')
-    elif col_index == '1':
+    elif col_index == 1:
         style_parts.append('border-left-width: 1px;')
         style_parts.append('border-left-style: solid;')
 
     style_parts.append(
-        f'grid-area: {escape_html(row_index)} / {escape_html(col_index)} / span {rowspan} / span {colspan};'
+        f'grid-area: {row_index} / {col_index} / span {rowspan} / span {colspan};'
     )
 
     inline_style = ' '.join(style_parts)
 
     if sdoc_json.get('is_combined'):
         text_id = escape_html(sdoc_json.get('children', [{}])[0].get('id', ''))
-        children_html = """
-        <span data-slate-node="text">
-            <span
-                data-id="{text_id}"
-                data-slate-leaf="true"
-                class="id"
-                style="padding-left: 0.1px;"
-            >
-                <span data-slate-zero-width="n" data-slate-length="0">
-                    <br>
-                </span>
-            </span>
-        </span>
-        """.format(text_id=text_id)
+        children_html = COMBINED_CELL_TEMPLATE.render(context.level, text_id=text_id)
     else:
-        children_html = indent_html(''.join(
-            render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-            for child in sdoc_json.get('children', [])
-        ))
+        children = yield child_tasks(sdoc_json, context.nested(ele_id))
+        children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <div
-        data-slate-node="element"
-        class="table-cell"
-        data-id="{ele_id}"
-        style="{inline_style}"
-    >
-        <div class="sdoc-cell-container">
-            {children_html}
-        </div>
-    </div>
-    """
+    html = TABLE_CELL_TEMPLATE.render(context.level, ele_id=ele_id, inline_style=inline_style, children_html=children_html)
 
     return html
 
 
-def render_table_row(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+TABLE_ROW_TEMPLATE = HtmlTemplate("""
+    <div hidden="" data-id="{ele_id}"></div>
+    {children_html}
+    """)
+
+
+@node_renderer
+def render_table_row(sdoc_json, context):
     """
     sdoc:
     {
@@ -366,31 +1046,42 @@ def render_table_row(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     """
 
     ele_id = escape_html(sdoc_json['id'])
-    row_index = escape_html(sdoc_json.get('_row_index', 1))
+    row_index = context.row_index
 
-    cell_html = []
+    cell_tasks = []
     for index, child in enumerate(sdoc_json.get('children', []), start=1):
-        if child.get('type') == 'table_cell':
-            cell_html.append(render_table_cell(
-                {**child, '_row_index': row_index, '_col_index': index},
-                doc_uuid=doc_uuid,
-                parent_id=ele_id,
-                publish_url=publish_url,
-            ))
-        else:
-            cell_html.append(render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url))
+        cell_tasks.append((child, context.nested(ele_id, row_index=row_index, col_index=index)))
 
-    children_html = indent_html(''.join(cell_html))
+    cell_html = yield cell_tasks
+    children_html = join_html(cell_html, context.level + 1)
 
-    html = f"""
-    <div hidden="" data-id="{ele_id}"></div>
-    {children_html}
-    """
+    html = TABLE_ROW_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
 
     return html
 
 
-def render_table(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+TABLE_TEMPLATE = HtmlTemplate("""
+    <div
+        data-slate-node="element"
+        class="sdoc-table-wrapper position-relative sdoc-drag-cover scroll"
+        data-root="true"
+        style="{wrapper_style}"
+    >
+        <div class="sdoc-table-scroll-wrapper scroll-at-left">
+            <div
+                class="sdoc-table-container sdoc-drag-cover"
+                data-id="{ele_id}"
+                style="{container_style}"
+            >
+                {children_html}
+            </div>
+        </div>
+    </div>
+    """)
+
+
+@node_renderer
+def render_table(sdoc_json, context):
     """
     sdoc:
     {
@@ -457,42 +1148,34 @@ def render_table(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
         f"grid-auto-rows: {grid_auto_rows};"
     )
 
-    row_html = []
+    row_tasks = []
     for index, child in enumerate(sdoc_json.get('children', []), start=1):
-        if child.get('type') == 'table_row':
-            row_html.append(render_table_row(
-                {**child, '_row_index': index},
-                doc_uuid=doc_uuid,
-                parent_id=ele_id,
-            ))
-        else:
-            row_html.append(render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url))
+        row_tasks.append((child, context.nested(ele_id, row_index=index)))
+
+    row_html = yield row_tasks
+    children_html = join_html(row_html, context.level + 1)
 
-    children_html = indent_html(''.join(row_html))
+    html = TABLE_TEMPLATE.render(context.level, wrapper_style=wrapper_style, ele_id=ele_id, container_style=container_style, children_html=children_html)
 
-    html = f"""
+    return html
+
+
+COLUMN_TEMPLATE = HtmlTemplate("""
     <div
         data-slate-node="element"
-        class="sdoc-table-wrapper position-relative sdoc-drag-cover scroll"
-        data-root="true"
-        style="{wrapper_style}"
+        class="column"
+        data-id="{ele_id}"
+        style="width: {width}px;"
     >
-        <div class="sdoc-table-scroll-wrapper scroll-at-left">
-            <div
-                class="sdoc-table-container sdoc-drag-cover"
-                data-id="{ele_id}"
-                style="{container_style}"
-            >
-                {children_html}
-            </div>
+        <div class="sdoc-column-container">
+            {children_html}
         </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_column(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_column(sdoc_json, context):
     """
     sdoc:
     {
@@ -517,28 +1200,34 @@ def render_column(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     ele_id = escape_html(sdoc_json['id'])
     width = escape_html(sdoc_json['width'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
+
+    html = COLUMN_TEMPLATE.render(context.level, ele_id=ele_id, width=width, children_html=children_html)
 
-    html = f"""
+    return html
+
+
+MULTI_COLUMN_TEMPLATE = HtmlTemplate("""
     <div
         data-slate-node="element"
-        class="column"
-        data-id="{ele_id}"
-        style="width: {width}px;"
+        data-root="true"
+        class="sdoc-multicolumn-wrapper position-relative"
+        style="max-width: 100%;"
     >
-        <div class="sdoc-column-container">
+        <div
+            class="sdoc-multicolumn-container"
+            data-id="{ele_id}"
+            style="grid-template-columns: {grid_template_columns};"
+        >
             {children_html}
         </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_multi_column(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_multi_column(sdoc_json, context):
     """
     sdoc:
     {
@@ -579,32 +1268,33 @@ def render_multi_column(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     ele_id = escape_html(sdoc_json['id'])
     grid_template_columns = escape_html(sdoc_json['style']['gridTemplateColumns'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
+
+    html = MULTI_COLUMN_TEMPLATE.render(context.level, ele_id=ele_id, grid_template_columns=grid_template_columns, children_html=children_html)
 
-    html = f"""
+    return html
+
+
+FORMULA_TEMPLATE = HtmlTemplate("""
     <div
         data-slate-node="element"
+        data-slate-void="true"
+        class="sdoc-block-formula"
         data-root="true"
-        class="sdoc-multicolumn-wrapper position-relative"
-        style="max-width: 100%;"
+        data-id="{ele_id}"
     >
-        <div
-            class="sdoc-multicolumn-container"
-            data-id="{ele_id}"
-            style="grid-template-columns: {grid_template_columns};"
-        >
-            {children_html}
+        <div>
+            <div class="python-math-jax" contenteditable="false">
+                {formula_html}
+            </div>
         </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_formula(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_formula(sdoc_json, context):
     """
     sdoc:
     {
@@ -635,32 +1325,49 @@ def render_formula(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     formula = sdoc_json.get('data', {}).get('formula', '')
     normalized_formula = normalize_formula(formula)
+    formula_url = context.options.formula_urls.get(normalized_formula)
+    if formula_url is not None:
+        formula_src = escape_html(formula_url)
+        formula_alt = escape_html(normalized_formula)
+        formula_html = indent_html(
+            f'<img class="sdoc-formula-image" src="{formula_src}" alt="{formula_alt}">', INDENT * context.level)
+        html = FORMULA_TEMPLATE.render(context.level, ele_id=ele_id, formula_html=formula_html)
+        return html
+
     try:
-        formula_html = indent_html(formula_to_svg(normalized_formula))
+        svg = formula_to_svg_within(normalized_formula, context.options.formula_time_budget())
+        if svg is None:
+            return render_fallback(sdoc_json, context, 'time budget')
+        formula_html = indent_html(svg, INDENT * (context.level + 1))
     except ValueError:
         fallback_formula = escape_html(normalized_formula)
-        formula_html = f'<span>{fallback_formula}</span>'
+        formula_html = indent_html(f'<span>{fallback_formula}</span>', INDENT * context.level)
+
+    html = FORMULA_TEMPLATE.render(context.level, ele_id=ele_id, formula_html=formula_html)
+
+    return html
+
 
-    html = f"""
+CALLOUT_TEMPLATE = HtmlTemplate("""
     <div
         data-slate-node="element"
-        data-slate-void="true"
-        class="sdoc-block-formula"
+        class="sdoc-callout-white-wrapper"
         data-root="true"
         data-id="{ele_id}"
     >
-        <div>
-            <div class="python-math-jax" contenteditable="false">
-                {formula_html}
+        <div
+            class="sdoc-callout-container"
+            style="{inline_style}">
+            <div class="callout-content">
+                {children_html}
             </div>
         </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_callout(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_callout(sdoc_json, context):
     """
     sdoc:
     {
@@ -692,32 +1399,42 @@ def render_callout(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     background_color = escape_html(sdoc_json['style']['background_color'])
     inline_style = f"background-color: {background_color}; border-color: transparent;"
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
+
+    html = CALLOUT_TEMPLATE.render(context.level, ele_id=ele_id, inline_style=inline_style, children_html=children_html)
+
+    return html
+
+
+CODE_LINE_TEMPLATE = HtmlTemplate("""
+            <div
+                data-id="{code_line_id}"
+                data-slate-node="element"
+                class="sdoc-code-line{language_class}"
+            >
+                {code_line_html}
+            </div>
+            """)
 
-    html = f"""
+CODE_BLOCK_TEMPLATE = HtmlTemplate("""
     <div
+        data-id="{ele_id}"
         data-slate-node="element"
-        class="sdoc-callout-white-wrapper"
+        class="sdoc-code-block-container sdoc-drag-cover"
         data-root="true"
-        data-id="{ele_id}"
     >
-        <div
-            class="sdoc-callout-container"
-            style="{inline_style}">
-            <div class="callout-content">
+        <pre class="sdoc-code-block-pre">
+            <code class="sdoc-code-block-code sdoc-code-no-wrap">
                 {children_html}
-            </div>
-        </div>
+            </code>
+        </pre>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_code_block(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_code_block(sdoc_json, context):
     """
     sdoc:
     {
@@ -746,7 +1463,10 @@ def render_code_block(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
     language = sdoc_json.get('language')
-    highlighted_lines = highlight_code_block_lines(sdoc_json)
+    highlighted_lines, complete = highlight_code_block_lines(
+        sdoc_json, context.options.time_budget(CODE_HIGHLIGHT_TIME_BUDGET))
+    if not complete:
+        context.options.incomplete_ids.add(sdoc_json['id'])
 
     rendered_children = []
     code_line_index = 0
@@ -755,48 +1475,83 @@ def render_code_block(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
             code_line_id = escape_html(child['id'])
             language_class = f' language-{escape_html(language)}' if language else ''
             if highlighted_lines is not None and code_line_index < len(highlighted_lines):
-                code_line_html = indent_html(highlighted_lines[code_line_index])
+                code_line_html = indent_html(highlighted_lines[code_line_index], INDENT * (context.level + 2))
             else:
-                code_line_html = indent_html("".join(
-                    render_node(grandchild, doc_uuid=doc_uuid, parent_id=code_line_id, publish_url=publish_url)
-                    for grandchild in child.get('children', [])
-                ))
+                grandchildren = yield child_tasks(child, context.nested(code_line_id, 2))
+                code_line_html = join_html(grandchildren, context.level + 2)
             if not code_line_html.strip():
-                code_line_html = indent_html('<br>')
+                code_line_html = indent_html('<br>', INDENT * (context.level + 2))
             code_line_index += 1
-            rendered_children.append(f"""
-            <div
-                data-id="{code_line_id}"
-                data-slate-node="element"
-                class="sdoc-code-line{language_class}"
-            >
-                {code_line_html}
-            </div>
-            """)
+            rendered_children.append(CODE_LINE_TEMPLATE.render(context.level + 1, code_line_id=code_line_id, language_class=language_class, code_line_html=code_line_html))
         else:
-            rendered_children.append(render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url))
+            rendered_child = yield [(child, context.nested(ele_id))]
+            rendered_children.extend(rendered_child)
+
+    children_html = join_html(rendered_children, context.level + 1)
+
+    html = CODE_BLOCK_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
+
+    return html
+
+
+VIDEO_ELEMENT_TEMPLATE = HtmlTemplate("""
+    <video
+        class="sdoc-video-element"
+        src="{video_src}"
+        controls=""
+        controlslist="nofullscreen"
+        draggable="false"
+        style="box-shadow: none; pointer-events: auto;">
+    </video>
+    """)
 
-    children_html = indent_html("".join(rendered_children))
+VIDEO_IFRAME_TEMPLATE = HtmlTemplate("""
+    <iframe
+        class="sdoc-video-element"
+        title="{video_src}"
+        allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen=""
+        src="{video_src}"
+        style="height: 100%; border-width: medium; border-style: none; border-color: currentcolor; border-image: initial; box-shadow: none; pointer-events: auto;">
+    </iframe>
+    """)
 
-    html = f"""
+VIDEO_TEMPLATE = HtmlTemplate("""
     <div
-        data-id="{ele_id}"
+        class="sdoc-drag-cover"
         data-slate-node="element"
-        class="sdoc-code-block-container sdoc-drag-cover"
+        data-slate-void="true"
         data-root="true"
+        contenteditable="true"
     >
-        <pre class="sdoc-code-block-pre">
-            <code class="sdoc-code-block-code sdoc-code-no-wrap">
-                {children_html}
-            </code>
-        </pre>
+        <div
+           class="sdoc-video-children-wrapper"
+           contenteditable="false"
+           style="user-select: none; pointer-events: none;"
+        >
+            <div data-slate-spacer="true" style="height: 0px; color: transparent; outline: none; position: absolute;">
+                <span data-slate-node="text">
+                    <span data-slate-leaf="true">
+                        <span data-slate-zero-width="z" data-slate-length="0"></span>
+                    </span>
+               </span>
+           </div>
+       </div>
+       <div
+           data-id="{ele_id}"
+           class="sdoc-video-wrapper"
+           contenteditable="false"
+           style="display: flex;"
+        >
+           <div class="sdoc-video-inner" style="visibility: visible; width: 100%;">
+            {player_html}
+            </div>
+        </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_video(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_video(sdoc_json, context):
     """
     sdoc:
     {
@@ -916,68 +1671,43 @@ def render_video(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     is_embeddable_link = sdoc_json['data']['is_embeddable_link']
     video_src = sdoc_json['data']['src']
     if not is_embeddable_link:
-        video_src = trans_video_path_to_url(video_src, doc_uuid)
+        video_src = context.options.video_url(video_src)
     video_src = escape_html(video_src)
 
-    video_html = f"""
-    <video
-        class="sdoc-video-element"
-        src="{video_src}"
-        controls=""
-        controlslist="nofullscreen"
-        draggable="false"
-        style="box-shadow: none; pointer-events: auto;">
-    </video>
-    """
+    if is_embeddable_link:
+        player_html = VIDEO_IFRAME_TEMPLATE.render(context.level, video_src=video_src)
+    else:
+        player_html = VIDEO_ELEMENT_TEMPLATE.render(context.level, video_src=video_src)
+
+    html = VIDEO_TEMPLATE.render(context.level, ele_id=ele_id, player_html=player_html)
+
+    return html
 
-    iframe_html = f"""
-    <iframe
-        class="sdoc-video-element"
-        title="{video_src}"
-        allow="accelerometer; autoplay; clipboard-write; encrypted-media; gyroscope; picture-in-picture" allowfullscreen=""
-        src="{video_src}"
-        style="height: 100%; border-width: medium; border-style: none; border-color: currentcolor; border-image: initial; box-shadow: none; pointer-events: auto;">
-    </iframe>
-    """
 
-    html = f"""
+CHECK_LIST_TEMPLATE = HtmlTemplate("""
     <div
-        class="sdoc-drag-cover"
+        data-id="{ele_id}"
         data-slate-node="element"
-        data-slate-void="true"
+        class="sdoc-checkbox-container"
         data-root="true"
-        contenteditable="true"
     >
-        <div
-           class="sdoc-video-children-wrapper"
-           contenteditable="false"
-           style="user-select: none; pointer-events: none;"
-        >
-            <div data-slate-spacer="true" style="height: 0px; color: transparent; outline: none; position: absolute;">
-                <span data-slate-node="text">
-                    <span data-slate-leaf="true">
-                        <span data-slate-zero-width="z" data-slate-length="0"></span>
-                    </span>
-               </span>
-           </div>
-       </div>
-       <div
-           data-id="{ele_id}"
-           class="sdoc-video-wrapper"
-           contenteditable="false"
-           style="display: flex;"
-        >
-           <div class="sdoc-video-inner" style="visibility: visible; width: 100%;">
-            {iframe_html if is_embeddable_link else video_html}
-            </div>
+        <div class="sdoc-checkbox-input-wrapper">
+            <input contenteditable="false"
+                class="sdoc-checkbox-input"
+                type="checkbox"
+                {checked_attr}
+                disabled
+            >
+            <p class="sdoc-checkbox-content-container">
+                {children_html}
+            </p>
         </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_check_list(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_check_list(sdoc_json, context):
     """
     sdoc:
     {
@@ -1024,37 +1754,30 @@ def render_check_list(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
     checked = sdoc_json.get('checked', False)
+    checked_attr = 'checked' if checked else ''
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <div
+    html = CHECK_LIST_TEMPLATE.render(context.level, ele_id=ele_id, checked_attr=checked_attr, children_html=children_html)
+
+    return html
+
+
+ORDERED_LIST_TEMPLATE = HtmlTemplate("""
+    <ol
         data-id="{ele_id}"
         data-slate-node="element"
-        class="sdoc-checkbox-container"
         data-root="true"
+        class="list-container d-flex flex-column"
     >
-        <div class="sdoc-checkbox-input-wrapper">
-            <input contenteditable="false"
-                class="sdoc-checkbox-input"
-                type="checkbox"
-                {'checked' if checked else ''}
-                disabled
-            >
-            <p class="sdoc-checkbox-content-container">
-                {children_html}
-            </p>
-        </div>
-    </div>
-    """
-
-    return html
+        {children_html}
+    </ol>
+    """)
 
 
-def render_ordered_list(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_ordered_list(sdoc_json, context):
     """
     sdoc:
     {
@@ -1075,26 +1798,28 @@ def render_ordered_list(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <ol
+    html = ORDERED_LIST_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
+
+    return html
+
+
+UNORDERED_LIST_TEMPLATE = HtmlTemplate("""
+    <ul
         data-id="{ele_id}"
         data-slate-node="element"
         data-root="true"
         class="list-container d-flex flex-column"
     >
         {children_html}
-    </ol>
-    """
-
-    return html
+    </ul>
+    """)
 
 
-def render_unordered_list(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_unordered_list(sdoc_json, context):
     """
     sdoc:
     {
@@ -1115,41 +1840,60 @@ def render_unordered_list(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <ul
-        data-id="{ele_id}"
-        data-slate-node="element"
-        data-root="true"
-        class="list-container d-flex flex-column"
-    >
-        {children_html}
-    </ul>
-    """
+    html = UNORDERED_LIST_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
 
     return html
 
 
-def render_list_item(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
-    """
-    sdoc:
-    {
-        "id": "Blh6tlFITl6CuIK1-A9Unw",
-        "type": "list_item",
-        "children": []
-    },
+LIST_ITEM_TEMPLATE = HtmlTemplate("""
+        <li
+            data-id="{ele_id}"
+            data-slate-node="element"
+            class=""
+        >
+            <span class="sdoc-li-content">
+                {children_html}
+            </span>
+        </li>
+        """)
 
-    html:
-    <li
-        data-id="Blh6tlFITl6CuIK1-A9Unw"
-        data-slate-node="element"
-        class=""
-    >
-        <span class="sdoc-li-control" contenteditable="false">
+NESTED_LIST_ITEM_TEMPLATE = HtmlTemplate("""
+        <li
+            data-id="{ele_id}"
+            data-slate-node="element"
+            class=""
+        >
+            <span class="sdoc-li-control" contenteditable="false">
+                <span class="sdoc-li-prefix sdocfont sdoc-arrow-down"></span>
+                <span class="sdoc-li-divider"></span>
+            </span>
+            <span class="sdoc-li-content">
+                {children_html}
+            </span>
+        </li>
+        """)
+
+
+@node_renderer
+def render_list_item(sdoc_json, context):
+    """
+    sdoc:
+    {
+        "id": "Blh6tlFITl6CuIK1-A9Unw",
+        "type": "list_item",
+        "children": []
+    },
+
+    html:
+    <li
+        data-id="Blh6tlFITl6CuIK1-A9Unw"
+        data-slate-node="element"
+        class=""
+    >
+        <span class="sdoc-li-control" contenteditable="false">
              <span class="sdoc-li-prefix sdocfont sdoc-arrow-down"></span>
              <span class="sdoc-li-divider"></span>
         </span>
@@ -1160,46 +1904,34 @@ def render_list_item(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
     children_len = len(sdoc_json.get('children', []))
 
     if children_len == 1:
-        html = f"""
-        <li
-            data-id="{ele_id}"
-            data-slate-node="element"
-            class=""
-        >
-            <span class="sdoc-li-content">
-                {children_html}
-            </span>
-        </li>
-        """
+        html = LIST_ITEM_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
     else:
-        html = f"""
-        <li
-            data-id="{ele_id}"
-            data-slate-node="element"
-            class=""
-        >
-            <span class="sdoc-li-control" contenteditable="false">
-                <span class="sdoc-li-prefix sdocfont sdoc-arrow-down"></span>
-                <span class="sdoc-li-divider"></span>
-            </span>
-            <span class="sdoc-li-content">
-                {children_html}
-            </span>
-        </li>
-        """
+        html = NESTED_LIST_ITEM_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
 
     return html
 
 
-def render_toggle_header(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+TOGGLE_HEADER_TEMPLATE = HtmlTemplate("""
+    <div
+        data-id="{ele_id}"
+        id="{ele_id}"
+        data-slate-node="element"
+        class="sdoc-toggle-header-container"
+        data-root="true"
+    >
+        {children_html}
+    </div>
+    """)
+
+
+@node_renderer
+def render_toggle_header(sdoc_json, context):
     """
     sdoc:
     {
@@ -1222,27 +1954,35 @@ def render_toggle_header(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <div
-        data-id="{ele_id}"
-        id="{ele_id}"
-        data-slate-node="element"
-        class="sdoc-toggle-header-container"
-        data-root="true"
-    >
-        {children_html}
-    </div>
-    """
+    html = TOGGLE_HEADER_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
 
     return html
 
 
-def render_toggle_header_row(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+TOGGLE_HEADER_ROW_TEMPLATE = HtmlTemplate("""
+    <div class="sdoc-toggle-header-row">
+        <span class="sdoc-toggle-header-prefix" contenteditable="false">
+            <span class="sdocfont sdoc-big-drop-down"></span>
+        </span>
+        <div class="sdoc-toggle-header-title-wrap">
+            <div
+                data-id="{ele_id}"
+                data-slate-node="element"
+                class="sdoc-toggle-header-title {html_class}"
+                style="{inline_style}"
+            >
+                {children_html}
+            </div>
+        </div>
+    </div>
+    """)
+
+
+@node_renderer
+def render_toggle_header_row(sdoc_json, context):
     """
     sdoc:
     {
@@ -1272,33 +2012,29 @@ def render_toggle_header_row(sdoc_json, doc_uuid='', parent_id='', publish_url='
     html_class = HEADER_CLASS_DICT[ele_type]
     inline_style = "font-size: 20pt;"
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <div class="sdoc-toggle-header-row">
-        <span class="sdoc-toggle-header-prefix" contenteditable="false">
-            <span class="sdocfont sdoc-big-drop-down"></span>
-        </span>
-        <div class="sdoc-toggle-header-title-wrap">
-            <div
-                data-id="{ele_id}"
-                data-slate-node="element"
-                class="sdoc-toggle-header-title {html_class}"
-                style="{inline_style}"
-            >
-                {children_html}
-            </div>
-        </div>
-    </div>
-    """
+    html = TOGGLE_HEADER_ROW_TEMPLATE.render(context.level, ele_id=ele_id, html_class=html_class, inline_style=inline_style, children_html=children_html)
 
     return html
 
 
-def render_toggle_content(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+TOGGLE_CONTENT_TEMPLATE = HtmlTemplate("""
+    <div class="sdoc-toggle-header-content-wrap">
+        <div
+            data-id="{ele_id}"
+            data-slate-node="element"
+            class="sdoc-toggle-header-content"
+        >
+            {children_html}
+        </div>
+    </div>
+    """)
+
+
+@node_renderer
+def render_toggle_content(sdoc_json, context):
     """
     sdoc:
     {
@@ -1320,27 +2056,28 @@ def render_toggle_content(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
 
     ele_id = escape_html(sdoc_json['id'])
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
-    <div class="sdoc-toggle-header-content-wrap">
-        <div
-            data-id="{ele_id}"
-            data-slate-node="element"
-            class="sdoc-toggle-header-content"
-        >
-            {children_html}
-        </div>
-    </div>
-    """
+    html = TOGGLE_CONTENT_TEMPLATE.render(context.level, ele_id=ele_id, children_html=children_html)
 
     return html
 
 
-def render_paragraph(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+PARAGRAPH_TEMPLATE = HtmlTemplate("""
+    <div
+        data-id="{ele_id}"
+        data-slate-node="element"
+        data-root="true"
+        style="{inline_style}"
+    >
+        {children_html}
+    </div>
+    """)
+
+
+@node_renderer
+def render_paragraph(sdoc_json, context):
     """
     sdoc:
     {
@@ -1362,26 +2099,38 @@ def render_paragraph(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     ele_id = escape_html(sdoc_json['id'])
     inline_style = "padding-top: 5px; padding-bottom: 5px;"
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
+    html = PARAGRAPH_TEMPLATE.render(context.level, ele_id=ele_id, inline_style=inline_style, children_html=children_html)
+
+    return html
+
+
+HEADER_TEMPLATE = HtmlTemplate("""
     <div
         data-id="{ele_id}"
+        id="{ele_id}"
         data-slate-node="element"
+        class="{html_class}"
         data-root="true"
         style="{inline_style}"
     >
-        {children_html}
+        <div class="sdoc-header-row">
+            <span class="sdoc-header-collapse-prefix" contenteditable="false">
+                <span class="sdocfont sdoc-big-drop-down">
+                </span>
+            </span>
+            <div class="sdoc-header-content">
+                {children_html}
+            </div>
+        </div>
     </div>
-    """
+    """)
 
-    return html
 
-
-def render_header(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_header(sdoc_json, context):
     """
     sdoc:
     {
@@ -1415,36 +2164,32 @@ def render_header(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     html_class = HEADER_CLASS_DICT[ele_type]
     inline_style = "font-size: 20pt;"
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=ele_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(ele_id))
+    children_html = join_html(children, context.level + 1)
 
-    html = f"""
+    html = HEADER_TEMPLATE.render(context.level, ele_id=ele_id, html_class=html_class, inline_style=inline_style, children_html=children_html)
+
+    return html
+
+
+EMBED_LINK_TEMPLATE = HtmlTemplate("""
     <div
-        data-id="{ele_id}"
-        id="{ele_id}"
         data-slate-node="element"
-        class="{html_class}"
+        data-slate-void="true"
+        class="sdoc-drag-cover"
         data-root="true"
-        style="{inline_style}"
+        contenteditable="false"
     >
-        <div class="sdoc-header-row">
-            <span class="sdoc-header-collapse-prefix" contenteditable="false">
-                <span class="sdocfont sdoc-big-drop-down">
-                </span>
-            </span>
-            <div class="sdoc-header-content">
-                {children_html}
-            </div>
+        <div class="sdoc-embed-link-container" scrolling="no">
+            <iframe class="sdoc-embed-link-element {link_type}" title="{link}" src="{link}"></iframe>
+            <div class="iframe-overlay"></div>
         </div>
     </div>
-    """
-
-    return html
+    """)
 
 
-def render_embed_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_embed_link(sdoc_json, context):
     """
     sdoc:
     {
@@ -1473,25 +2218,50 @@ def render_embed_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     link = escape_html(sdoc_json['link'])
     link_type = escape_html(sdoc_json['link_type'])
 
-    html = f"""
-    <div
-        data-slate-node="element"
-        data-slate-void="true"
-        class="sdoc-drag-cover"
-        data-root="true"
-        contenteditable="false"
-    >
-        <div class="sdoc-embed-link-container" scrolling="no">
-            <iframe class="sdoc-embed-link-element {link_type}" title="{link}" src="{link}"></iframe>
-            <div class="iframe-overlay"></div>
-        </div>
-    </div>
-    """
+    html = EMBED_LINK_TEMPLATE.render(context.level, link_type=link_type, link=link)
 
     return html
 
 
-def render_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+LINK_TEMPLATE = HtmlTemplate("""
+        <span
+            class="virtual-link"
+            data-slate-node="element"
+            data-slate-inline="true"
+        >
+            <a href="{href}" title="{title}" target="_blank" rel="noreferrer">
+                {children_html}
+            </a>
+        </span>
+        """)
+
+LINK_BLOCK_TEMPLATE = HtmlTemplate("""
+        <span
+            class="virtual-link"
+            data-slate-node="element"
+            data-slate-inline="true"
+        >
+            <a class="sdoc-link-block" data-link-block-id="{linked_id}" title="{title}" target="_blank" rel="noreferrer">
+                {children_html}
+            </a>
+        </span>
+        """)
+
+LINK_PAGE_TEMPLATE = HtmlTemplate("""
+        <span
+            class="virtual-link"
+            data-slate-node="element"
+            data-slate-inline="true"
+        >
+            <a class="sdoc-link-page" href="{href}" title="{title}" target="_blank" rel="noreferrer">
+                {children_html}
+            </a>
+        </span>
+        """)
+
+
+@node_renderer
+def render_link(sdoc_json, context):
     """
     sdoc:
     {
@@ -1582,53 +2352,43 @@ def render_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     linked_id = escape_html(sdoc_json.get('linked_id', ''))
     linked_wiki_page_id = escape_html(sdoc_json.get('linked_wiki_page_id', ''))
 
-    children_html = indent_html("".join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
-        for child in sdoc_json.get('children', [])
-    ))
+    children = yield child_tasks(sdoc_json, context.nested(context.parent_id))
+    children_html = join_html(children, context.level + 1)
 
     if href:
-        html = f"""
-        <span
-            class="virtual-link"
-            data-slate-node="element"
-            data-slate-inline="true"
-        >
-            <a href="{href}" title="{title}" target="_blank" rel="noreferrer">
-                {children_html}
-            </a>
-        </span>
-        """
+        html = LINK_TEMPLATE.render(context.level, href=href, title=title, children_html=children_html)
     elif linked_id:
-        html = f"""
-        <span
-            class="virtual-link"
-            data-slate-node="element"
-            data-slate-inline="true"
-        >
-            <a class="sdoc-link-block" data-link-block-id="{linked_id}" title="{title}" target="_blank" rel="noreferrer">
-                {children_html}
-            </a>
-        </span>
-        """
+        html = LINK_BLOCK_TEMPLATE.render(context.level, linked_id=linked_id, title=title, children_html=children_html)
     elif linked_wiki_page_id:
-        href = trans_wiki_page_id_to_url(publish_url, linked_wiki_page_id)
-        html = f"""
-        <span
-            class="virtual-link"
-            data-slate-node="element"
-            data-slate-inline="true"
-        >
-            <a class="sdoc-link-page" href="{href}" title="{title}" target="_blank" rel="noreferrer">
-                {children_html}
-            </a>
-        </span>
-        """
+        href = context.options.wiki_page_url(linked_wiki_page_id)
+        html = LINK_PAGE_TEMPLATE.render(context.level, href=href, title=title, children_html=children_html)
 
     return html
 
 
-def render_file_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+FILE_LINK_TEMPLATE = HtmlTemplate("""
+    <span
+        data-slate-node="element"
+        data-slate-inline="true"
+        data-slate-void="true"
+        data-id="{ele_id}"
+        contenteditable="false"
+        class="sdoc-file-link-render"
+    >
+        <span>
+            <span class="sdoc-file-link-icon">
+                <img class="file-link-img" src="{icon_src}" alt="">
+            </span>
+            <span class="sdoc-file-text-link">
+                <a href="{file_src}" title="{title}">{title}</a>
+            </span>
+        </span>
+    </span>
+    """)
+
+
+@node_renderer
+def render_file_link(sdoc_json, context):
     """
     {
         "id": "U1q38n7sRpmp4SyPt7xdoA",
@@ -1667,30 +2427,34 @@ def render_file_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     icon_src = "/media/img/file/256/sdoc.png"
     file_src = f"/api/v2.1/seadoc/file/{doc_uuid}/?doc_uuid={doc_uuid}"
 
-    html = f"""
+    html = FILE_LINK_TEMPLATE.render(context.level, ele_id=ele_id, icon_src=icon_src, file_src=file_src, title=title)
+
+    return html
+
+
+WIKI_LINK_TEMPLATE = HtmlTemplate("""
     <span
         data-slate-node="element"
         data-slate-inline="true"
         data-slate-void="true"
         data-id="{ele_id}"
         contenteditable="false"
-        class="sdoc-file-link-render"
+        class="sdoc-file-render"
     >
         <span>
             <span class="sdoc-file-link-icon">
-                <img class="file-link-img" src="{icon_src}" alt="">
+                <span class="sf3-font sf3-font-file"></span>
             </span>
             <span class="sdoc-file-text-link">
-                <a href="{file_src}" title="{title}">{title}</a>
+                <a class="sdoc-wiki-link" href="{wiki_src}" title="{title}">{title}</a>
             </span>
         </span>
     </span>
-    """
-
-    return html
+    """)
 
 
-def render_wiki_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+@node_renderer
+def render_wiki_link(sdoc_json, context):
     """
     {
         "id": "K4-R9_yuSgmjVL7M42zbLg",
@@ -1708,50 +2472,14 @@ def render_wiki_link(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     ele_id = escape_html(sdoc_json['id'])
     title = escape_html(sdoc_json['title'])
     page_id = sdoc_json['page_id']
-    wiki_src = f"/wiki/publish/{publish_url}/{page_id}/"
+    wiki_src = f"/wiki/publish/{context.options.publish_url}/{page_id}/"
 
-    html = f"""
-    <span
-        data-slate-node="element"
-        data-slate-inline="true"
-        data-slate-void="true"
-        data-id="{ele_id}"
-        contenteditable="false"
-        class="sdoc-file-render"
-    >
-        <span>
-            <span class="sdoc-file-link-icon">
-                <span class="sf3-font sf3-font-file"></span>
-            </span>
-            <span class="sdoc-file-text-link">
-                <a class="sdoc-wiki-link" href="{wiki_src}" title="{title}">{title}</a>
-            </span>
-        </span>
-    </span>
-    """
+    html = WIKI_LINK_TEMPLATE.render(context.level, ele_id=ele_id, wiki_src=wiki_src, title=title)
 
     return html
 
 
-def render_image(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
-    """
-    {
-        "id": "CAcDgxD-RtScHXjFhii-Mw",
-        "type": "image",
-        "children": [],
-        "data": {
-            "src": "/image-aFPg3kqiSbud1nvRsQLunw.webp"
-        }
-    },
-    """
-
-    # 不处理行内元素image中的children
-    ele_id = escape_html(sdoc_json['id'])
-    image_src = sdoc_json['data']['src']
-    image_src = escape_html(trans_img_path_to_url(image_src, doc_uuid))
-    parent_id = escape_html(parent_id)
-
-    html = f"""
+IMAGE_TEMPLATE = HtmlTemplate("""
     <span
         data-id="{ele_id}"
         data-parent-id="{parent_id}"
@@ -1774,12 +2502,47 @@ def render_image(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
             </span>
         </span>
     </span>
+    """)
+
+
+@node_renderer
+def render_image(sdoc_json, context):
     """
+    {
+        "id": "CAcDgxD-RtScHXjFhii-Mw",
+        "type": "image",
+        "children": [],
+        "data": {
+            "src": "/image-aFPg3kqiSbud1nvRsQLunw.webp"
+        }
+    },
+    """
+
+    # 不处理行内元素image中的children
+    ele_id = escape_html(sdoc_json['id'])
+    image_src = sdoc_json['data']['src']
+    image_src = escape_html(context.options.image_url(image_src))
+    parent_id = escape_html(context.parent_id)
+
+    html = IMAGE_TEMPLATE.render(context.level, ele_id=ele_id, parent_id=parent_id, image_src=image_src)
 
     return html
 
 
-def render_text(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
+TEXT_TEMPLATE = HtmlTemplate("""
+    <span data-slate-node="text">
+        <span data-id="{ele_id}"
+            data-slate-leaf="true"
+            class="id"
+        >
+            <span data-slate-string="true">{text}</span>
+        </span>
+    </span>
+    """)
+
+
+@node_renderer
+def render_text(sdoc_json, context):
     """
     sdoc:
     {
@@ -1802,111 +2565,238 @@ def render_text(sdoc_json, doc_uuid='', parent_id='', publish_url=''):
     ele_id = escape_html(sdoc_json['id'])
     text = escape_html(sdoc_json['text'])
 
-    html = f"""
-    <span data-slate-node="text">
-        <span data-id="{ele_id}"
-            data-slate-leaf="true"
-            class="id"
-        >
-            <span data-slate-string="true">{text}</span>
-        </span>
-    </span>
-    """
+    html = TEXT_TEMPLATE.render(context.level, ele_id=ele_id, text=text)
 
     return html
 
 
-# recursive
-def render_node(node, doc_uuid='', parent_id='', publish_url=''):
+def visit_children(sdoc_json, context):
+    # nodes without a renderer of their own are rendered as their
+    # children, at the level of the node
+    children = yield child_tasks(sdoc_json, context.nested(sdoc_json.get('id', ''), 0))
+    return join_html(children, context.level)
+
+
+def is_complete_fragment(element, html, options):
+    """
+    Whether the html of a top level element was rendered in full, and
+    not partly as its source text or plain code for lack of time.
+    """
+    if RENDER_FALLBACK_CLASS in html:
+        return False
+    return not options.incomplete_ids or \
+        all(node.get('id') not in options.incomplete_ids for node in iter_nodes([element]))
+
+
+def visit_fragments(elements, options, fragment_cache=None, processes=1):
+    """
+    Visitor of the html of each of the top level ``elements``, taken
+    from ``fragment_cache`` where it has them.
+    """
+    if fragment_cache is None:
+        keys = [None] * len(elements)
+    else:
+        keys = [fragment_key(element, options) for element in elements]
+    fragments = [None if key is None else fragment_cache.get(key) for key in keys]
+    missing = [index for index, fragment in enumerate(fragments) if fragment is None]
+
+    missing_elements = [elements[index] for index in missing]
+    if processes > 1 and len(missing_elements) >= PARALLEL_RENDER_MIN_ELEMENTS:
+        rendered = render_in_pool(missing_elements, options, processes)
+    else:
+        context = RenderContext(options)
+        rendered = yield [(element, context) for element in missing_elements]
+
+    for index, html in zip(missing, rendered):
+        fragments[index] = html
+        if keys[index] is not None and is_complete_fragment(elements[index], html, options):
+            fragment_cache.set(keys[index], html)
+
+    return fragments
+
+
+def visit_elements(elements, options, fragment_cache=None, processes=1):
+    fragments = yield from visit_fragments(elements, options, fragment_cache, processes)
+    return ''.join(fragments)
+
+
+NODE_RENDERERS = {
+    'table': render_table,
+    'table_row': render_table_row,
+    'table_cell': render_table_cell,
+    'link': render_link,
+    'file_link': render_file_link,
+    'wiki_link': render_wiki_link,
+    'image': render_image,
+    'column': render_column,
+    'multi_column': render_multi_column,
+    'callout': render_callout,
+    'code_block': render_code_block,
+    'video': render_video,
+    'check_list_item': render_check_list,
+    'ordered_list': render_ordered_list,
+    'unordered_list': render_unordered_list,
+    'list_item': render_list_item,
+    'header1': render_header,
+    'header2': render_header,
+    'header3': render_header,
+    'header4': render_header,
+    'header5': render_header,
+    'header6': render_header,
+    'toggle_header': render_toggle_header,
+    'toggle_header1': render_toggle_header_row,
+    'toggle_header2': render_toggle_header_row,
+    'toggle_header3': render_toggle_header_row,
+    'toggle_header4': render_toggle_header_row,
+    'toggle_header5': render_toggle_header_row,
+    'toggle_header6': render_toggle_header_row,
+    'toggle_content': render_toggle_content,
+    'paragraph': render_paragraph,
+    'embed_link': render_embed_link,
+    'formula': render_formula,
+    'blockquote': render_blockquote,
+}
+
 
+def visit_node(node, context):
+    """
+    Return the html of a leaf node, or the visitor generator of a node
+    whose html depends on its children.
+    """
     if 'text' in node:
-        return render_text(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+        return render_text.visit(node, context)
 
     node_type = node.get('type')
+    deadline = context.options.deadline
+    if deadline is not None and (not context.parent_id or node_type in DEADLINE_NODE_TYPES) and \
+            time.monotonic() > deadline:
+        return render_fallback(node, context, 'export deadline')
 
-    if node_type == 'table':
-        return render_table(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    renderer = NODE_RENDERERS.get(node_type)
+    if renderer is None:
+        return visit_children(node, context)
 
-    if node_type == 'table_row':
-        return render_table_row(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    return renderer.visit(node, context)
 
-    if node_type == 'table_cell':
-        return render_table_cell(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type == 'link':
-        return render_link(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+def iter_visited(tasks):
+    rendered = yield tasks
+    return ''.join(rendered)
 
-    if node_type == 'file_link':
-        return render_file_link(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type == 'wiki_link':
-        return render_wiki_link(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+def render_node(node, doc_uuid='', parent_id='', publish_url='', level=0, profile=None):
+    context = RenderContext(RenderOptions(doc_uuid, publish_url), parent_id, level)
+    if profile is not None:
+        # profile the node itself too
+        return render_iteratively_profiled(iter_visited([(node, context)]), profile)
+    return render_visited(visit_node(node, context))
 
-    if node_type == 'image':
-        return render_image(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type == 'column':
-        return render_column(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+class FragmentCache(object):
+    """
+    Html of top level elements from earlier sdoc2html calls, so that only
+    the elements changed since the last export are rendered again.
 
-    if node_type == 'multi_column':
-        return render_multi_column(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    The least recently used fragments are dropped once the total length
+    of the cached html goes over ``max_size``.
+    """
 
-    if node_type == 'callout':
-        return render_callout(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.fragments = OrderedDict()
+        self.lock = threading.Lock()
 
-    if node_type == 'code_block':
-        return render_code_block(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    def get(self, key):
+        with self.lock:
+            html = self.fragments.get(key)
+            if html is not None:
+                self.fragments.move_to_end(key)
+            return html
 
-    if node_type == 'video':
-        return render_video(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    def set(self, key, html):
+        if len(html) > self.max_size:
+            return
 
-    if node_type == 'check_list_item':
-        return render_check_list(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+        with self.lock:
+            previous = self.fragments.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.fragments[key] = html
+            self.size += len(html)
+            while self.size > self.max_size:
+                _, evicted = self.fragments.popitem(last=False)
+                self.size -= len(evicted)
 
-    if node_type == 'ordered_list':
-        return render_ordered_list(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    def clear(self):
+        with self.lock:
+            self.fragments.clear()
+            self.size = 0
 
-    if node_type == 'unordered_list':
-        return render_unordered_list(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+    def __len__(self):
+        return len(self.fragments)
 
-    if node_type == 'list_item':
-        return render_list_item(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type in ['header1', 'header2', 'header3', 'header4', 'header5', 'header6']:
-        return render_header(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+FRAGMENT_KEY_ENCODER = json.JSONEncoder(sort_keys=True, ensure_ascii=False, separators=(',', ':'))
 
-    if node_type == 'toggle_header':
-        return render_toggle_header(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type in ['toggle_header1', 'toggle_header2', 'toggle_header3',
-                     'toggle_header4', 'toggle_header5', 'toggle_header6']:
-        return render_toggle_header_row(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+def fragment_key(element, options):
+    try:
+        content = FRAGMENT_KEY_ENCODER.encode(element)
+    except RecursionError:
+        # too deep for the json encoder, such elements are not cached
+        return None
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+    return element.get('id', ''), digest, options.doc_uuid, options.publish_url
 
-    if node_type == 'toggle_content':
-        return render_toggle_content(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type == 'paragraph':
-        return render_paragraph(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+HTML_FRAGMENT_CACHE = FragmentCache(HTML_FRAGMENT_CACHE_SIZE)
 
-    if node_type == 'embed_link':
-        return render_embed_link(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
 
-    if node_type == 'formula':
-        return render_formula(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+# fewer elements than this are not worth sending to other processes
+PARALLEL_RENDER_MIN_ELEMENTS = 200
+# chunks handed out per worker process, to even out slow elements
+PARALLEL_RENDER_CHUNKS_PER_PROCESS = 4
 
-    if node_type == 'blockquote':
-        return render_blockquote(node, doc_uuid=doc_uuid, parent_id=parent_id, publish_url=publish_url)
+RENDER_POOLS = {}
+RENDER_POOLS_LOCK = threading.Lock()
 
-    # TODO
-    children = node.get('children', [])
-    return ''.join(
-        render_node(child, doc_uuid=doc_uuid, parent_id=node.get('id', ''), publish_url=publish_url)
-        for child in children
-    )
 
+def get_render_pool(processes):
+    with RENDER_POOLS_LOCK:
+        pool = RENDER_POOLS.get(processes)
+        if pool is None:
+            # workers start from a fresh interpreter instead of a copy of the
+            # server process with its greenlets and held locks
+            pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+            RENDER_POOLS[processes] = pool
+        return pool
+
+
+def render_elements(elements, options):
+    context = RenderContext(options)
+    rendered = [render_visited(visit_node(element, context)) for element in elements]
+    return rendered, options.incomplete_ids
+
+
+def render_in_pool(elements, options, processes):
+    """
+    Render top level elements in chunks on a pool of ``processes`` and
+    return their html in order.  The ids of the nodes the workers cut
+    short are added to ``options.incomplete_ids``.
+    """
+    chunk_size = -(-len(elements) // (processes * PARALLEL_RENDER_CHUNKS_PER_PROCESS))
+    chunks = [elements[start:start + chunk_size] for start in range(0, len(elements), chunk_size)]
 
-def sdoc2html(sdoc_str, doc_uuid='', publish_url=''):
+    pool = get_render_pool(processes)
+    rendered = []
+    for chunk_html, incomplete_ids in pool.map(render_elements, chunks, itertools.repeat(options)):
+        rendered.extend(chunk_html)
+        options.incomplete_ids.update(incomplete_ids)
+    return rendered
 
+
+def get_elements(sdoc_str):
     if isinstance(sdoc_str, dict):
         doc = sdoc_str
     else:
@@ -1915,6 +2805,314 @@ def sdoc2html(sdoc_str, doc_uuid='', publish_url=''):
     elements = doc.get('elements', [])
     if not elements:
         elements = doc.get('children', [])
+    return elements
+
+
+def render_fragments(elements, options, use_cache=True, processes=None, profile=None):
+    """
+    The html of each of the top level ``elements``.  With a ``profile``,
+    every element is rendered in this process, cached or not.
+    """
+    if processes is None:
+        processes = HTML_RENDER_PROCESSES
+    if profile is not None:
+        use_cache = False
+        processes = 1
+
+    fragment_cache = HTML_FRAGMENT_CACHE if use_cache and HTML_FRAGMENT_CACHE.max_size > 0 else None
+    return render_iteratively(visit_fragments(
+        elements, options, fragment_cache=fragment_cache, processes=processes), profile)
+
+
+def render_document(elements, options, use_cache=True, processes=None, profile=None):
+    return ''.join(render_fragments(elements, options, use_cache=use_cache, processes=processes, profile=profile))
+
+
+def export_deadline(timeout=None):
+    if timeout is None:
+        timeout = HTML_EXPORT_TIMEOUT
+    return time.monotonic() + timeout if timeout else None
+
+
+def sdoc2html(sdoc_str, doc_uuid='', publish_url='', use_cache=True, processes=None, timeout=None,
+              profile=None):
+    """
+    Render a document to html.  Elements not rendered after ``timeout``
+    seconds, by default HTML_EXPORT_TIMEOUT, are shown as their text.
 
-    html = "".join(render_node(element, doc_uuid=doc_uuid, publish_url=publish_url) for element in elements)
+    The time spent on each node type is recorded in ``profile``, a
+    ``RenderProfile``, when one is given, and logged when
+    HTML_RENDER_PROFILE is set.
+    """
+    log_profile = profile is None and HTML_RENDER_PROFILE
+    if log_profile:
+        profile = RenderProfile()
+
+    deadline = export_deadline(timeout)
+    elements = get_elements(sdoc_str)
+    options = RenderOptions(doc_uuid, publish_url, deadline=deadline, node_time_budget=HTML_NODE_TIME_BUDGET)
+    html = render_document(elements, options, use_cache=use_cache, processes=processes, profile=profile)
+
+    if log_profile:
+        profile.log(doc_uuid)
     return html
+
+
+def sdoc2html_preview(sdoc_str, doc_uuid='', publish_url='', max_blocks=None, max_chars=None, max_bytes=None):
+    """
+    Render the head of a document, up to the first of the budgets of
+    ``iter_preview`` met.  The elements after it are neither decoded
+    nor rendered.
+    """
+    options = RenderOptions(doc_uuid, publish_url, deadline=export_deadline(),
+                            node_time_budget=HTML_NODE_TIME_BUDGET)
+    context = RenderContext(options)
+    fragments = iter_preview(iter_sdoc_elements(sdoc_str), lambda element: render_visited(visit_node(element, context)),
+                             max_blocks=max_blocks, max_chars=max_chars, max_bytes=max_bytes)
+    return ''.join(fragments)
+
+
+# where formula svgs and the code highlighting stylesheet are stored
+BUNDLE_ASSETS_DIR = 'assets'
+
+
+def content_hashed_path(name, extension, content):
+    digest = hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+    return f'{BUNDLE_ASSETS_DIR}/{name}-{digest}{extension}'
+
+
+@functools.lru_cache(maxsize=None)
+def get_highlight_stylesheet():
+    return HtmlFormatter(classprefix='pg-').get_style_defs('.sdoc-code-block-code')
+
+
+def render_formula_assets(elements, options):
+    """
+    Render the svg of every distinct formula of a document once.
+
+    Return ``(formula_urls, assets)``: the path of the svg of each
+    normalized formula, and the svgs by path.  The paths contain a hash
+    of the svg, so that the same formula is one file for every page and
+    can be cached for good.  Formulas that can not be rendered are left
+    out, to fall back to their text.
+    """
+    formula_urls = {}
+    assets = {}
+    for node in iter_nodes(elements):
+        if node.get('type') != 'formula':
+            continue
+        formula = normalize_formula(node.get('data', {}).get('formula', ''))
+        if formula in formula_urls:
+            continue
+        try:
+            svg = formula_to_svg_within(formula, options.formula_time_budget())
+        except ValueError:
+            svg = None
+        if svg is None:
+            formula_urls[formula] = None
+            continue
+        path = content_hashed_path('formula', '.svg', svg)
+        formula_urls[formula] = path
+        assets[path] = svg
+    formula_urls = {formula: path for formula, path in formula_urls.items() if path is not None}
+    return formula_urls, assets
+
+
+def prepare_bundle(elements, options, inline_images=True, external_assets=False):
+    """
+    Download the images of a document and, with ``external_assets``,
+    render its formulas and highlighting stylesheet to files, setting
+    the urls ``options`` renders them with.
+
+    Return the path of the stylesheet, or None, and the assets by path.
+    """
+    image_srcs = collect_image_srcs(elements)
+    if inline_images:
+        images = download_images(bundled_image_srcs(image_srcs), options.doc_uuid)
+        options.image_urls = {
+            image_src: image_data_uri(content, mimetype) for image_src, (content, mimetype) in images.items()
+        }
+        assets = {}
+    else:
+        options.image_urls, assets = bundle_images(image_srcs, options.doc_uuid)
+
+    stylesheet_path = None
+    if external_assets:
+        options.formula_urls, formula_assets = render_formula_assets(elements, options)
+        assets.update(formula_assets)
+        if any(node.get('type') == 'code_block' for node in iter_nodes(elements)):
+            stylesheet = get_highlight_stylesheet()
+            stylesheet_path = content_hashed_path('highlight', '.css', stylesheet)
+            assets[stylesheet_path] = stylesheet
+
+    return stylesheet_path, assets
+
+
+def sdoc2html_bundle(sdoc_str, doc_uuid='', publish_url='', inline_images=True, external_assets=False,
+                     processes=None, timeout=None):
+    """
+    Render a document that can be viewed offline.
+
+    Every image is downloaded once, however often it is used, with the
+    downloads running concurrently.  Return ``(html, assets)``: with
+    ``inline_images`` the images are embedded in the html as data uris,
+    otherwise ``assets`` maps the paths the html refers to, under
+    ``images/``, to the image content.  Images that can not be
+    downloaded keep their Seahub url.
+
+    With ``external_assets`` formulas are rendered as ``<img>`` of svg
+    files and code highlighting is styled by a linked stylesheet, both
+    stored under ``assets/`` with a content hash in their name.
+    """
+    deadline = export_deadline(timeout)
+    elements = get_elements(sdoc_str)
+    options = RenderOptions(doc_uuid, publish_url, deadline=deadline, node_time_budget=HTML_NODE_TIME_BUDGET)
+    stylesheet_path, assets = prepare_bundle(elements, options, inline_images, external_assets)
+
+    stylesheet_html = ''
+    if stylesheet_path:
+        stylesheet_html = f'<link rel="stylesheet" href="{escape_html(stylesheet_path)}">\n'
+
+    # cached fragments refer to the images by their Seahub url
+    html = render_document(elements, options, use_cache=False, processes=processes)
+    return stylesheet_html + html, assets
+
+
+# paginated export
+HEADER_LEVELS = {f'header{level}': level for level in range(1, 7)}
+# pages longer than this are also split at lower level headers
+PAGE_MAX_BLOCKS = 1000
+
+PAGE_TEMPLATE = HtmlTemplate("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="utf-8">
+        <title>{title}</title>
+        {head_html}
+    </head>
+    <body>
+        {top_nav_html}
+        {content_html}
+        {bottom_nav_html}
+    </body>
+    </html>
+    """)
+
+PAGE_NAV_TEMPLATE = HtmlTemplate("""
+    <nav class="sdoc-page-nav">
+        {links_html}
+    </nav>
+    """)
+
+PAGE_LINK_TEMPLATE = HtmlTemplate("""
+    <a class="{link_class}" href="{href}">{title}</a>
+    """)
+
+TOC_TEMPLATE = HtmlTemplate("""
+    <h1 class="sdoc-page-toc-title">{title}</h1>
+    <ol class="sdoc-page-toc">
+        {items_html}
+    </ol>
+    """)
+
+TOC_ITEM_TEMPLATE = HtmlTemplate("""
+    <li><a href="{href}">{title}</a></li>
+    """)
+
+
+def split_pages(elements, page_header_level=1, max_page_blocks=None):
+    """
+    Split the top level elements of a document into pages, each but the
+    first starting at a header of ``page_header_level`` or above.  A
+    page of ``max_page_blocks`` elements or more also ends before the
+    next header of any level.
+
+    Return the ``(start, end)`` of the elements of each page.
+    """
+    if max_page_blocks is None:
+        max_page_blocks = PAGE_MAX_BLOCKS
+
+    starts = [0]
+    for index, element in enumerate(elements):
+        header_level = HEADER_LEVELS.get(element.get('type'))
+        if not header_level or index == starts[-1]:
+            continue
+        if header_level <= page_header_level or index - starts[-1] >= max_page_blocks:
+            starts.append(index)
+    return list(zip(starts, starts[1:] + [len(elements)]))
+
+
+def page_file_names(name, count):
+    width = len(str(count))
+    return [f'{name}-{number:0{width}d}.html' for number in range(1, count + 1)]
+
+
+def render_page_nav(links):
+    links_html = join_html([
+        PAGE_LINK_TEMPLATE.render(2, link_class=link_class, href=escape_html(quote(href)), title=escape_html(title))
+        for link_class, href, title in links
+    ], 2)
+    return PAGE_NAV_TEMPLATE.render(1, links_html=links_html)
+
+
+def sdoc2html_pages(sdoc_str, name, doc_uuid='', publish_url='', page_header_level=1, bundle='',
+                    external_assets=False, processes=None, timeout=None):
+    """
+    Render a document as html pages split at its top level headers, see
+    ``split_pages``, with a table of contents and links to the previous
+    and next page.
+
+    Return ``{file name: content}``: the table of contents as
+    ``<name>.html``, the pages as ``<name>-<number>.html`` and, with
+    ``bundle`` set to ``inline`` or ``zip``, the assets of
+    ``sdoc2html_bundle``.  The elements are rendered at once, on the
+    render processes for large documents, and then split.
+    """
+    deadline = export_deadline(timeout)
+    elements = get_elements(sdoc_str)
+    options = RenderOptions(doc_uuid, publish_url, deadline=deadline, node_time_budget=HTML_NODE_TIME_BUDGET)
+
+    files = {}
+    stylesheet_path = None
+    if bundle:
+        stylesheet_path, files = prepare_bundle(elements, options, bundle == 'inline', external_assets)
+    head_html = ''
+    if stylesheet_path:
+        head_html = indent_html(f'<link rel="stylesheet" href="{escape_html(stylesheet_path)}">', INDENT)
+
+    # cached fragments refer to the images by their Seahub url
+    fragments = render_fragments(elements, options, use_cache=not bundle, processes=processes)
+
+    pages = split_pages(elements, page_header_level)
+    titles = []
+    for number, (start, end) in enumerate(pages, 1):
+        title = ''
+        if start < end and elements[start].get('type') in HEADER_LEVELS:
+            title = ''.join(get_source_lines(elements[start])).strip()
+        titles.append(title or f'{name} ({number})')
+
+    toc_name = f'{name}.html'
+    file_names = page_file_names(name, len(pages))
+    for index, (start, end) in enumerate(pages):
+        links = []
+        if index:
+            links.append(('sdoc-page-prev', file_names[index - 1], titles[index - 1]))
+        links.append(('sdoc-page-toc', toc_name, name))
+        if index + 1 < len(pages):
+            links.append(('sdoc-page-next', file_names[index + 1], titles[index + 1]))
+        nav_html = render_page_nav(links)
+
+        files[file_names[index]] = PAGE_TEMPLATE.render(
+            title=escape_html(titles[index]), head_html=head_html, top_nav_html=nav_html,
+            content_html=''.join(fragments[start:end]), bottom_nav_html=nav_html)
+
+    items_html = join_html([
+        TOC_ITEM_TEMPLATE.render(2, href=escape_html(quote(file_name)), title=escape_html(title))
+        for file_name, title in zip(file_names, titles)
+    ], 2)
+    toc_html = TOC_TEMPLATE.render(1, title=escape_html(name), items_html=items_html)
+    files[toc_name] = PAGE_TEMPLATE.render(
+        title=escape_html(name), head_html=head_html, top_nav_html='', content_html=toc_html, bottom_nav_html='')
+
+    return files
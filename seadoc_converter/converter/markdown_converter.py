@@ -1,7 +1,21 @@
-from html2text import HTML2Text
-from seadoc_converter.converter.utils import trans_img_path_to_url
-
-md_hander = HTML2Text(bodywidth=0) # no wrapping length
+import re
+import uuid
+
+from seadoc_converter.converter.utils import trans_img_path_to_url, iter_sdoc_elements, iter_preview, \
+        bundle_images
+
+# what would turn literal text into markdown: a backslash escaping
+# punctuation, an ordered or unordered list marker at the start of a
+# line, and html tags and entities
+MD_BACKSLASH_RE = re.compile(r'(\\)(?=[\\`*_{}\[\]()#+\-.!])')
+MD_DOT_RE = re.compile(r'^(\s*\d+)(\.)(?=\s)', re.MULTILINE)
+MD_PLUS_RE = re.compile(r'^(\s*)(\+)(?=\s)', re.MULTILINE)
+MD_DASH_RE = re.compile(r'^(\s*)(-)(?=\s|-)', re.MULTILINE)
+MD_HTML_RE = re.compile(r'(<)(?=[A-Za-z/!?])|(&)(?=#?\w+;)')
+MD_URL_RE = re.compile(r'([\\\[\]()])')
+MD_SPACE_RE = re.compile(r'\s+')
+# any text the escapes above could change
+MD_ESCAPE_RE = re.compile(r'[\\<&]|^\s*[\d+-]', re.MULTILINE)
 
 
 HEADER_LABEL = [
@@ -28,42 +42,156 @@ def _handle_text_style(json_data_text, return_null=False):
         text = '.'
     return text, pure_text
 
-# sdoc 2 html dom
-# 1. header
-def _handle_header_dom(header_json, header_type):
-    output = ''
-    for child in header_json['children']:
-        if 'text' in child:
-            output += child.get('text')
-        else:
-            child_type = child.get('type')
-            if child_type == 'link':
-                output += _handle_link_dom(child)
-
-    tag = {
-        "header1": "<h1>%s</h1>",
-        "header2": "<h2>%s</h2>",
-        "header3": "<h3>%s</h3>",
-        "header4": "<h4>%s</h4>",
-        "header5": "<h5>%s</h5>",
-        "header6": "<h6>%s</h6>",
-
-    }.get(header_type)
-    return tag % output
-
-# 2 image
-def _handle_img_dom(img_json, doc_uuid=''):
-
-    output = ''
-    url = img_json.get('data', {}).get('src')
-    if doc_uuid:
-        url = trans_img_path_to_url(url, doc_uuid)
-
-    output += '<img src="%s">' % url
-    return output
 
+def escape_md_text(text):
+    if not MD_ESCAPE_RE.search(text):
+        return text
+    text = MD_BACKSLASH_RE.sub(r'\\\1', text)
+    text = MD_DOT_RE.sub(r'\1\\\2', text)
+    text = MD_PLUS_RE.sub(r'\1\\\2', text)
+    text = MD_DASH_RE.sub(r'\1\\\2', text)
+    return MD_HTML_RE.sub(r'\\\1\2', text)
+
+
+def escape_md_url(url):
+    return MD_URL_RE.sub(r'\\\1', url)
+
+
+# sdoc inline nodes to markdown
+# the inline content of a block is a list of (value, is_text) runs:
+# texts are escaped and have their whitespace collapsed, markup is
+# written as it is
+def _handle_link_runs(link_json, newlines=True):
+    href = link_json.get('href', '')
+    text = link_json['children'][0].get('text', '')
+    if not newlines:
+        href, text = href.replace('\n', ''), text.replace('\n', '')
+    # anchors of the page, which markdown has none of
+    if href.startswith('#'):
+        return [(text, True)]
+    return [('[', False), (text, True), ('](%s)' % escape_md_url(href), False)]
+
+
+class ImageLinks(object):
+    """
+    How the images of a document are linked: by the url of their src in
+    ``image_urls``, such as their path next to the export, or else by
+    their Seahub url.
+    """
+
+    def __init__(self, image_urls=None):
+        self.image_urls = image_urls or {}
+
+    def link(self, image_src, doc_uuid, encode):
+        """
+        The url of an image as written in the markdown, ``encode`` being
+        what the handler writing it does to urls.
+        """
+        if image_src in self.image_urls:
+            return encode(self.image_urls[image_src])
+        if doc_uuid:
+            return encode(trans_img_path_to_url(image_src, doc_uuid))
+        return encode(image_src)
+
+
+class BundleImageLinks(ImageLinks):
+    """
+    Image links of markdown whose images are downloaded once it is
+    written.  Every image is linked by a placeholder, and ``srcs`` are
+    those of the images linked, which ``fill`` then puts the urls of.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.srcs = {}
+        self.links = []
+        # placeholders no text of the document can have
+        self.token = uuid.uuid4().hex
+        self.placeholder_re = re.compile('\x00%s:(\\d+)\x00' % self.token)
+
+    def link(self, image_src, doc_uuid, encode):
+        if image_src:
+            self.srcs[image_src] = None
+        self.links.append((image_src, doc_uuid, encode))
+        return '\x00%s:%d\x00' % (self.token, len(self.links) - 1)
+
+    def fill(self, markdown, image_urls):
+        self.image_urls = image_urls
+        return self.placeholder_re.sub(
+            lambda match: super(BundleImageLinks, self).link(*self.links[int(match.group(1))]), markdown)
+
+
+SEAHUB_IMAGE_LINKS = ImageLinks()
+
+
+def _handle_img_runs(img_json, doc_uuid='', newlines=True, image_links=None):
+    def encode(url):
+        if not newlines:
+            url = url.replace('\n', '')
+        return escape_md_url(url)
+
+    url = (image_links or SEAHUB_IMAGE_LINKS).link(img_json.get('data', {}).get('src'), doc_uuid, encode)
+    return [('![](%s)' % url, False)]
+
+
+def _handle_inline_runs(children, styled=True, doc_uuid=None, newlines=True, image_links=None):
+    '''
+    styled: whether bold and italic are kept
+    doc_uuid: images are kept, with urls of this document, unless None
+    newlines: whether line breaks are kept, as spaces
+    image_links: how images are linked, by their Seahub url by default
+    '''
+    runs = []
+    text = None
+    for child in children:
+        if 'text' in child:
+            text = (text or '') + (_handle_text_style(child)[0] if styled else child.get('text'))
+            continue
 
-# 3 list including ordered / unordered list
+        child_type = child.get('type')
+        if child_type == 'link':
+            child_runs = _handle_link_runs(child, newlines)
+        elif child_type == 'image' and doc_uuid is not None:
+            child_runs = _handle_img_runs(child, doc_uuid, newlines, image_links)
+        else:
+            continue
+        if text is not None:
+            if not newlines:
+                text = text.replace('\n', '')
+            runs.append((text, True))
+            text = None
+        runs.extend(child_runs)
+    if text is not None:
+        if not newlines:
+            text = text.replace('\n', '')
+        runs.append((text, True))
+    return runs
+
+
+def _join_runs(runs):
+    # whitespace at the start of a text is kept as one space, unless it
+    # starts the line or nothing follows it
+    output = []
+    space = False
+    for value, is_text in runs:
+        if is_text:
+            value = escape_md_text(value)
+            # tabs, line breaks and the like are not printable
+            if '  ' in value or not value.isprintable():
+                value = MD_SPACE_RE.sub(' ', value)
+            if value.startswith(' '):
+                space = True
+                value = value[1:]
+            if not value:
+                continue
+        if space and output:
+            output.append(' ')
+        space = False
+        output.append(value)
+    return ''.join(output)
+
+
+# list including ordered / unordered list
 def _handle_list_dom(list_json, indent_level=0, ordered=False):
     '''
     list_json: list json data
@@ -117,83 +245,6 @@ def _handle_list_dom(list_json, indent_level=0, ordered=False):
                 
     return result
 
-# 4 checkbox
-def _handle_check_list_dom(check_list_json):
-    output = ""
-    checked = check_list_json.get('checked')
-    for child in check_list_json['children']:
-        if 'text' in child:
-            output += _handle_text_style(child)[0]
-        else:
-            child_type = child.get('type')
-            if child_type == 'link':
-                output += _handle_link_dom(child)
-
-    if checked:
-        output = "<p><span>* [x] %s</span></p>" % output
-    else:
-        output = "<p><span>* [ ] %s</span></p>" % output
-
-    return output
-
-# 5 blockquote
-def _handle_blockquote_dom(blockquote_json):
-    output = ""
-    for child in blockquote_json['children']:
-        child_type = child.get('type')
-        if child_type in ['ordered_list', 'unordered_list']:
-            output += _handle_list_dom(child, '', child_type == 'ordered_list')
-
-        if child_type == 'link':
-            text_name = child['children'][0]['text']
-            text_url = child.get('href')
-            output += "<a href='%s'><span>%s</span></a>" % (text_url, text_name)
-
-        if child_type == 'paragraph':
-            output += '%s' % _handle_pagragh_dom(child)
-
-        if child_type == 'check_list_item':
-            output += '%s' % _handle_check_list_dom(child)
-
-        if child_type == 'image':
-            output += _handle_img_dom(child)
-
-        if 'text' in child:
-            text = child.get('text')
-            text_list = text.split("\n")
-            output += ''.join(['<p><span>%s</span></p>' % t for t in text_list if t.strip()])
-
-    tag = "<blockquote>%s</blockquote>" % output
-    return tag
-
-# 6 url link
-def _handle_link_dom(link_json):
-    href = link_json.get('href')
-    link_child = link_json['children'][0]
-
-    res = "<a href='%s'><span>%s</span></a>" % (href, link_child.get('text'))
-    return res
-
-
-# 7 pagragh
-def _handle_pagragh_dom(pagragh_json, doc_uuid=''):
-    output = ''
-    for child in pagragh_json['children']:
-        if 'text' in child:
-            output += _handle_text_style(child)[0]
-        else:
-            child_type = child.get('type')
-            if child_type == 'link':
-                output += _handle_link_dom(child)
-            if child_type == 'image':
-                output += _handle_img_dom(child, doc_uuid)
-
-
-    result = "<p><span>%s</span></p>" % output
-    return result.replace("\n", "")
-
-
-
 def _handle_table_cell_dom(table_cell_json):
     output = ''
     for child in table_cell_json['children']:
@@ -211,24 +262,26 @@ def _handle_table_cell_dom(table_cell_json):
     return output.strip()
 
 
-#  html2markdown
+# sdoc blocks to markdown
 def handle_header(header_json, header_type):
-    dom = _handle_header_dom(header_json, header_type)
-    return md_hander.handle(dom)
+    level = HEADER_LABEL.index(header_type) + 1
+    runs = [('#' * level + ' ', False)] + _handle_inline_runs(header_json['children'], styled=False)
+    return _join_runs(runs) + '\n'
 
 
 def handle_img(img_json):
-    dom = _handle_img_dom(img_json)
-    return dom
+    return _join_runs(_handle_img_runs(img_json))
 
 
 def handle_check_list(check_list_json):
-    return md_hander.handle(_handle_check_list_dom(check_list_json))
+    mark = {'text': '* [x] ' if check_list_json.get('checked') else '* [ ] '}
+    return _join_runs(_handle_inline_runs([mark] + check_list_json['children'])) + '\n'
 
 
-def handle_paragraph(paragraph_json, doc_uuid=''):
-    dom = _handle_pagragh_dom(paragraph_json, doc_uuid)
-    return md_hander.handle(dom)
+def handle_paragraph(paragraph_json, doc_uuid='', image_links=None):
+    runs = _handle_inline_runs(paragraph_json['children'], doc_uuid=doc_uuid, newlines=False,
+                               image_links=image_links)
+    return _join_runs(runs) + '\n'
 
 
 def handle_list(json_data, ordered=False):
@@ -246,10 +299,43 @@ def handle_codeblock(code_bloc_json):
     return "```%s\n%s```" % (lang, output)
 
 
-def handle_blockquote(json_data):
-    html = _handle_blockquote_dom(json_data)
-    md = md_hander.handle(html)
-    return md
+def handle_blockquote(json_data, image_links=None):
+    # paragraphs, text lines and check list items are blocks of their
+    # own, links and images next to each other share one
+    blocks = []
+    inline = None
+    for child in json_data['children']:
+        child_type = child.get('type')
+        if child_type in ['link', 'image']:
+            if inline is None:
+                inline = []
+                blocks.append(inline)
+            if child_type == 'link':
+                inline.extend(_handle_link_runs(child))
+            else:
+                inline.extend(_handle_img_runs(child, image_links=image_links))
+            continue
+
+        count = len(blocks)
+        if child_type in ['ordered_list', 'unordered_list']:
+            lines = _handle_list_dom(child, 0, child_type == 'ordered_list')
+            blocks.append([('\n> '.join(lines), False)])
+
+        if child_type == 'paragraph':
+            blocks.append(_handle_inline_runs(child['children'], doc_uuid='', newlines=False,
+                                              image_links=image_links))
+
+        if child_type == 'check_list_item':
+            blocks.append([(handle_check_list(child).rstrip('\n'), False)])
+
+        if 'text' in child:
+            blocks.extend([(t, True)] for t in child.get('text').split('\n') if t.strip())
+
+        if len(blocks) > count:
+            inline = None
+
+    lines = [line for line in map(_join_runs, blocks) if line]
+    return '> ' + '\n> \n> '.join(lines) + '\n'
 
 
 def handle_table(table_json):
@@ -301,16 +387,16 @@ def handle_table(table_json):
     return '\n' + '\n'.join(rows) + '\n'
 
 
-def handle_callout(json_data):
+def handle_callout(json_data, image_links=None):
     children = json_data.get('children')
     callout = ''
 
     for child in children:
-        output = handle_paragraph(child)
+        output = handle_paragraph(child, image_links=image_links)
         callout += output
     return callout
 
-def handle_image_block(json_data, doc_uuid=''):
+def handle_image_block(json_data, doc_uuid='', image_links=None):
     children = json_data.get('children', [])
     
     if not children:
@@ -323,8 +409,8 @@ def handle_image_block(json_data, doc_uuid=''):
             data = child.get('data', {})
             src = data.get('src', '')
             
-            if doc_uuid and src:
-                src = trans_img_path_to_url(src, doc_uuid)
+            if src:
+                src = (image_links or SEAHUB_IMAGE_LINKS).link(src, doc_uuid, str)
             
             alt_text = ''
             if 'children' in child and child['children']:
@@ -340,7 +426,7 @@ def handle_image_block(json_data, doc_uuid=''):
     return ''
 
 
-def json2md(json_data, doc_uuid=''):
+def json2md(json_data, doc_uuid='', image_links=None):
     doc_type = json_data.get('type')
     markdown_output = ''
     if doc_type in HEADER_LABEL:
@@ -352,7 +438,7 @@ def json2md(json_data, doc_uuid=''):
         markdown_output += output
 
     if doc_type == 'paragraph':
-        output = handle_paragraph(json_data, doc_uuid)
+        output = handle_paragraph(json_data, doc_uuid, image_links)
         markdown_output += output
 
     if doc_type == 'code_block':
@@ -372,24 +458,59 @@ def json2md(json_data, doc_uuid=''):
         markdown_output += output
 
     if doc_type == 'blockquote':
-        output = handle_blockquote(json_data)
+        output = handle_blockquote(json_data, image_links)
         markdown_output += output
 
     if doc_type == 'callout':
-        output = handle_callout(json_data)
+        output = handle_callout(json_data, image_links)
         markdown_output += output
     
     if doc_type == 'image_block':
-        output = handle_image_block(json_data, doc_uuid)
+        output = handle_image_block(json_data, doc_uuid, image_links)
         markdown_output += output
 
     return markdown_output
 
-def sdoc2md(json_tree, doc_uuid=''):
+def sdoc2md(json_tree, doc_uuid='', image_urls=None, image_links=None):
+    """
+    Markdown of a document.  Images are linked by their url in
+    ``image_urls`` or, without one, their Seahub url, unless
+    ``image_links`` says how.
+    """
+    if image_links is None:
+        image_links = ImageLinks(image_urls)
     results = []
     elements = json_tree.get('elements', []) or json_tree.get('children', [])
     for sub in elements:
-        results.append(json2md(sub, doc_uuid))
+        results.append(json2md(sub, doc_uuid, image_links))
 
     markdown_text = "\n".join(results)
     return markdown_text
+
+
+def sdoc2md_bundle(json_tree, doc_uuid=''):
+    """
+    Markdown of a document that can be read offline.
+
+    Every image the markdown links is downloaded once, however often it
+    is used, with the downloads running concurrently.  Images of blocks
+    written without them, such as lists and tables, are not downloaded.
+    Return ``(markdown, files)``: the markdown links the images by their
+    path under ``images/`` and ``files`` maps the paths to the image
+    content.  Images that can not be downloaded keep their Seahub url.
+    """
+    image_links = BundleImageLinks()
+    markdown = sdoc2md(json_tree, doc_uuid, image_links=image_links)
+    image_urls, files = bundle_images(list(image_links.srcs), doc_uuid)
+    return image_links.fill(markdown, image_urls), files
+
+
+def sdoc2md_preview(sdoc_str, doc_uuid='', max_blocks=None, max_chars=None, max_bytes=None):
+    """
+    Markdown of the head of a document, up to the first of the budgets
+    of ``iter_preview`` met.  ``sdoc_str`` is the sdoc json or its dict.
+    """
+    elements = iter_sdoc_elements(sdoc_str)
+    results = iter_preview(elements, lambda sub: json2md(sub, doc_uuid),
+                           max_blocks=max_blocks, max_chars=max_chars, max_bytes=max_bytes)
+    return "\n".join(results)
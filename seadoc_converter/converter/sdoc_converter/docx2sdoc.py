@@ -12,6 +12,7 @@ from docx.opc.pkgreader import _SerializedRelationships, _SerializedRelationship
 from docx.opc.oxml import parse_xml
 from docx.document import Document as _Document
 from docx.oxml.text.paragraph import CT_P
+from docx.oxml.ns import qn
 from docx.oxml.table import CT_Tbl
 from docx.table import _Cell, Table
 from docx.text.paragraph import Paragraph
@@ -172,38 +173,39 @@ def parse_paragraph(block, docx, docx_uuid):
     }
 
 
-def _get_numFmt(numbering_xml, num_id, ilvlid):
-    # Parse the XML
-    root = ET.fromstring(numbering_xml)
-    namespace = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
-
-    # Find the <w:num> element with the given numId
-    num_element = root.find(f".//w:num[@w:numId='{num_id}']", namespace)
-    if num_element is None:
-        return None
-
-    # Get the abstractNumId value from the <w:num> element
-    abstract_num_id = num_element.find("w:abstractNumId", namespace).get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val")
-
-    # Find the corresponding <w:abstractNum> element with the abstractNumId
-    abstract_num_element = root.find(f".//w:abstractNum[@w:abstractNumId='{abstract_num_id}']", namespace)
-    if abstract_num_element is None:
-        return None
-
-    # Find the <w:lvl> element with the given ilvlid
-    lvl_element = abstract_num_element.find(f".//w:lvl[@w:ilvl='{ilvlid}']", namespace)
-    if lvl_element is None:
-        return None
-
-    # Get the numFmt value from the <w:lvl> element
-    num_fmt = lvl_element.find("w:numFmt", namespace)
-    if num_fmt is not None:
-        return num_fmt.get("{http://schemas.openxmlformats.org/wordprocessingml/2006/main}val")
-    else:
-        return None
+def parse_numbering(numbering):
+    """
+    Index the w:numbering element ``numbering`` as a dict of (numId,
+    ilvl) to the numFmt of that list level, both ids as their attribute
+    strings, to look list paragraphs up in without going through the
+    numbering again.  The first w:num and w:abstractNum of an id count.
+    """
+    abstract_num_fmts = {}
+    for abstract_num in numbering.iter(qn('w:abstractNum')):
+        abstract_num_id = abstract_num.get(qn('w:abstractNumId'))
+        if abstract_num_id in abstract_num_fmts:
+            continue
+        level_fmts = abstract_num_fmts[abstract_num_id] = {}
+        for lvl in abstract_num.iter(qn('w:lvl')):
+            num_fmt = lvl.find(qn('w:numFmt'))
+            level_fmts.setdefault(lvl.get(qn('w:ilvl')), num_fmt.get(qn('w:val')) if num_fmt is not None else None)
+
+    num_fmts = {}
+    num_ids = set()
+    for num in numbering.iter(qn('w:num')):
+        num_id = num.get(qn('w:numId'))
+        if num_id in num_ids:
+            continue
+        num_ids.add(num_id)
+        abstract_num_id = num.find(qn('w:abstractNumId'))
+        if abstract_num_id is None:
+            continue
+        for ilvl, num_fmt in abstract_num_fmts.get(abstract_num_id.get(qn('w:val')), {}).items():
+            num_fmts[(num_id, ilvl)] = num_fmt
+    return num_fmts
 
 
-def parse_list(block, numbering_xml, docx, docx_uuid):
+def parse_list(block, num_fmts, docx, docx_uuid):
     if block._element.pPr.numPr is not None:
         num_id = block._element.pPr.numPr.numId.val
     elif block.style._element.pPr.numPr is not None:
@@ -217,7 +219,7 @@ def parse_list(block, numbering_xml, docx, docx_uuid):
     else:
         return parse_paragraph(block, docx, docx_uuid)
 
-    num_fmt = _get_numFmt(numbering_xml, num_id, ilvl_id)
+    num_fmt = num_fmts.get((str(num_id), str(ilvl_id)))
     if num_fmt in {'decimal', 'lowerLetter', 'lowerRoman', 'upperLetter', 'upperRoman'}:
         list_type = 'ordered_list'
     else:
@@ -360,9 +362,9 @@ def docx2sdoc(docx, username, docx_uuid):
         logging.error(e)
         return None, "Docx file is invalid."
     try:
-        numbering_xml = docx.part.numbering_part.element.xml
+        num_fmts = parse_numbering(docx.part.numbering_part.element)
     except (KeyError, NotImplementedError):
-        numbering_xml = None
+        num_fmts = {}
     styles_map = {
         'Title': 'title',
         'Subtitle': 'subtitle',
@@ -387,7 +389,7 @@ def docx2sdoc(docx, username, docx_uuid):
         elif style_name == 'Normal':
             node = parse_paragraph(block, docx, docx_uuid)
         elif style_name.startswith('List'):
-            node = parse_list(block, numbering_xml, docx, docx_uuid)
+            node = parse_list(block, num_fmts, docx, docx_uuid)
         elif is_normal_table:
             is_paragraph = isinstance(block, Paragraph)
             if is_paragraph:
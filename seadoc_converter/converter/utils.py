@@ -2,61 +2,83 @@ import os
 import re
 import jwt
 import json
+import time
+import base64
+import socket
 import logging
+import ipaddress
+import mimetypes
 import requests
+import threading
 
-from zipfile import ZipFile
+from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
 from pathlib import Path
+from urllib.parse import urlparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.fields import RequestField
+from urllib3.filepost import choose_boundary
 from bs4 import BeautifulSoup
 from html_to_markdown import convert_to_markdown
 
 from seadoc_converter.converter.sdoc_converter.md2sdoc import md2sdoc
-from seadoc_converter.config import SEAHUB_SERVICE_URL, SEADOC_PRIVATE_KEY
+from seadoc_converter.config import SEAHUB_SERVICE_URL, SEADOC_PRIVATE_KEY, \
+        IMAGE_DOWNLOAD_WORKERS, IMAGE_DOWNLOAD_TIMEOUT, IMAGE_LINK_CACHE_TTL, IMAGE_LINK_CACHE_SIZE, \
+        IMAGE_DOWNLOAD_EXTERNAL
+
+logger = logging.getLogger(__name__)
 
 
 IMAGE_PATTERN = r'<img.*?src="(.*?)".*?>'
 
 
 def is_url_link(s):
-    if re.match(r'^http[s]?://', s):
-        return True
-    else:
-        return False
-
+    return s.startswith(('http://', 'https://'))
 
-def trans_img_path_to_url(image_path, doc_uuid):
-    if is_url_link(image_path):
-        return image_path
 
-    return "%(server_url)s/%(tag)s/%(doc_uuid)s/%(image_path)s" % ({
+def get_img_url_prefix(doc_uuid):
+    return "%(server_url)s/%(tag)s/%(doc_uuid)s/" % ({
         'server_url': SEAHUB_SERVICE_URL.rstrip('/'),
         'tag': 'api/v2.1/seadoc/download-image',
         'doc_uuid': doc_uuid,
-        'image_path': image_path.strip('/')
     })
 
 
-def trans_video_path_to_url(video_path, doc_uuid):
-    if is_url_link(video_path):
-        return video_path
-
-    return "%(server_url)s/%(tag)s/%(doc_uuid)s/%(video_path)s" % ({
+def get_video_url_prefix(doc_uuid):
+    return "%(server_url)s/%(tag)s/%(doc_uuid)s/" % ({
         'server_url': SEAHUB_SERVICE_URL.rstrip('/'),
         'tag': 'api/v2.1/seadoc/download-video',
         'doc_uuid': doc_uuid,
-        'video_path': video_path.strip('/')
     })
 
 
-def trans_wiki_page_id_to_url(publish_url, wiki_page_id):
-
-    return "%(server_url)s/wiki/publish/%(publish_url)s/%(wiki_page_id)s" % ({
+def get_wiki_page_url_prefix(publish_url):
+    return "%(server_url)s/wiki/publish/%(publish_url)s/" % ({
         'server_url': SEAHUB_SERVICE_URL.rstrip('/'),
         'publish_url': publish_url,
-        'wiki_page_id': wiki_page_id
     })
 
 
+def trans_img_path_to_url(image_path, doc_uuid):
+    if is_url_link(image_path):
+        return image_path
+
+    return get_img_url_prefix(doc_uuid) + image_path.strip('/')
+
+
+def trans_video_path_to_url(video_path, doc_uuid):
+    if is_url_link(video_path):
+        return video_path
+
+    return get_video_url_prefix(doc_uuid) + video_path.strip('/')
+
+
+def trans_wiki_page_id_to_url(publish_url, wiki_page_id):
+
+    return get_wiki_page_url_prefix(publish_url) + wiki_page_id
+
+
 def gen_jwt_auth_header(payload):
 
     jwt_token = jwt.encode(payload, SEADOC_PRIVATE_KEY, algorithm='HS256')
@@ -64,6 +86,472 @@ def gen_jwt_auth_header(payload):
     return headers
 
 
+# image download links by (file_uuid, image_name), with the time they
+# are used until, shared by all conversions of the process.  Every link
+# lives as long, so the oldest ones are the first to expire.
+IMAGE_LINK_CACHE = OrderedDict()
+IMAGE_LINK_CACHE_LOCK = threading.Lock()
+
+
+def get_cached_image_links(file_uuid, image_names):
+    """
+    Return ``{image_name: download_link}`` of the images whose links are
+    cached and not expired.
+    """
+    now = time.monotonic()
+    links = {}
+    with IMAGE_LINK_CACHE_LOCK:
+        for image_name in image_names:
+            key = (file_uuid, image_name)
+            cached = IMAGE_LINK_CACHE.get(key)
+            if cached is None:
+                continue
+            expires, link = cached
+            if expires > now:
+                links[image_name] = link
+            else:
+                del IMAGE_LINK_CACHE[key]
+    return links
+
+
+def cache_image_links(file_uuid, links):
+    if IMAGE_LINK_CACHE_TTL <= 0:
+        return
+    expires = time.monotonic() + IMAGE_LINK_CACHE_TTL
+    with IMAGE_LINK_CACHE_LOCK:
+        for image_name, link in links.items():
+            if not link:
+                continue
+            key = (file_uuid, image_name)
+            IMAGE_LINK_CACHE[key] = (expires, link)
+            IMAGE_LINK_CACHE.move_to_end(key)
+        while len(IMAGE_LINK_CACHE) > IMAGE_LINK_CACHE_SIZE:
+            IMAGE_LINK_CACHE.popitem(last=False)
+
+
+def evict_image_link(file_uuid, image_name):
+    with IMAGE_LINK_CACHE_LOCK:
+        IMAGE_LINK_CACHE.pop((file_uuid, image_name), None)
+
+
+def get_image_content_url(file_uuid, image_name):
+
+    cached = get_cached_image_links(file_uuid, [image_name])
+    if cached:
+        return cached[image_name]
+
+    payload = {
+        'file_uuid': file_uuid,
+        'exp': int(time.time()) + 300
+    }
+
+    url = f'{SEAHUB_SERVICE_URL}/api/v2.1/seadoc/image-download-link/{file_uuid}/'
+    params = {'image_name': image_name}
+    headers = gen_jwt_auth_header(payload)
+
+    try:
+        resp = requests.get(url, params, headers=headers, timeout=IMAGE_DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error('can not get image download link: %s %s %s', file_uuid, image_name, e)
+        return ""
+
+    if resp.status_code == 200:
+        download_link = resp.json().get('download_link')
+        cache_image_links(file_uuid, {image_name: download_link})
+        return download_link
+    else:
+        logger.error(resp.__dict__)
+        return ""
+
+
+# Seahub urls that answered they have no endpoint for batched image
+# download links, which are not asked for them again by the process
+BATCH_IMAGE_LINKS_UNSUPPORTED = set()
+
+
+def get_image_content_urls(file_uuid, image_names):
+    """
+    Download links of several images of a document, requested at once.
+
+    Return ``{image_name: download_link}``, or None when Seahub can not
+    resolve the links in one request, e.g. because it is too old to.
+    """
+    if SEAHUB_SERVICE_URL in BATCH_IMAGE_LINKS_UNSUPPORTED:
+        return None
+
+    payload = {
+        'file_uuid': file_uuid,
+        'exp': int(time.time()) + 300
+    }
+
+    url = f'{SEAHUB_SERVICE_URL}/api/v2.1/seadoc/image-download-links/{file_uuid}/'
+    headers = gen_jwt_auth_header(payload)
+
+    try:
+        resp = requests.post(url, json={'image_names': image_names}, headers=headers,
+                             timeout=IMAGE_DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        logger.error('can not get image download links: %s %s', file_uuid, e)
+        return None
+
+    if resp.status_code == 200:
+        download_links = resp.json().get('download_links') or {}
+        cache_image_links(file_uuid, download_links)
+        return download_links
+    if resp.status_code in (404, 405):
+        logger.info('%s has no batched image download links, asking for them one by one', SEAHUB_SERVICE_URL)
+        BATCH_IMAGE_LINKS_UNSUPPORTED.add(SEAHUB_SERVICE_URL)
+    else:
+        logger.error(resp.__dict__)
+    return None
+
+
+def is_external_image(image_src):
+    # images fetched from their own url rather than through Seahub
+    return IMAGE_DOWNLOAD_EXTERNAL and is_url_link(image_src)
+
+
+def is_public_url(url):
+    """
+    Whether every address the host of ``url`` resolves to is public, so
+    that fetching it can not reach the internal network.
+    """
+    host = urlparse(url).hostname
+    if not host:
+        return False
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except (socket.gaierror, UnicodeError):
+        return False
+    return all(ipaddress.ip_address(address[4][0].split('%')[0]).is_global for address in addresses)
+
+
+def download_image(image_src, doc_uuid, download_link=None):
+    """
+    Return ``(content, mimetype)`` of an image of a document, or None
+    when it can not be downloaded.  Images are fetched through
+    ``download_link`` or, without one, a download link asked from
+    Seahub by their name, and with IMAGE_DOWNLOAD_EXTERNAL, links to
+    public hosts directly.
+    """
+    external = is_external_image(image_src)
+    if external:
+        if not is_public_url(image_src):
+            logger.warning('refused to download image of a non public host: %s %s', doc_uuid, image_src)
+            return None
+        image_url = image_src
+    else:
+        image_url = download_link or get_image_content_url(doc_uuid, os.path.basename(image_src))
+        if not image_url:
+            return None
+
+    # redirects could lead external images to the internal network
+    resp = requests.get(image_url, timeout=IMAGE_DOWNLOAD_TIMEOUT, allow_redirects=not external)
+    if not resp.ok:
+        if not external:
+            # the link may have expired before the cache let it go
+            evict_image_link(doc_uuid, os.path.basename(image_src))
+        logger.error('can not download image: %s %s %s', doc_uuid, image_src, resp.status_code)
+        return None
+
+    mimetype = resp.headers.get('Content-Type', '').split(';')[0].strip()
+    if not mimetype.startswith('image/'):
+        mimetype = mimetypes.guess_type(urlparse(image_src).path)[0] or 'application/octet-stream'
+    return resp.content, mimetype
+
+
+def download_images(image_srcs, doc_uuid, max_workers=None, batch_links=False):
+    """
+    Download the distinct ``image_srcs`` of a document on at most
+    ``max_workers`` threads at a time.  With ``batch_links`` the download
+    links of the images of the document are asked from Seahub in one
+    request, falling back to a request per image when that fails.
+
+    Return ``{image_src: (content, mimetype)}`` of the images that could
+    be downloaded.
+    """
+    image_srcs = list(dict.fromkeys(image_srcs))
+    if not image_srcs:
+        return {}
+
+    download_links = {}
+    if batch_links:
+        image_names = {
+            image_src: os.path.basename(image_src) for image_src in image_srcs if not is_external_image(image_src)
+        }
+        if image_names:
+            names = list(dict.fromkeys(image_names.values()))
+            links = get_cached_image_links(doc_uuid, names)
+            missing_names = [image_name for image_name in names if image_name not in links]
+            if missing_names:
+                links.update(get_image_content_urls(doc_uuid, missing_names) or {})
+            download_links = {image_src: links.get(image_name) for image_src, image_name in image_names.items()}
+
+    def download(image_src):
+        try:
+            return download_image(image_src, doc_uuid, download_links.get(image_src))
+        except Exception as e:
+            logger.error('can not download image: %s %s %s', doc_uuid, image_src, e)
+            return None
+
+    max_workers = min(max_workers or IMAGE_DOWNLOAD_WORKERS, len(image_srcs))
+    with ThreadPoolExecutor(max_workers) as executor:
+        images = executor.map(download, image_srcs)
+        return {image_src: image for image_src, image in zip(image_srcs, images) if image is not None}
+
+
+def image_data_uri(content, mimetype):
+    return 'data:%s;base64,%s' % (mimetype, base64.b64encode(content).decode('ascii'))
+
+
+def image_file_name(image_src, taken):
+    """
+    A file name for an image downloaded from ``image_src`` that is not
+    in ``taken`` yet.
+    """
+    name = os.path.basename(urlparse(image_src).path) or 'image'
+    name = re.sub(r'[^\w.-]', '_', name)
+    stem, extension = os.path.splitext(name)
+    index = 1
+    while name in taken:
+        name = f'{stem}-{index}{extension}'
+        index += 1
+    taken.add(name)
+    return name
+
+
+# where images are stored in a zip bundle, next to the exported file
+BUNDLE_IMAGES_DIR = 'images'
+
+
+def bundled_image_srcs(image_srcs):
+    # images linking other sites stay linked in bundles, unless they may
+    # be fetched
+    return [image_src for image_src in image_srcs if not is_url_link(image_src) or is_external_image(image_src)]
+
+
+def bundle_images(image_srcs, doc_uuid, max_workers=None):
+    """
+    Download the images of a document to store them next to an export.
+
+    Return ``(image_urls, files)``: the relative path, under ``images/``,
+    of every image src that could be downloaded, and the image content
+    by path.
+    """
+    image_urls = {}
+    files = {}
+    names = set()
+    images = download_images(bundled_image_srcs(image_srcs), doc_uuid, max_workers)
+    for image_src, (content, _) in images.items():
+        path = f'{BUNDLE_IMAGES_DIR}/{image_file_name(image_src, names)}'
+        image_urls[image_src] = path
+        files[path] = content
+    return image_urls, files
+
+
+def iter_nodes(elements):
+    """
+    Yield the nodes of a document depth first, in document order.
+    """
+    stack = list(reversed(elements))
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        yield node
+        stack.extend(reversed(node.get('children', [])))
+
+
+def collect_image_srcs(elements):
+    """
+    The distinct srcs of the images of a document, in document order.
+    """
+    image_srcs = {}
+    for node in iter_nodes(elements):
+        if node.get('type') == 'image':
+            image_src = node.get('data', {}).get('src')
+            if image_src:
+                image_srcs[image_src] = None
+    return list(image_srcs)
+
+
+WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(sdoc_str, index, decoder):
+    """
+    Yield the items of the json array starting at ``index`` one by one,
+    decoding each only when it is asked for.
+    """
+    index = WHITESPACE_RE.match(sdoc_str, index + 1).end()
+    if sdoc_str.startswith(']', index):
+        return
+    while True:
+        item, index = decoder.raw_decode(sdoc_str, index)
+        yield item
+        index = WHITESPACE_RE.match(sdoc_str, index).end()
+        if sdoc_str.startswith(']', index):
+            return
+        if not sdoc_str.startswith(',', index):
+            raise ValueError('Expecting , or ] at %d' % index)
+        index = WHITESPACE_RE.match(sdoc_str, index + 1).end()
+
+
+def iter_sdoc_elements(sdoc_str):
+    """
+    Yield the top level elements of a document, its ``elements`` or,
+    when it has none, its ``children``.
+
+    A json string is decoded only as far as the elements taken from it,
+    so that the head of a large document is read without decoding the
+    rest.
+    """
+    if isinstance(sdoc_str, dict):
+        yield from sdoc_str.get('elements', []) or sdoc_str.get('children', [])
+        return
+
+    decoder = json.JSONDecoder()
+    index = WHITESPACE_RE.match(sdoc_str, 0).end()
+    if not sdoc_str.startswith('{', index):
+        raise ValueError('Expecting a json object')
+    index = WHITESPACE_RE.match(sdoc_str, index + 1).end()
+
+    children = []
+    while not sdoc_str.startswith('}', index):
+        key, index = decoder.raw_decode(sdoc_str, index)
+        index = WHITESPACE_RE.match(sdoc_str, index).end()
+        if not sdoc_str.startswith(':', index):
+            raise ValueError('Expecting : at %d' % index)
+        index = WHITESPACE_RE.match(sdoc_str, index + 1).end()
+
+        if key == 'elements' and sdoc_str.startswith('[', index):
+            elements = iter_json_array(sdoc_str, index, decoder)
+            first = next(elements, None)
+            if first is not None:
+                yield first
+                yield from elements
+                return
+        value, index = decoder.raw_decode(sdoc_str, index)
+        if key == 'children':
+            children = value
+
+        index = WHITESPACE_RE.match(sdoc_str, index).end()
+        if sdoc_str.startswith(',', index):
+            index = WHITESPACE_RE.match(sdoc_str, index + 1).end()
+
+    yield from children
+
+
+def get_text_length(element):
+    length = 0
+    stack = [element]
+    while stack:
+        node = stack.pop()
+        if not isinstance(node, dict):
+            continue
+        if 'text' in node:
+            length += len(str(node['text']))
+        stack.extend(node.get('children', []))
+    return length
+
+
+def iter_preview(elements, render, max_blocks=None, max_chars=None, max_bytes=None):
+    """
+    Yield ``render(element)`` for the top level ``elements`` until one
+    of the budgets is met: ``max_blocks`` elements, ``max_chars``
+    characters of document text or ``max_bytes`` bytes of output.  The
+    element that meets a budget is the last one rendered, and elements
+    after it are not even taken from ``elements``.
+    """
+    blocks = chars = size = 0
+    for element in elements:
+        if max_blocks is not None and blocks >= max_blocks:
+            return
+        output = render(element)
+        yield output
+
+        blocks += 1
+        if max_chars is not None:
+            chars += get_text_length(element)
+            if chars >= max_chars:
+                return
+        if max_bytes is not None:
+            size += len(output.encode('utf-8'))
+            if size >= max_bytes:
+                return
+
+
+def make_zip(files):
+    """
+    Return the bytes of a zip archive of ``files``, a dict of archive
+    path to str or bytes content.
+    """
+    buffer = BytesIO()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED) as zip_file:
+        for path, content in files.items():
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            zip_file.writestr(path, content)
+    return buffer.getvalue()
+
+
+class MultipartBody(object):
+    """
+    The multipart/form-data body ``requests.post(url, files=files)``
+    sends, for a ``files`` dict of name to str, bytes or a (filename,
+    content) tuple.  File objects in it are read while the body is sent
+    instead of being copied into memory first:
+
+        body = MultipartBody({'file': ('a.docx', fp)})
+        requests.post(url, data=body, headers={'Content-Type': body.content_type})
+    """
+
+    def __init__(self, files):
+        boundary = choose_boundary()
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.parts = deque()
+        self.length = 0
+
+        for name, value in files.items():
+            filename, content = value if isinstance(value, tuple) else (name, value)
+            field = RequestField(name=name, data=b'', filename=filename)
+            field.make_multipart()
+            self.add_part(f'--{boundary}\r\n{field.render_headers()}')
+            self.add_part(content)
+            self.add_part('\r\n')
+        self.add_part(f'--{boundary}--\r\n')
+
+    def add_part(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        if isinstance(content, bytes):
+            self.length += len(content)
+            content = BytesIO(content)
+        else:
+            start = content.tell()
+            self.length += content.seek(0, os.SEEK_END) - start
+            content.seek(start)
+        self.parts.append(content)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        while chunk := self.read(64 * 1024):
+            yield chunk
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.popleft()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
 
 def process_images_and_attachments(content_div, html_file, seafile_server_url):
     for a in content_div.find_all('a'):
@@ -5,23 +5,29 @@ import logging
 import requests
 import shutil
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
 from pathlib import Path
 from urllib.parse import quote
 from zipfile import ZipFile
 
 from flask import request, Flask, Response
+from werkzeug.wsgi import wrap_file
 from seadoc_converter import config
 
 from seadoc_converter.converter.sdoc_converter.docx2sdoc import docx2sdoc
 from seadoc_converter.converter.sdoc_converter.md2sdoc import md2sdoc, trans_image_url_to_path
-from seadoc_converter.converter.markdown_converter import sdoc2md
+from seadoc_converter.converter.markdown_converter import sdoc2md, sdoc2md_bundle, sdoc2md_preview
 from seadoc_converter.converter.docx_converter import sdoc2docx
-from seadoc_converter.converter.html_converter import sdoc2html
-from seadoc_converter.converter.utils import process_zip_file
+from seadoc_converter.converter.html_converter import sdoc2html, sdoc2html_bundle, sdoc2html_preview, \
+        sdoc2html_pages
+from seadoc_converter.converter.utils import process_zip_file, make_zip, MultipartBody
 
 logger = logging.getLogger(__name__)
 flask_app = Flask(__name__)
 
+# blocks in a preview when no budget is given
+DEFAULT_PREVIEW_BLOCKS = 20
+
 
 def check_auth_token(req):
     auth = req.headers.get('Authorization', '').split()
@@ -161,29 +167,30 @@ def sdoc_convert_to_docx():
     filename = os.path.basename(path)
     new_filename = filename[:-4] + 'docx'
 
-    docx_content = b''
-    if extension == '.sdoc' and src_type == 'sdoc' and dst_type == 'docx':
-        if sdoc_content:
-            sdoc_content_json = json.loads(sdoc_content)
-            docx_content = sdoc2docx(sdoc_content_json, doc_uuid, username)
-    else:
+    if extension != '.sdoc' or src_type != 'sdoc' or dst_type != 'docx':
         return {'error_msg': 'unsupported convert type.'}, 400
 
-    # upload file
-    files = {
-        'file': (new_filename, docx_content),
-        'parent_dir': parent_dir,
-    }
-    try:
-        resp = requests.post(upload_url, files=files)
-        if not resp.ok:
-            logger.error(resp.text)
-            return {'error_msg': resp.text}, 500
-
-    except Exception as e:
-        logger.error(e)
-        error_msg = 'Internal Server Error'
-        return {'error_msg': error_msg}, 500
+    with SpooledTemporaryFile(max_size=config.DOCX_SPOOL_MAX_SIZE) as docx_file:
+        if sdoc_content:
+            sdoc_content_json = json.loads(sdoc_content)
+            sdoc2docx(sdoc_content_json, doc_uuid, username, output=docx_file)
+        docx_file.seek(0)
+
+        # upload file, streamed from docx_file
+        body = MultipartBody({
+            'file': (new_filename, docx_file),
+            'parent_dir': parent_dir,
+        })
+        try:
+            resp = requests.post(upload_url, data=body, headers={'Content-Type': body.content_type})
+            if not resp.ok:
+                logger.error(resp.text)
+                return {'error_msg': resp.text}, 500
+
+        except Exception as e:
+            logger.error(e)
+            error_msg = 'Internal Server Error'
+            return {'error_msg': error_msg}, 500
 
     return {'success': True}, 200
 
@@ -217,25 +224,43 @@ def sdoc_export_to_docx():
 
     sdoc_content = requests.get(download_url).content.decode()
 
-    docx_content = b''
-    if extension == '.sdoc' and src_type == 'sdoc' and dst_type == 'docx':
+    if extension != '.sdoc' or src_type != 'sdoc' or dst_type != 'docx':
+        return {'error_msg': 'unsupported convert type.'}, 400
+
+    # closed by the response once it is sent
+    docx_file = SpooledTemporaryFile(max_size=config.DOCX_SPOOL_MAX_SIZE)
+    try:
         if sdoc_content:
             sdoc_content_json = json.loads(sdoc_content)
-            docx_content = sdoc2docx(sdoc_content_json, doc_uuid, username)
-    else:
-        return {'error_msg': 'unsupported convert type.'}, 400
+            sdoc2docx(sdoc_content_json, doc_uuid, username, output=docx_file)
+    except Exception:
+        docx_file.close()
+        raise
+    content_length = docx_file.tell()
+    docx_file.seek(0)
 
     filename = os.path.basename(path)
     new_filename = quote(filename[:-4] + 'docx')
     return Response(
-        docx_content,
+        wrap_file(request.environ, docx_file),
         mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-        headers={'Content-disposition': f'attachment; filename={new_filename}'}
+        headers={
+            'Content-disposition': f'attachment; filename={new_filename}',
+            'Content-Length': str(content_length),
+        },
+        direct_passthrough=True,
     )
 
 
 @flask_app.route('/api/v1/sdoc-export-to-md/', methods=['POST'])
 def sdoc_export_to_md():
+    """
+    Export an .sdoc file as Markdown (direct download).
+
+    With ``bundle`` set to ``zip`` the markdown and its images, stored
+    under ``images/`` and linked by relative paths, are returned as a zip
+    archive, so that the export can be read without Seahub.
+    """
     is_valid = check_auth_token(request)
     if not is_valid:
         return {'error_msg': 'Permission denied'}, 403
@@ -251,6 +276,7 @@ def sdoc_export_to_md():
     src_type = data.get('src_type')
     dst_type = data.get('dst_type')
     download_url = data.get('download_url')
+    bundle = data.get('bundle', '')
 
     extension = Path(path).suffix
     if extension not in ['.sdoc']:
@@ -259,15 +285,32 @@ def sdoc_export_to_md():
     if not download_url:
         return {'error_msg': 'download_url invalid.'}, 400
 
+    if bundle not in ('', 'zip'):
+        return {'error_msg': 'bundle invalid.'}, 400
+
     sdoc_content = requests.get(download_url).content.decode()
     md_content = ''
+    files = {}
     if extension == '.sdoc' and src_type == 'sdoc' and dst_type == 'md':
         if sdoc_content:
             sdoc_content_json = json.loads(sdoc_content)
-            md_content = sdoc2md(sdoc_content_json, doc_uuid)
+            if bundle:
+                md_content, files = sdoc2md_bundle(sdoc_content_json, doc_uuid)
+            else:
+                md_content = sdoc2md(sdoc_content_json, doc_uuid)
     else:
         return {'error_msg': 'unsupported convert type.'}, 400
 
+    if bundle == 'zip':
+        filename = os.path.basename(path)
+        files[filename[:-5] + '.md'] = md_content
+        new_filename = quote(filename[:-5] + '.zip')
+        return Response(
+            make_zip(files),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={new_filename}'},
+        )
+
     if isinstance(md_content, dict):
         md_content = json.dumps(md_content)
     
@@ -284,7 +327,11 @@ def sdoc_export_to_md():
 
 @flask_app.route('/api/v1/sdoc-convert-to-html/', methods=['POST'])
 def sdoc_convert_to_html():
-    """Convert an .sdoc file to HTML and upload the result."""
+    """
+    Convert an .sdoc file to HTML and upload the result.  With
+    ``paginate`` the pages of ``sdoc2html_pages`` are uploaded instead,
+    next to each other.
+    """
     is_valid = check_auth_token(request)
     if not is_valid:
         return {'error_msg': 'Permission denied'}, 403
@@ -301,6 +348,8 @@ def sdoc_convert_to_html():
     dst_type = data.get('dst_type')
     download_url = data.get('download_url')
     upload_url = data.get('upload_url')
+    paginate = data.get('paginate', False)
+    page_header_level = data.get('page_header_level', 1)
 
     extension = Path(path).suffix
     if extension not in ['.sdoc']:
@@ -312,6 +361,9 @@ def sdoc_convert_to_html():
     if not upload_url:
         return {'error_msg': 'upload_url invalid.'}, 400
 
+    if page_header_level not in range(1, 7):
+        return {'error_msg': 'page_header_level invalid.'}, 400
+
     if not (extension == '.sdoc' and src_type == 'sdoc' and dst_type == 'html'):
         return {'error_msg': 'unsupported convert type.'}, 400
 
@@ -319,22 +371,26 @@ def sdoc_convert_to_html():
     if not sdoc_content:
         return {'error_msg': 'Empty sdoc content.'}, 400
 
-    html_body = sdoc2html(sdoc_content, doc_uuid=doc_uuid)
-
     parent_dir = os.path.dirname(path)
     filename = os.path.basename(path)
-    new_filename = filename[:-5] + '.html'
-    new_file_path = os.path.join(parent_dir, new_filename)
+
+    if paginate:
+        files = sdoc2html_pages(sdoc_content, filename[:-5], doc_uuid=doc_uuid,
+                                page_header_level=page_header_level)
+    else:
+        files = {filename[:-5] + '.html': sdoc2html(sdoc_content, doc_uuid=doc_uuid)}
 
     try:
-        resp = requests.post(
-            upload_url,
-            data={'target_file': new_file_path, 'parent_dir': parent_dir},
-            files={'file': (new_filename, html_body.encode())},
-        )
-        if not resp.ok:
-            logger.error(resp.text)
-            return {'error_msg': resp.text}, 500
+        for new_filename, html_body in files.items():
+            new_file_path = os.path.join(parent_dir, new_filename)
+            resp = requests.post(
+                upload_url,
+                data={'target_file': new_file_path, 'parent_dir': parent_dir},
+                files={'file': (new_filename, html_body.encode())},
+            )
+            if not resp.ok:
+                logger.error(resp.text)
+                return {'error_msg': resp.text}, 500
     except Exception as e:
         logger.error(e)
         return {'error_msg': 'Internal Server Error'}, 500
@@ -344,7 +400,19 @@ def sdoc_convert_to_html():
 
 @flask_app.route('/api/v1/sdoc-export-to-html/', methods=['POST'])
 def sdoc_export_to_html():
-    """Export an .sdoc file as an HTML response (direct download)."""
+    """
+    Export an .sdoc file as an HTML response (direct download).
+
+    With ``bundle`` set to ``inline`` the images are embedded in the html,
+    with ``zip`` the html and its images are returned as a zip archive,
+    so that the export can be viewed offline.  A zip bundle with
+    ``external_assets`` also stores the formula svgs and the code
+    highlighting stylesheet as files the html links to.
+
+    With ``paginate`` the document is split into pages at its top level
+    headers, see ``sdoc2html_pages``, and the pages are returned as a
+    zip archive.
+    """
     is_valid = check_auth_token(request)
     if not is_valid:
         return {'error_msg': 'Permission denied'}, 403
@@ -361,6 +429,10 @@ def sdoc_export_to_html():
     dst_type = data.get('dst_type')
     download_url = data.get('download_url')
     publish_url = data.get('publish_url')
+    bundle = data.get('bundle', '')
+    external_assets = data.get('external_assets', False)
+    paginate = data.get('paginate', False)
+    page_header_level = data.get('page_header_level', 1)
 
     extension = Path(path).suffix
     if extension not in ['.sdoc']:
@@ -369,6 +441,15 @@ def sdoc_export_to_html():
     if not download_url:
         return {'error_msg': 'download_url invalid.'}, 400
 
+    if bundle not in ('', 'inline', 'zip'):
+        return {'error_msg': 'bundle invalid.'}, 400
+
+    if external_assets and bundle != 'zip':
+        return {'error_msg': 'external_assets requires a zip bundle.'}, 400
+
+    if page_header_level not in range(1, 7):
+        return {'error_msg': 'page_header_level invalid.'}, 400
+
     if not (extension == '.sdoc' and src_type == 'sdoc' and dst_type == 'html'):
         return {'error_msg': 'unsupported convert type.'}, 400
 
@@ -376,10 +457,37 @@ def sdoc_export_to_html():
     if not sdoc_content:
         return {'error_msg': 'Empty sdoc content.'}, 400
 
-    html_body = sdoc2html(sdoc_content, doc_uuid=doc_uuid, publish_url=publish_url)
-
     filename = os.path.basename(path)
-    new_filename = quote(filename[:-5] + '.html')
+    html_filename = filename[:-5] + '.html'
+
+    if paginate:
+        files = sdoc2html_pages(
+            sdoc_content, filename[:-5], doc_uuid=doc_uuid, publish_url=publish_url,
+            page_header_level=page_header_level, bundle=bundle, external_assets=bool(external_assets))
+        new_filename = quote(filename[:-5] + '.zip')
+        return Response(
+            make_zip(files),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={new_filename}'},
+        )
+
+    if bundle:
+        html_body, assets = sdoc2html_bundle(
+            sdoc_content, doc_uuid=doc_uuid, publish_url=publish_url, inline_images=bundle == 'inline',
+            external_assets=bool(external_assets))
+    else:
+        html_body = sdoc2html(sdoc_content, doc_uuid=doc_uuid, publish_url=publish_url)
+
+    if bundle == 'zip':
+        assets[html_filename] = html_body
+        new_filename = quote(filename[:-5] + '.zip')
+        return Response(
+            make_zip(assets),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={new_filename}'},
+        )
+
+    new_filename = quote(html_filename)
     return Response(
         html_body.encode(),
         mimetype='text/html',
@@ -387,6 +495,67 @@ def sdoc_export_to_html():
     )
 
 
+@flask_app.route('/api/v1/sdoc-preview/', methods=['POST'])
+def sdoc_preview():
+    """
+    Return the html or markdown of the head of an .sdoc file, up to
+    ``max_blocks`` top level elements, ``max_chars`` characters of text
+    or ``max_bytes`` bytes of output, whichever comes first.
+    """
+    is_valid = check_auth_token(request)
+    if not is_valid:
+        return {'error_msg': 'Permission denied'}, 403
+
+    try:
+        data = json.loads(request.data)
+    except Exception as e:
+        logger.exception(e)
+        return {'error_msg': 'Bad request.'}, 400
+
+    doc_uuid = data.get('doc_uuid')
+    dst_type = data.get('dst_type')
+    download_url = data.get('download_url')
+    publish_url = data.get('publish_url')
+
+    if not download_url:
+        return {'error_msg': 'download_url invalid.'}, 400
+
+    if dst_type not in ('html', 'md'):
+        return {'error_msg': 'unsupported convert type.'}, 400
+
+    budgets = {}
+    for name in ('max_blocks', 'max_chars', 'max_bytes'):
+        value = data.get(name)
+        if value is None:
+            continue
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = 0
+        if value <= 0:
+            return {'error_msg': f'{name} invalid.'}, 400
+        budgets[name] = value
+    if not budgets:
+        budgets['max_blocks'] = DEFAULT_PREVIEW_BLOCKS
+
+    sdoc_content = requests.get(download_url).content.decode()
+    if not sdoc_content:
+        return {'error_msg': 'Empty sdoc content.'}, 400
+
+    try:
+        if dst_type == 'html':
+            content = sdoc2html_preview(sdoc_content, doc_uuid=doc_uuid, publish_url=publish_url, **budgets)
+            mimetype = 'text/html'
+        else:
+            content = sdoc2md_preview(sdoc_content, doc_uuid=doc_uuid, **budgets)
+            mimetype = 'text/markdown'
+    except ValueError as e:
+        logger.error(e)
+        return {'error_msg': 'Invalid sdoc content.'}, 400
+
+    return Response(content.encode(), mimetype=mimetype)
+
+
 @flask_app.route('/api/v1/confluence-to-wiki/', methods=['POST'])
 def confluence_to_wiki():
     is_valid = check_auth_token(request)
@@ -0,0 +1,19 @@
+"""
+Documents shared by the converter tests.
+"""
+
+DOC_UUID = 'test-doc-uuid'
+
+
+def image_doc(image_srcs):
+    """
+    A document of a paragraph per image src, holding just the image.
+    """
+    return {'elements': [
+        {'id': f'p-{index}', 'type': 'paragraph', 'children': [
+            {'id': f't-{index}', 'text': ''},
+            {'id': f'i-{index}', 'type': 'image', 'data': {'src': image_src}, 'children': [{'text': ''}]},
+            {'id': f'e-{index}', 'text': ''},
+        ]}
+        for index, image_src in enumerate(image_srcs)
+    ]}
@@ -0,0 +1,125 @@
+"""
+A local stand-in for the Seahub endpoints the converters call, so that
+image handling can be tested and benchmarked without a Seafile server.
+
+    stub = SeahubStub(latency=0.05)
+    stub.start()
+    os.environ['SEAHUB_SERVICE_URL'] = stub.url  # before importing config
+    ...
+    stub.stop()
+
+Images are small PNGs whose pixels depend on the image name, served
+after ``latency`` seconds to stand in for the network.  Requests are
+counted per endpoint in ``stub.requests``.  With ``batch_links=False``
+the stub answers 404 to batched download link requests, like a Seahub
+that does not support them.
+"""
+import json
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+IMAGE_DOWNLOAD_LINK_PATH = '/api/v2.1/seadoc/image-download-link/'
+IMAGE_DOWNLOAD_LINKS_PATH = '/api/v2.1/seadoc/image-download-links/'
+DOWNLOAD_IMAGE_PATH = '/api/v2.1/seadoc/download-image/'
+UPLOAD_IMAGE_PATH = '/api/v2.1/seadoc/upload-image/'
+FILES_PATH = '/files/'
+
+
+def make_png(name, size=64):
+    seed = zlib.crc32(name.encode('utf-8'))
+    color = bytes(((seed >> shift) & 0xff for shift in (0, 8, 16)))
+    row = b'\x00' + color * size
+    raw = row * size
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body))
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+
+class SeahubStub(object):
+
+    def __init__(self, latency=0.0, batch_links=True):
+        self.latency = latency
+        self.batch_links = batch_links
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        self.url = ''
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, body, content_type='application/json', status=200):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                endpoint = stub.count(url.path)
+                time.sleep(stub.latency)
+                if endpoint == IMAGE_DOWNLOAD_LINK_PATH:
+                    image_name = parse_qs(url.query).get('image_name', [''])[0]
+                    self.reply({'download_link': f'{stub.url}{FILES_PATH}{image_name}'})
+                elif endpoint in (FILES_PATH, DOWNLOAD_IMAGE_PATH):
+                    self.reply(make_png(unquote(url.path.rsplit('/', 1)[-1])), 'image/png')
+                else:
+                    self.reply({'error_msg': 'Not found.'}, status=404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                endpoint = stub.count(url.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                time.sleep(stub.latency)
+                if endpoint == IMAGE_DOWNLOAD_LINKS_PATH and stub.batch_links:
+                    image_names = json.loads(body).get('image_names', [])
+                    self.reply({'download_links': {
+                        image_name: f'{stub.url}{FILES_PATH}{image_name}' for image_name in image_names
+                    }})
+                elif endpoint == UPLOAD_IMAGE_PATH:
+                    with stub.lock:
+                        index = stub.requests[UPLOAD_IMAGE_PATH]
+                    self.reply({'relative_path': [f'/image-uploaded-{index}.png']})
+                else:
+                    self.reply({'error_msg': 'Not found.'}, status=404)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def count(self, path):
+        endpoint = next(
+            (prefix for prefix in (IMAGE_DOWNLOAD_LINK_PATH, IMAGE_DOWNLOAD_LINKS_PATH, DOWNLOAD_IMAGE_PATH,
+                                   UPLOAD_IMAGE_PATH, FILES_PATH)
+             if path.startswith(prefix)),
+            path,
+        )
+        with self.lock:
+            self.requests[endpoint] += 1
+        return endpoint
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
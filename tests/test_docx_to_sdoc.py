@@ -0,0 +1,58 @@
+import os
+import unittest
+from io import BytesIO
+
+import docx
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls
+
+os.environ.setdefault(
+    'SDOC_SERVER_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+)
+
+from seadoc_converter.converter.sdoc_converter.docx2sdoc import docx2sdoc, parse_numbering
+from tests.fixtures import DOC_UUID
+
+
+class TestDocxToSdoc(unittest.TestCase):
+
+    def test_docx2sdoc_list_types_from_numbering(self):
+        numbering = parse_xml(f"""<w:numbering {nsdecls('w')}>
+            <w:abstractNum w:abstractNumId="0">
+                <w:lvl w:ilvl="0"><w:numFmt w:val="decimal"/></w:lvl>
+                <w:lvl w:ilvl="1"><w:numFmt w:val="bullet"/></w:lvl>
+            </w:abstractNum>
+            <w:abstractNum w:abstractNumId="1"><w:lvl w:ilvl="0"><w:numFmt w:val="upperRoman"/></w:lvl></w:abstractNum>
+            <w:num w:numId="1"><w:abstractNumId w:val="0"/></w:num>
+            <w:num w:numId="1"><w:abstractNumId w:val="1"/></w:num>
+            <w:num w:numId="2"><w:abstractNumId w:val="1"/></w:num>
+            <w:num w:numId="3"><w:abstractNumId w:val="7"/></w:num>
+        </w:numbering>""")
+        self.assertEqual(parse_numbering(numbering), {
+            ('1', '0'): 'decimal',
+            ('1', '1'): 'bullet',
+            ('2', '0'): 'upperRoman',
+        })
+
+        document = docx.Document()
+        for num_id, ilvl in ((1, 0), (1, 1), (2, 0), (3, 0)):
+            paragraph = document.add_paragraph(f'{num_id}.{ilvl}', style='List Number')
+            num_pr = paragraph._p.get_or_add_pPr().get_or_add_numPr()
+            num_pr.get_or_add_numId().val = num_id
+            num_pr.get_or_add_ilvl().val = ilvl
+        numbering_part = document.part.numbering_part
+        numbering_part._element = numbering
+        docx_file = BytesIO()
+        document.save(docx_file)
+
+        sdoc, _ = docx2sdoc(docx_file.getvalue(), 'user@example.com', DOC_UUID)
+        first_list, second_list, third_list = sdoc['elements']
+        self.assertEqual([first_list['type'], second_list['type'], third_list['type']],
+                         ['ordered_list', 'ordered_list', 'unordered_list'])
+        nested_list = first_list['children'][0]['children'][1]
+        self.assertEqual(nested_list['type'], 'unordered_list')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import unittest
+from io import BytesIO
+from unittest.mock import patch
+
+import docx
+import requests
+
+os.environ.setdefault(
+    'SDOC_SERVER_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+)
+
+from seadoc_converter.converter import utils
+from seadoc_converter.converter.docx_converter import sdoc2docx
+from tests.fixtures import DOC_UUID, image_doc
+from tests.seahub_stub import SeahubStub, IMAGE_DOWNLOAD_LINK_PATH, IMAGE_DOWNLOAD_LINKS_PATH, FILES_PATH
+
+
+class TestImageDownloads(unittest.TestCase):
+
+    def test_sdoc2docx_resolves_image_links_at_once(self):
+        doc = image_doc(['/a.png', '/b.png', '/a.png'])
+
+        for batch_links in (True, False):
+            stub = SeahubStub(batch_links=batch_links).start()
+            try:
+                with patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', stub.url):
+                    docx_content = sdoc2docx(doc, DOC_UUID, 'user@example.com')
+            finally:
+                stub.stop()
+                utils.IMAGE_LINK_CACHE.clear()
+
+            self.assertEqual(len(docx.Document(BytesIO(docx_content)).inline_shapes), 3)
+            self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINKS_PATH], 1)
+            self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINK_PATH], 0 if batch_links else 2)
+            self.assertEqual(stub.requests[FILES_PATH], 2)
+
+    def test_download_image_of_other_site(self):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'png'
+        response.headers['Content-Type'] = 'image/png'
+
+        with patch('seadoc_converter.converter.utils.get_image_content_url',
+                   return_value='https://seahub.example.com/files/c.png') as mock_get_image_content_url, \
+                patch('seadoc_converter.converter.utils.requests.get', return_value=response) as mock_get:
+            # looked up in Seahub by name by default
+            self.assertEqual(utils.download_image('http://10.0.0.1/c.png', DOC_UUID), (b'png', 'image/png'))
+            mock_get_image_content_url.assert_called_once_with(DOC_UUID, 'c.png')
+            self.assertEqual(mock_get.call_args[0][0], 'https://seahub.example.com/files/c.png')
+
+            mock_get.reset_mock()
+            with patch.object(utils, 'IMAGE_DOWNLOAD_EXTERNAL', True), \
+                    self.assertLogs(utils.logger, 'WARNING'):
+                for image_src in ('http://10.0.0.1/c.png', 'http://127.0.0.1:8000/c.png', 'http://[::1]/c.png'):
+                    self.assertIsNone(utils.download_image(image_src, DOC_UUID))
+            mock_get.assert_not_called()
+
+    @patch('seadoc_converter.converter.utils.requests.get', side_effect=requests.Timeout('timed out'))
+    def test_image_link_request_times_out(self, mock_get):
+        utils.IMAGE_LINK_CACHE.clear()
+
+        with self.assertLogs(utils.logger, 'ERROR'):
+            self.assertEqual(utils.get_image_content_url(DOC_UUID, 'a.png'), '')
+        self.assertEqual(mock_get.call_args[1]['timeout'], utils.IMAGE_DOWNLOAD_TIMEOUT)
+
+    def test_unsupported_image_links_batch_is_not_asked_again(self):
+        doc = image_doc(['/a.png', '/b.png'])
+        stub = SeahubStub(batch_links=False).start()
+        try:
+            with patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', stub.url), \
+                    patch.object(utils, 'BATCH_IMAGE_LINKS_UNSUPPORTED', set()):
+                sdoc2docx(doc, DOC_UUID, 'user@example.com')
+                utils.IMAGE_LINK_CACHE.clear()
+                sdoc2docx(doc, DOC_UUID, 'user@example.com')
+                self.assertEqual(utils.BATCH_IMAGE_LINKS_UNSUPPORTED, {stub.url})
+        finally:
+            stub.stop()
+            utils.IMAGE_LINK_CACHE.clear()
+
+        self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINKS_PATH], 1)
+        self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINK_PATH], 4)
+
+    def test_image_links_are_cached(self):
+        doc = image_doc(['/a.png', '/b.png'])
+        utils.IMAGE_LINK_CACHE.clear()
+        stub = SeahubStub().start()
+        try:
+            with patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', stub.url):
+                sdoc2docx(doc, DOC_UUID, 'user@example.com')
+                sdoc2docx(doc, DOC_UUID, 'user@example.com')
+                self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINKS_PATH], 1)
+                self.assertEqual(utils.get_image_content_url(DOC_UUID, 'a.png'), f'{stub.url}{FILES_PATH}a.png')
+                self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINK_PATH], 0)
+
+                for key, (_, link) in list(utils.IMAGE_LINK_CACHE.items()):
+                    utils.IMAGE_LINK_CACHE[key] = (0, link)
+                sdoc2docx(doc, DOC_UUID, 'user@example.com')
+                self.assertEqual(stub.requests[IMAGE_DOWNLOAD_LINKS_PATH], 2)
+                self.assertEqual(stub.requests[FILES_PATH], 6)
+        finally:
+            stub.stop()
+            utils.IMAGE_LINK_CACHE.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
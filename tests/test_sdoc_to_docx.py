@@ -0,0 +1,199 @@
+import os
+import sys
+import time
+import unittest
+import tempfile
+import threading
+from copy import deepcopy
+from io import BytesIO
+from zipfile import ZipFile
+from unittest.mock import patch
+
+import docx
+import requests
+from docx.image.image import Image
+
+os.environ.setdefault(
+    'SDOC_SERVER_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+)
+
+from seadoc_converter.converter import docx_converter, utils
+from seadoc_converter.converter.docx_converter import sdoc2docx
+from tests.fixtures import DOC_UUID, image_doc
+from tests.seahub_stub import make_png
+
+
+class TestSdocToDocx(unittest.TestCase):
+
+    @patch('seadoc_converter.converter.utils.get_image_content_urls', return_value=None)
+    def test_sdoc2docx_downloads_each_image_once(self, mock_get_image_content_urls):
+        doc = image_doc(['/a.png', '/b.png', '/a.png', '/missing.png'])
+        downloaded = []
+        active = [0, 0]
+        lock = threading.Lock()
+
+        def download_image(image_src, doc_uuid, download_link=None):
+            with lock:
+                downloaded.append(image_src)
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            if image_src == '/missing.png':
+                return None
+            return make_png(image_src), 'image/png'
+
+        with patch('seadoc_converter.converter.utils.download_image', side_effect=download_image):
+            docx_content = sdoc2docx(doc, DOC_UUID, 'user@example.com')
+
+        self.assertEqual(sorted(downloaded), ['/a.png', '/b.png', '/missing.png'])
+        self.assertGreater(active[1], 1)
+        self.assertEqual(len(docx.Document(BytesIO(docx_content)).inline_shapes), 3)
+
+    def test_new_document_clones_cached_template(self):
+        docx_converter.load_docx_template.cache_clear()
+        first = docx_converter.new_document()
+        first.add_paragraph('only in the first')
+        second = docx_converter.new_document()
+        self.assertEqual([p.text for p in second.paragraphs], [])
+        self.assertEqual(docx_converter.load_docx_template.cache_info().misses, 1)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            template_path = os.path.join(tmp_dir, 'template.docx')
+            template = docx.Document()
+            template.add_paragraph('letterhead')
+            template.save(template_path)
+
+            doc = {'elements': [{'id': 'p', 'type': 'paragraph', 'children': [{'id': 't', 'text': 'body'}]}]}
+            for _ in range(2):
+                docx_content = sdoc2docx(doc, DOC_UUID, 'user@example.com', template_path=template_path)
+                paragraphs = docx.Document(BytesIO(docx_content)).paragraphs
+                self.assertEqual([p.text for p in paragraphs], ['letterhead', 'body'])
+            self.assertEqual(docx_converter.load_docx_template.cache_info().misses, 2)
+
+    def test_sdoc2docx_nested_list_levels(self):
+        def sdoc_list(list_type, texts, nested=None):
+            items = [{'type': 'list_item', 'children': [{'type': 'paragraph', 'children': [{'text': text}]}]}
+                     for text in texts]
+            if nested:
+                items[0]['children'].append(nested)
+            return {'type': list_type, 'children': items}
+
+        doc = {'elements': [
+            sdoc_list('ordered_list', ['1', '2'], sdoc_list('unordered_list', ['1.a'], sdoc_list(
+                'ordered_list', ['1.a.i'], sdoc_list('unordered_list', ['1.a.i.x'])))),
+        ]}
+        paragraphs = docx.Document(BytesIO(sdoc2docx(doc, DOC_UUID, 'user@example.com'))).paragraphs
+        self.assertEqual([(p.text, p.style.name) for p in paragraphs], [
+            ('1', 'List Number'),
+            ('1.a', 'List Bullet 2'),
+            ('1.a.i', 'List Number 3'),
+            ('1.a.i.x', 'List Bullet 3'),
+            ('2', 'List Number'),
+        ])
+
+        nested = None
+        for level in range(sys.getrecursionlimit()):
+            nested = sdoc_list('unordered_list', [str(level)], nested)
+        blocks = list(docx_converter.iter_docx_blocks([nested]))
+        self.assertEqual(len(blocks), sys.getrecursionlimit())
+        self.assertEqual(blocks[0][0], 'unordered_list')
+        self.assertEqual(blocks[-1][0], 'unordered_list_3')
+
+    def test_sdoc2docx_to_spooled_file_and_multipart_body(self):
+        doc = image_doc([])
+        doc['elements'].append({'type': 'paragraph', 'children': [{'text': 'body'}]})
+        with tempfile.SpooledTemporaryFile(max_size=1024) as docx_file:
+            self.assertIsNone(sdoc2docx(doc, DOC_UUID, 'user@example.com', output=docx_file))
+            self.assertTrue(docx_file._rolled)
+            docx_file.seek(0)
+            self.assertEqual([p.text for p in docx.Document(docx_file).paragraphs], ['body'])
+
+            docx_file.seek(0)
+            files = {'file': ('a b.docx', docx_file), 'parent_dir': '/dir'}
+            body = utils.MultipartBody(files)
+            data = b''.join(body)
+            self.assertEqual(len(data), len(body))
+
+            docx_file.seek(0)
+            files['file'] = ('a b.docx', docx_file.read())
+            boundary = body.content_type.split('boundary=')[1]
+            with patch('urllib3.filepost.choose_boundary', return_value=boundary):
+                prepared = requests.Request('POST', 'http://127.0.0.1/', files=files).prepare()
+            self.assertEqual(data, prepared.body)
+            self.assertEqual(body.content_type, prepared.headers['Content-Type'])
+
+    def test_sdoc2docx_interns_run_formatting_as_styles(self):
+        texts = [
+            {'text': 'plain '},
+            {'text': 'bold ', 'bold': True},
+            {'text': 'red ', 'color': '#e03e2d', 'font': 'Arial', 'font_size': 14},
+            {'text': 'bold again', 'bold': True},
+        ]
+        doc = {'elements': [
+            {'type': 'paragraph', 'children': deepcopy(texts)},
+            {'type': 'header1', 'children': deepcopy(texts)},
+        ]}
+        document = docx.Document(BytesIO(sdoc2docx(doc, DOC_UUID, 'user@example.com')))
+        paragraph, header = document.paragraphs
+
+        self.assertEqual([run.style.name for run in paragraph.runs],
+                         ['Default Paragraph Font', 'Sdoc Bold', 'Sdoc E03E2D Arial 14pt', 'Sdoc Bold'])
+        self.assertEqual([run.bold for run in paragraph.runs], [None] * 4)
+        red = paragraph.runs[2].style.font
+        self.assertEqual((str(red.color.rgb), red.name, red.size.pt), ('E03E2D', 'Arial', 14))
+
+        # bold would cancel out the bold of the heading style, so it stays on the runs
+        self.assertEqual([run.bold for run in header.runs], [False, True, False, True])
+        self.assertEqual([run.style.name for run in header.runs],
+                         ['Default Paragraph Font', 'Default Paragraph Font', 'Sdoc E03E2D Arial 14pt',
+                          'Default Paragraph Font'])
+
+    def test_sdoc2docx_embeds_each_image_once(self):
+        doc = image_doc(['/logo.png', '/icon.png', '/logo.png', '/logo-copy.png', '/logo.png'])
+        images = {
+            '/logo.png': (make_png('logo'), 'image/png'),
+            '/logo-copy.png': (make_png('logo'), 'image/png'),
+            '/icon.png': (make_png('icon'), 'image/png'),
+        }
+        with patch('seadoc_converter.converter.docx_converter.download_images', return_value=images), \
+                patch('docx.image.image.Image.from_file', wraps=Image.from_file) as from_file:
+            docx_content = sdoc2docx(doc, DOC_UUID, 'user@example.com')
+        self.assertEqual(from_file.call_count, 3)
+
+        with ZipFile(BytesIO(docx_content)) as docx_zip:
+            self.assertEqual(len([name for name in docx_zip.namelist() if name.startswith('word/media/')]), 2)
+        document = docx.Document(BytesIO(docx_content))
+        shapes = document.inline_shapes
+        self.assertEqual(len(shapes), 5)
+        r_ids = [shape._inline.graphic.graphicData.pic.blipFill.blip.embed for shape in shapes]
+        self.assertEqual(len(set(r_ids)), 2)
+        self.assertEqual(r_ids[0], r_ids[3])
+        shape_ids = document.element.body.xpath('.//wp:docPr/@id')
+        self.assertEqual(len(set(shape_ids)), 5)
+
+    def test_sdoc2docx_table_merged_cells(self):
+        def cell(text='', bold=False, **span):
+            return {'type': 'table_cell', 'children': [{'text': text, 'bold': bold}], **span}
+
+        combined = {'is_combined': True}
+        doc = {'elements': [{'type': 'table', 'children': [
+            {'type': 'table_row', 'children': [cell('a', rowspan=2, colspan=2), cell(**combined), cell('c')]},
+            {'type': 'table_row', 'children': [cell(**combined), cell(**combined), cell('d\te', bold=True)]},
+            {'type': 'table_row', 'children': [cell('f'), cell('g', colspan=2), cell(**combined)]},
+        ]}]}
+        table = docx.Document(BytesIO(sdoc2docx(doc, DOC_UUID, 'user@example.com'))).tables[0]
+
+        self.assertEqual([[cell.text for cell in row.cells] for row in table.rows],
+                         [['a', 'a', 'c'], ['a', 'a', 'd\te'], ['f', 'g', 'g']])
+        self.assertEqual([len(row._tr.tc_lst) for row in table.rows], [2, 2, 2])
+        first, second = table.rows[0]._tr.tc_lst[0], table.rows[1]._tr.tc_lst[0]
+        self.assertEqual((first.grid_span, first.vMerge), (2, 'restart'))
+        self.assertEqual((second.grid_span, second.vMerge), (2, 'continue'))
+        self.assertEqual(table.rows[1].cells[2].paragraphs[0].runs[0].style.name, 'Sdoc Bold')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import os
+import sys
 import json
+import time
 import unittest
+import threading
+import itertools
 from copy import deepcopy
 from unittest.mock import patch
 
@@ -10,10 +14,10 @@ os.environ.setdefault(
 )
 
 from seadoc_converter.converter import html_converter
+from tests.fixtures import DOC_UUID, image_doc
 
 
 FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'test.sdoc')
-DOC_UUID = 'test-doc-uuid'
 PUBLISH_URL = 'published-page'
 
 
@@ -92,6 +96,39 @@ class TestSdocToHtml(unittest.TestCase):
         self.assertIn('grid-template-columns: 209px 209px 209px 209px;', html)
         self.assertIn('grid-auto-rows: minmax(42px, auto) minmax(42px, auto);', html)
 
+    @patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', 'https://example.com/')
+    def test_render_table_passes_positions_and_publish_url_to_cells(self):
+        table = {
+            'id': 'table-id',
+            'type': 'table',
+            'columns': [{'width': 100}, {'width': 100}],
+            'children': [{
+                'id': f'row-{row}',
+                'type': 'table_row',
+                'children': [{
+                    'id': f'cell-{row}-{col}',
+                    'type': 'table_cell',
+                    'children': [{
+                        'id': f'link-{row}-{col}',
+                        'type': 'link',
+                        'href': '',
+                        'title': 'page',
+                        'linked_wiki_page_id': f'page-{row}-{col}',
+                        'children': [{'id': f'text-{row}-{col}', 'text': 'page'}],
+                    }],
+                } for col in range(2)],
+            } for row in range(2)],
+        }
+        cells = [cell for row in table['children'] for cell in row['children']]
+
+        with patch.object(html_converter.render_table_cell, 'visit', wraps=html_converter.render_table_cell.visit) as visit:
+            html = html_converter.render_table(table, publish_url=PUBLISH_URL)
+
+        self.assertEqual([call.args[0] for call in visit.call_args_list], cells)
+        self.assertTrue(all(call.args[0] is cell for call, cell in zip(visit.call_args_list, cells)))
+        self.assertIn('grid-area: 2 / 2 / span 1 / span 1;', html)
+        self.assertIn('href="https://example.com/wiki/publish/published-page/page-1-1"', html)
+
     def test_render_column_and_multi_column(self):
         column_html = html_converter.render_column(self.get_node_by_id('Y3_oAv3bTXiMf9yr1wbJ9g'))
         multi_column_html = html_converter.render_multi_column(self.get_node_by_id('c3bI4ot9T9aedqz4-Ns2Iw'))
@@ -124,8 +161,57 @@ class TestSdocToHtml(unittest.TestCase):
         self.assertIn('code 1', html)
         self.assertIn('code 3', html)
 
-    @patch('seadoc_converter.converter.html_converter.trans_video_path_to_url', return_value='https://example.com/video.mov')
-    def test_render_video(self, mock_trans_video_path_to_url):
+    @staticmethod
+    def _code_block(lines, language='python'):
+        return {'id': 'code-id', 'type': 'code_block', 'language': language, 'children': [
+            {'id': f'line-{index}', 'type': 'code_line', 'children': [{'id': f'text-{index}', 'text': line}]}
+            for index, line in enumerate(lines)
+        ]}
+
+    def test_highlight_code_block_in_one_piece(self):
+        code_block = self._code_block(['', 'def f(x):', '', '    return x', 'f(1)', ''])
+        highlighted_lines, complete = html_converter.highlight_code_block_lines(code_block)
+        self.assertTrue(complete)
+        self.assertEqual(len(highlighted_lines), 6)
+        self.assertIn('pg-k', highlighted_lines[1])
+
+        # a string spanning lines does not leak into the lines after it
+        lines = [f'x_{index} = {index}' for index in range(600)]
+        lines[495:505] = ['s = """'] + ['text'] * 8 + ['"""']
+        highlighted_lines, _ = html_converter.highlight_code_block_lines(self._code_block(lines))
+        self.assertEqual(len(highlighted_lines), 600)
+        self.assertIn('pg-s2', highlighted_lines[500])
+        self.assertIn('<span class="pg-n">x_550</span>', highlighted_lines[550])
+
+    def test_highlight_code_block_limits(self):
+        code_block = self._code_block([f'x_{index} = {index}' for index in range(6)])
+
+        with patch.object(html_converter, 'CODE_HIGHLIGHT_MAX_LINES', 4):
+            highlighted_lines, complete = html_converter.highlight_code_block_lines(code_block)
+            self.assertEqual((len(highlighted_lines), complete), (4, True))
+        with patch.object(html_converter, 'CODE_HIGHLIGHT_MAX_BYTES', 20):
+            highlighted_lines, complete = html_converter.highlight_code_block_lines(code_block)
+            self.assertEqual((len(highlighted_lines), complete), (2, True))
+        with patch.object(html_converter, 'CODE_HIGHLIGHT_TIME_BUDGET', -1):
+            self.assertEqual(html_converter.highlight_code_block_lines(code_block), ([], False))
+
+        highlighted_lines, _ = html_converter.highlight_code_block_lines(code_block)
+        clock = itertools.count()
+        with patch.object(html_converter, 'CODE_HIGHLIGHT_CHECK_TOKENS', 4), \
+                patch.object(html_converter.time, 'monotonic', side_effect=lambda: next(clock)):
+            partly_highlighted_lines, complete = html_converter.highlight_code_block_lines(code_block, 2.5)
+        self.assertFalse(complete)
+        self.assertEqual(partly_highlighted_lines, highlighted_lines[:len(partly_highlighted_lines)])
+        self.assertTrue(0 < len(partly_highlighted_lines) < 6)
+
+        with patch.object(html_converter, 'CODE_HIGHLIGHT_MAX_LINES', 4):
+            html = html_converter.render_code_block(code_block)
+        self.assertIn('<span class="pg-n">x_3</span>', html)
+        self.assertIn('<span data-slate-string="true">x_4 = 4</span>', html)
+        self.assertNotIn('<span class="pg-n">x_4</span>', html)
+
+    @patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', 'https://example.com/')
+    def test_render_video(self):
         local_video_html = html_converter.render_video(
             self.get_node_by_id('PP4fv0YfSmqZNH9So-yJvA'),
             doc_uuid=DOC_UUID,
@@ -133,10 +219,12 @@ class TestSdocToHtml(unittest.TestCase):
         remote_video_html = html_converter.render_video(self.get_node_by_id('aQgyZHHyS3Kk39V7Gyq_jg'))
 
         self.assertIn('<video', local_video_html)
-        self.assertIn('src="https://example.com/video.mov"', local_video_html)
+        self.assertIn(
+            'src="https://example.com/api/v2.1/seadoc/download-video/test-doc-uuid/video-IbjwV-N0Sxmim6R0qrNcKw.mov"',
+            local_video_html,
+        )
         self.assertIn('<iframe', remote_video_html)
         self.assertIn('player.bilibili.com/player.html?bvid=BV1XY546vE1o&amp;autoplay=0', remote_video_html)
-        mock_trans_video_path_to_url.assert_called_once_with('/video-IbjwV-N0Sxmim6R0qrNcKw.mov', DOC_UUID)
 
     def test_render_check_list(self):
         checked_html = html_converter.render_check_list(self.get_node_by_id('M57TxsgiR7KNDxQvQN1eEQ'))
@@ -191,8 +279,8 @@ class TestSdocToHtml(unittest.TestCase):
         self.assertIn('class="sdoc-embed-link-element seatable"', html)
         self.assertIn('https://dev.seatable.cn/workspace/', html)
 
-    @patch('seadoc_converter.converter.html_converter.trans_wiki_page_id_to_url', return_value='https://example.com/wiki/YdoF')
-    def test_render_link(self, mock_trans_wiki_page_id_to_url):
+    @patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', 'https://example.com/')
+    def test_render_link(self):
         link_node = self.get_node_by_id('JHp4EBztRNqxonur3_JtfA')
         linked_block_node = deepcopy(link_node)
         linked_block_node['href'] = ''
@@ -207,8 +295,7 @@ class TestSdocToHtml(unittest.TestCase):
 
         self.assertIn('href="https://seafile.com"', href_html)
         self.assertIn('data-link-block-id="linked-block-id"', block_html)
-        self.assertIn('class="sdoc-link-page" href="https://example.com/wiki/YdoF"', wiki_html)
-        mock_trans_wiki_page_id_to_url.assert_called_once_with(PUBLISH_URL, 'YdoF')
+        self.assertIn('class="sdoc-link-page" href="https://example.com/wiki/publish/published-page/YdoF"', wiki_html)
 
     def test_render_file_link(self):
         html = html_converter.render_file_link({
@@ -241,8 +328,8 @@ class TestSdocToHtml(unittest.TestCase):
         self.assertIn('/wiki/publish/published-page/page-id/', html)
         self.assertIn('Wiki page', html)
 
-    @patch('seadoc_converter.converter.html_converter.trans_img_path_to_url', return_value='https://example.com/image.png')
-    def test_render_image(self, mock_trans_img_path_to_url):
+    @patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', 'https://example.com/')
+    def test_render_image(self):
         html = html_converter.render_image(
             self.get_node_by_id('fV-_QGi4RwOmWiWNzsCLRQ'),
             doc_uuid=DOC_UUID,
@@ -251,8 +338,10 @@ class TestSdocToHtml(unittest.TestCase):
 
         self.assertIn('data-id="fV-_QGi4RwOmWiWNzsCLRQ"', html)
         self.assertIn('data-parent-id="image-block-id"', html)
-        self.assertIn('src="https://example.com/image.png"', html)
-        mock_trans_img_path_to_url.assert_called_once_with('/image-J10ano3ZQV6R0cbAehCKKw.png', DOC_UUID)
+        self.assertIn(
+            'src="https://example.com/api/v2.1/seadoc/download-image/test-doc-uuid/image-J10ano3ZQV6R0cbAehCKKw.png"',
+            html,
+        )
 
     def test_render_text(self):
         html = html_converter.render_text(self.get_node_by_id('dncBr5o8RwiAaqd4uwfL1A'))
@@ -273,6 +362,373 @@ class TestSdocToHtml(unittest.TestCase):
         self.assertIn('class="sdoc-code-block-container sdoc-drag-cover"', html)
         self.assertIn('class="sdoc-callout-white-wrapper"', html)
 
+    def test_render_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        node = {'id': 'leaf', 'type': 'paragraph', 'children': [{'id': 'leaf-text', 'text': 'deepest'}]}
+        for level in range(depth):
+            node = {'id': f'block-{level}', 'type': 'image_block', 'children': [node]}
+
+        html = html_converter.sdoc2html({'elements': [node]})
+
+        self.assertIn('deepest', html)
+        self.assertEqual(html, html_converter.render_node(node))
+
+    def test_render_nested_lists_in_order(self):
+        node = {'id': 'leaf', 'type': 'paragraph', 'children': [{'id': 'leaf-text', 'text': 'item leaf'}]}
+        for level in range(20):
+            node = {'id': f'ul-{level}', 'type': 'unordered_list', 'children': [{
+                'id': f'li-{level}',
+                'type': 'list_item',
+                'children': [
+                    {'id': f'p-{level}', 'type': 'paragraph', 'children': [{'id': f't-{level}', 'text': f'item {level}'}]},
+                    node,
+                ],
+            }]}
+
+        html = html_converter.render_unordered_list(node)
+
+        positions = [html.index(f'>item {level}<') for level in reversed(range(20))]
+        self.assertEqual(positions, sorted(positions))
+        self.assertLess(positions[-1], html.index('>item leaf<'))
+        self.assertEqual(html.count('<ul'), 20)
+
+    def test_template_render_at_level(self):
+        template = html_converter.HtmlTemplate("""
+    <p data-id="{ele_id}" class="{class_name}">
+        {text}
+        <span>{text}</span>
+        {children_html}
+    </p>
+    """)
+        values = ['', 'plain', '  ', 'two\nlines', 'nbsp\xa0\nbreak', 'line\u2028separator\n\n']
+        children = ['', '<b>child</b>', '\n<i>child</i>\n']
+        for value in values:
+            for child in children:
+                plain = template.render(ele_id='x', class_name=value, text=value, children_html=child)
+                for level in (1, 3):
+                    indent = html_converter.INDENT * level
+                    self.assertEqual(
+                        template.render(level, ele_id='x', class_name=value, text=value,
+                                        children_html=html_converter.indent_html(child, indent)),
+                        html_converter.indent_html(plain, indent),
+                    )
+
+    def test_join_html_at_level(self):
+        parts = ['\n<p>\n', 'text', ' tail\n', '<b>bold</b>', '', '   ', '<i>\n</i>', '\n']
+        for level in (1, 2):
+            indent = html_converter.INDENT * level
+            self.assertEqual(
+                html_converter.join_html([html_converter.indent_html(part, indent) for part in parts], level),
+                html_converter.indent_html(''.join(parts), indent),
+            )
+
+    def test_render_deep_nested_lists(self):
+        node = {'id': 'leaf', 'type': 'paragraph', 'children': [{'id': 'leaf-text', 'text': 'item leaf'}]}
+        for level in range(60):
+            node = {'id': f'ul-{level}', 'type': 'unordered_list', 'children': [{
+                'id': f'li-{level}', 'type': 'list_item', 'children': [node],
+            }]}
+
+        html = html_converter.sdoc2html({'elements': [node]})
+        leaf_line = next(line for line in html.splitlines() if 'item leaf' in line)
+        shallow = html_converter.sdoc2html({'elements': [node['children'][0]['children'][0]]})
+        shallow_line = next(line for line in shallow.splitlines() if 'item leaf' in line)
+
+        self.assertEqual(len(leaf_line) - len(shallow_line), 2 * len(html_converter.INDENT))
+
+    def test_sdoc2html_renders_only_changed_elements(self):
+        doc = {'elements': [
+            {'id': f'p-{index}', 'type': 'paragraph', 'children': [{'id': f't-{index}', 'text': f'text {index}'}]}
+            for index in range(5)
+        ]}
+        edited = deepcopy(doc)
+        edited['elements'][2]['children'][0]['text'] = 'edited'
+
+        fragment_cache = html_converter.FragmentCache(1024 * 1024)
+        with patch.object(html_converter, 'HTML_FRAGMENT_CACHE', fragment_cache), \
+                patch.object(html_converter.render_text, 'visit', wraps=html_converter.render_text.visit) as render_text:
+            html = html_converter.sdoc2html(doc)
+            self.assertEqual(render_text.call_count, 5)
+            self.assertEqual(html_converter.sdoc2html(doc), html)
+            self.assertEqual(render_text.call_count, 5)
+
+            edited_html = html_converter.sdoc2html(edited)
+            self.assertEqual(render_text.call_count, 6)
+            self.assertEqual(edited_html, html_converter.sdoc2html(edited, use_cache=False))
+
+            html_converter.sdoc2html(doc, publish_url=PUBLISH_URL)
+            self.assertEqual(render_text.call_count, 16)
+
+    def test_sdoc2html_on_processes_matches_serial(self):
+        html = html_converter.sdoc2html(self.fixture, doc_uuid=DOC_UUID, use_cache=False)
+
+        with patch.object(html_converter, 'PARALLEL_RENDER_MIN_ELEMENTS', 1), \
+                patch.dict(html_converter.RENDER_POOLS, clear=True):
+            try:
+                parallel_html = html_converter.sdoc2html(self.fixture, doc_uuid=DOC_UUID, use_cache=False, processes=2)
+            finally:
+                for pool in html_converter.RENDER_POOLS.values():
+                    pool.shutdown()
+
+        self.assertEqual(parallel_html, html)
+
+    def test_fragment_cache_is_bounded(self):
+        fragment_cache = html_converter.FragmentCache(10)
+        fragment_cache.set('a', 'aaaa')
+        fragment_cache.set('b', 'bbbb')
+        fragment_cache.get('a')
+        fragment_cache.set('c', 'cccc')
+        fragment_cache.set('d', 'd' * 11)
+
+        self.assertEqual(fragment_cache.get('a'), 'aaaa')
+        self.assertIsNone(fragment_cache.get('b'))
+        self.assertEqual(fragment_cache.get('c'), 'cccc')
+        self.assertIsNone(fragment_cache.get('d'))
+        self.assertEqual(fragment_cache.size, 8)
+
+    @patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', 'https://example.com/')
+    @patch('seadoc_converter.converter.utils.IMAGE_DOWNLOAD_EXTERNAL', True)
+    def test_sdoc2html_bundle_downloads_each_image_once(self):
+        doc = image_doc(['/a.png', '/b.png', '/a.png', 'https://cdn.example.com/c.png?x=1', '/missing.png'])
+        downloaded = []
+        active = [0, 0]
+        lock = threading.Lock()
+
+        def download_image(image_src, doc_uuid, download_link=None):
+            with lock:
+                downloaded.append(image_src)
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            if image_src == '/missing.png':
+                return None
+            return image_src.encode(), 'image/png'
+
+        with patch('seadoc_converter.converter.utils.download_image', side_effect=download_image):
+            html, assets = html_converter.sdoc2html_bundle(doc, doc_uuid=DOC_UUID)
+            zip_html, zip_assets = html_converter.sdoc2html_bundle(doc, doc_uuid=DOC_UUID, inline_images=False)
+
+        self.assertEqual(sorted(downloaded), sorted(['/a.png', '/b.png', 'https://cdn.example.com/c.png?x=1',
+                                                     '/missing.png'] * 2))
+        self.assertGreater(active[1], 1)
+
+        self.assertEqual(assets, {})
+        self.assertEqual(html.count('src="data:image/png;base64,L2EucG5n"'), 2)
+        self.assertIn('src="data:image/png;base64,L2IucG5n"', html)
+        self.assertIn('src="https://example.com/api/v2.1/seadoc/download-image/test-doc-uuid/missing.png"', html)
+
+        self.assertEqual(zip_assets, {
+            'images/a.png': b'/a.png',
+            'images/b.png': b'/b.png',
+            'images/c.png': b'https://cdn.example.com/c.png?x=1',
+        })
+        self.assertEqual(zip_html.count('src="images/a.png"'), 2)
+        self.assertIn('src="images/c.png"', zip_html)
+
+    @patch('seadoc_converter.converter.utils.download_image', return_value=(b'a', 'image/png'))
+    def test_sdoc2html_bundle_leaves_external_images_linked(self, mock_download_image):
+        doc = image_doc(['/a.png', 'https://cdn.example.com/c.png'])
+
+        html, _ = html_converter.sdoc2html_bundle(doc, doc_uuid=DOC_UUID)
+
+        mock_download_image.assert_called_once_with('/a.png', DOC_UUID, None)
+        self.assertIn('src="https://cdn.example.com/c.png"', html)
+
+    def test_sdoc2html_bundle_external_assets(self):
+        doc = {'elements': [
+            {'id': 'f-1', 'type': 'formula', 'data': {'formula': 'a^2'}, 'children': []},
+            {'id': 'f-2', 'type': 'formula', 'data': {'formula': ' a^2 '}, 'children': []},
+            {'id': 'f-3', 'type': 'formula', 'data': {'formula': 'b^2'}, 'children': []},
+            self.get_node_by_type('code_block'),
+        ]}
+
+        with patch('seadoc_converter.converter.html_converter.formula_to_svg_within',
+                   side_effect=lambda formula, time_budget: f'<svg>{formula}</svg>') as mock_formula_to_svg:
+            html, assets = html_converter.sdoc2html_bundle(doc, external_assets=True)
+
+        self.assertEqual(mock_formula_to_svg.call_count, 2)
+        formula_paths = sorted(path for path in assets if path.endswith('.svg'))
+        stylesheet_paths = [path for path in assets if path.endswith('.css')]
+        self.assertEqual(len(formula_paths), 2)
+        self.assertEqual(len(stylesheet_paths), 1)
+        self.assertEqual(sorted(assets[path] for path in formula_paths), ['<svg>a^2</svg>', '<svg>b^2</svg>'])
+        self.assertIn('.sdoc-code-block-code .pg-', assets[stylesheet_paths[0]])
+
+        a_path = next(path for path in formula_paths if assets[path] == '<svg>a^2</svg>')
+        self.assertEqual(html.count(f'<img class="sdoc-formula-image" src="{a_path}" alt="a^2">'), 2)
+        self.assertTrue(html.startswith(f'<link rel="stylesheet" href="{stylesheet_paths[0]}">'))
+        self.assertNotIn('<svg', html)
+
+    def test_sdoc2html_after_deadline_renders_source_text(self):
+        doc = {'elements': [
+            self.get_node_by_type('paragraph'),
+            {'id': 'f-1', 'type': 'formula', 'data': {'formula': 'a < b'}, 'children': []},
+            self._code_block(['x = 1', 'y = 2']),
+        ]}
+        options = html_converter.RenderOptions(deadline=0)
+        fragment_cache = html_converter.FragmentCache(1024 * 1024)
+
+        with patch.dict(html_converter.RENDER_FALLBACKS, clear=True), \
+                self.assertLogs(html_converter.logger, 'WARNING') as logs:
+            html = html_converter.render_iteratively(
+                html_converter.visit_elements(doc['elements'], options, fragment_cache=fragment_cache))
+            fallbacks = dict(html_converter.RENDER_FALLBACKS)
+
+        self.assertEqual(html.count('class="sdoc-render-fallback"'), 3)
+        self.assertIn('<div data-id="f-1" class="sdoc-render-fallback">a &lt; b</div>', html)
+        self.assertIn('<div data-id="code-id" class="sdoc-render-fallback">x = 1<br>y = 2</div>', html)
+        self.assertEqual(fallbacks, {
+            ('paragraph', 'export deadline'): 1,
+            ('formula', 'export deadline'): 1,
+            ('code_block', 'export deadline'): 1,
+        })
+        self.assertEqual(len(fragment_cache), 0)
+        self.assertIn('rendered formula f-1 of document  as text: export deadline', logs.output[1])
+
+    def test_partly_highlighted_code_block_is_not_cached(self):
+        elements = [self._code_block(['x = 1', 'y = 2']), self.get_node_by_type('paragraph')]
+        options = html_converter.RenderOptions(node_time_budget=0.001)
+        fragment_cache = html_converter.FragmentCache(1024 * 1024)
+
+        with patch.object(html_converter, 'CODE_HIGHLIGHT_TIME_BUDGET', -1):
+            html = html_converter.render_iteratively(
+                html_converter.visit_elements(elements, options, fragment_cache=fragment_cache))
+
+        self.assertIn('<span data-slate-string="true">x = 1</span>', html)
+        self.assertEqual(options.incomplete_ids, {'code-id'})
+        self.assertEqual(len(fragment_cache), 1)
+        self.assertIsNone(fragment_cache.get(html_converter.fragment_key(elements[0], options)))
+
+    def test_slow_formula_renders_source_text(self):
+        slow_formula = ' + '.join(f'\\frac{{a_{{{index}}}}}{{b_{{{index}}}}}' for index in range(200))
+        formula = {'id': 'f-1', 'type': 'formula', 'data': {'formula': slow_formula}, 'children': []}
+
+        with patch.object(html_converter, 'HTML_NODE_TIME_BUDGET', 0.01), \
+                patch.object(html_converter, 'SLOW_FORMULAS', html_converter.OrderedDict()), \
+                self.assertLogs(html_converter.logger, 'WARNING'):
+            html = html_converter.sdoc2html({'elements': [formula]}, use_cache=False)
+            with patch.object(html_converter, 'formula_to_svg_in_worker') as mock_formula_to_svg_in_worker:
+                self.assertEqual(html_converter.sdoc2html({'elements': [formula]}, use_cache=False), html)
+
+        mock_formula_to_svg_in_worker.assert_not_called()
+        self.assertIn('<div data-id="f-1" class="sdoc-render-fallback">\\frac{a_{0}}{b_{0}}', html)
+        self.assertNotIn('<svg', html)
+
+    def test_formula_renders_in_process_without_node_time_budget(self):
+        formula = {'id': 'f-1', 'type': 'formula', 'data': {'formula': 'a^2'}, 'children': []}
+
+        with patch.object(html_converter, 'HTML_NODE_TIME_BUDGET', 0), \
+                patch.object(html_converter, 'FormulaWorker') as mock_formula_worker:
+            html = html_converter.sdoc2html({'elements': [formula]}, use_cache=False)
+
+        mock_formula_worker.assert_not_called()
+        self.assertIn('<svg', html)
+
+    def test_formula_worker_failure_renders_source_text(self):
+        formula = {'id': 'f-1', 'type': 'formula', 'data': {'formula': 'a < b'}, 'children': []}
+
+        with patch.object(html_converter, 'HTML_NODE_TIME_BUDGET', 5), \
+                patch.object(html_converter, 'FORMULA_WORKERS', []), \
+                patch.object(html_converter, 'FormulaWorker', side_effect=EOFError), \
+                self.assertLogs(html_converter.logger, 'ERROR'):
+            html = html_converter.sdoc2html({'elements': [formula]}, use_cache=False)
+
+        self.assertIn('<span>a &lt; b</span>', html)
+        self.assertNotIn('<svg', html)
+
+    def test_formula_renders_in_worker_within_budget(self):
+        formula = {'id': 'f-1', 'type': 'formula', 'data': {'formula': 'a^2'}, 'children': []}
+
+        with patch.object(html_converter, 'HTML_NODE_TIME_BUDGET', 60):
+            html = html_converter.sdoc2html({'elements': [formula]}, use_cache=False)
+
+        self.assertIn('<svg', html)
+        self.assertNotIn('sdoc-render-fallback', html)
+
+    def test_sdoc2html_preview_stops_at_budget(self):
+        elements = [
+            {'id': f'p-{index}', 'type': 'paragraph', 'children': [{'id': f't-{index}', 'text': 'x' * 10}]}
+            for index in range(5)
+        ]
+        # the tail is never decoded
+        sdoc_str = '{"version": 1, "elements": [%s, {"broken' % ', '.join(json.dumps(element) for element in elements)
+
+        html = html_converter.sdoc2html_preview(sdoc_str, max_blocks=2)
+        self.assertEqual(html, html_converter.sdoc2html({'elements': elements[:2]}, use_cache=False))
+
+        html = html_converter.sdoc2html_preview(sdoc_str, max_chars=25)
+        self.assertEqual(html, html_converter.sdoc2html({'elements': elements[:3]}, use_cache=False))
+
+        first_size = len(html_converter.sdoc2html({'elements': elements[:1]}, use_cache=False).encode())
+        html = html_converter.sdoc2html_preview(sdoc_str, max_bytes=first_size + 1)
+        self.assertEqual(html, html_converter.sdoc2html({'elements': elements[:2]}, use_cache=False))
+
+        self.assertEqual(
+            html_converter.sdoc2html_preview(json.dumps({'elements': [], 'children': elements}), max_blocks=1),
+            html_converter.sdoc2html({'elements': elements[:1]}, use_cache=False),
+        )
+
+    def test_sdoc2html_pages(self):
+        def header(header_type, text):
+            return {'id': f'{header_type}-{text}', 'type': header_type, 'children': [{'id': f't-{text}', 'text': text}]}
+
+        paragraph = self.get_node_by_type('paragraph')
+        elements = [
+            paragraph,
+            header('header1', 'Intro'), paragraph, header('header2', 'Details'), paragraph,
+            header('header1', 'Usage <b>'), paragraph,
+        ]
+
+        self.assertEqual(html_converter.split_pages(elements), [(0, 1), (1, 5), (5, 7)])
+        self.assertEqual(html_converter.split_pages(elements, page_header_level=2), [(0, 1), (1, 3), (3, 5), (5, 7)])
+        self.assertEqual(html_converter.split_pages(elements, max_page_blocks=2), [(0, 1), (1, 3), (3, 5), (5, 7)])
+
+        files = html_converter.sdoc2html_pages({'elements': elements}, 'my doc', doc_uuid=DOC_UUID)
+        self.assertEqual(list(files), ['my doc-1.html', 'my doc-2.html', 'my doc-3.html', 'my doc.html'])
+
+        toc = files['my doc.html']
+        self.assertIn('<li><a href="my%20doc-1.html">my doc (1)</a></li>', toc)
+        self.assertIn('<li><a href="my%20doc-2.html">Intro</a></li>', toc)
+        self.assertIn('<li><a href="my%20doc-3.html">Usage &lt;b&gt;</a></li>', toc)
+
+        page = files['my doc-2.html']
+        self.assertIn('<title>Intro</title>', page)
+        self.assertEqual(page.count('<a class="sdoc-page-prev" href="my%20doc-1.html">my doc (1)</a>'), 2)
+        self.assertEqual(page.count('<a class="sdoc-page-next" href="my%20doc-3.html">Usage &lt;b&gt;</a>'), 2)
+        self.assertIn('data-id="header2-Details"', page)
+        self.assertNotIn('data-id="header1-Usage', page)
+        self.assertNotIn('sdoc-page-next', files['my doc-3.html'])
+
+    def test_sdoc2html_profile(self):
+        doc = {'elements': [
+            {'id': f'p-{index}', 'type': 'paragraph', 'children': [
+                {'id': f't-{index}', 'text': 'text'},
+                {'id': f'l-{index}', 'type': 'link', 'href': 'https://example.com', 'title': 'link', 'children': [
+                    {'id': f'lt-{index}', 'text': 'link'},
+                ]},
+            ]}
+            for index in range(2)
+        ]}
+        profile = html_converter.RenderProfile()
+
+        html = html_converter.sdoc2html(doc, profile=profile)
+
+        self.assertEqual(html, html_converter.sdoc2html(doc, use_cache=False))
+        stats = profile.as_dict()
+        self.assertEqual({node_type: stat['calls'] for node_type, stat in stats.items()},
+                         {'paragraph': 2, 'link': 2, 'text': 4})
+        self.assertEqual(stats['paragraph']['bytes'], len(html.encode('utf-8')))
+        self.assertLess(stats['link']['bytes'], stats['paragraph']['bytes'])
+        for stat in stats.values():
+            self.assertLessEqual(stat['self'], stat['cumulative'])
+        self.assertLessEqual(stats['link']['cumulative'], stats['paragraph']['cumulative'])
+
+        node_profile = html_converter.RenderProfile()
+        html_converter.render_node(doc['elements'][0], profile=node_profile)
+        self.assertEqual(node_profile.as_dict()['paragraph']['calls'], 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+import os
+import unittest
+from unittest.mock import patch
+
+os.environ.setdefault(
+    'SDOC_SERVER_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+)
+
+from seadoc_converter.converter.markdown_converter import sdoc2md, sdoc2md_bundle
+from tests.fixtures import DOC_UUID, image_doc
+
+
+class TestSdocToMd(unittest.TestCase):
+
+    def test_sdoc2md(self):
+        def text(value, **marks):
+            return dict(text=value, **marks)
+
+        def link(value, href):
+            return {'type': 'link', 'href': href, 'children': [text(value)]}
+
+        def paragraph(*children):
+            return {'type': 'paragraph', 'children': list(children)}
+
+        elements = [
+            {'type': 'header2', 'children': [text('Title '), link('seafile', 'https://www.seafile.com/')]},
+            paragraph(text('a  '), text('bold', bold=True), text(' and\n'), text('both', bold=True, italic=True)),
+            paragraph(text('1. not a list'), link('(x)', 'https://example.com/a_(b)'), text(' -- + - x')),
+            paragraph(text('a \\* b <b>tag</b> &amp; x < y & z '), link('top', '#top')),
+            paragraph(text('img '), {'type': 'image', 'data': {'src': '/a.png'}, 'children': [text('')]}),
+            {'type': 'check_list_item', 'checked': True, 'children': [text('done', italic=True)]},
+            {'type': 'blockquote', 'children': [
+                paragraph(text('- quoted')), paragraph(text('')), text('one\n\n two'),
+                {'type': 'check_list_item', 'checked': False, 'children': [text('todo')]},
+            ]},
+        ]
+
+        self.assertEqual(sdoc2md({'elements': elements}).split('\n'), [
+            '## Title [seafile](https://www.seafile.com/)',
+            '',
+            'a **bold** and**_both_**',
+            '',
+            '1\\. not a list[(x)](https://example.com/a_\\(b\\)) \\-- + - x',
+            '',
+            'a \\\\* b \\<b>tag\\</b> \\&amp; x < y & z top',
+            '',
+            'img ![](/a.png)',
+            '',
+            '* [x] _done_',
+            '',
+            '> \\- quoted',
+            '> ',
+            '> one',
+            '> ',
+            '> two',
+            '> ',
+            '> * [ ] todo',
+            '',
+        ])
+
+    @patch('seadoc_converter.converter.utils.SEAHUB_SERVICE_URL', 'https://example.com/')
+    def test_sdoc2md_bundle(self):
+        doc = image_doc(['/a.png', '/b.png', '/a.png', '/missing.png'])
+        doc['elements'].append({'type': 'image_block', 'children': [
+            {'type': 'image', 'data': {'src': '/b.png'}, 'children': [{'text': 'b'}]},
+        ]})
+        doc['elements'].append({'type': 'blockquote', 'children': [
+            {'type': 'image', 'data': {'src': '/c.png'}, 'children': [{'text': ''}]},
+        ]})
+        # lists are written without their images
+        doc['elements'].append({'type': 'unordered_list', 'children': [
+            {'type': 'list_item', 'children': [{'type': 'paragraph', 'children': [
+                {'text': 'item'}, {'type': 'image', 'data': {'src': '/in-list.png'}, 'children': [{'text': ''}]},
+            ]}]},
+        ]})
+        downloaded = []
+
+        def download_image(image_src, doc_uuid, download_link=None):
+            downloaded.append(image_src)
+            if image_src == '/missing.png':
+                return None
+            return image_src.encode(), 'image/png'
+
+        with patch('seadoc_converter.converter.utils.download_image', side_effect=download_image):
+            markdown, files = sdoc2md_bundle(doc, doc_uuid=DOC_UUID)
+
+        self.assertEqual(sorted(downloaded), ['/a.png', '/b.png', '/c.png', '/missing.png'])
+        self.assertEqual(files, {'images/a.png': b'/a.png', 'images/b.png': b'/b.png', 'images/c.png': b'/c.png'})
+        self.assertEqual(markdown.split('\n'), [
+            '![](images/a.png)', '',
+            '![](images/b.png)', '',
+            '![](images/a.png)', '',
+            '![](https://example.com/api/v2.1/seadoc/download-image/test-doc-uuid/missing.png)', '',
+            '![b](images/b.png)', '',
+            '> ![](images/c.png)', '',
+            '* item',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()